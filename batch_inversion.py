@@ -0,0 +1,67 @@
+import argparse
+import logging
+import os
+
+from models import create_model
+from utils.inversion_utils import batch_inversion
+from utils.logger import get_root_logger
+from utils.options import (dict2str, dict_to_nonedict, parse,
+                           parse_opt_wrt_resolution)
+from utils.util import make_exp_dirs
+
+
+def parse_args():
+    """Parses arguments."""
+    parser = argparse.ArgumentParser(description='')
+    parser.add_argument('--opt', type=str, help='Path to option YAML file.')
+    parser.add_argument(
+        '--img_dir',
+        type=str,
+        default=None,
+        help='Directory of the images, overrides inversion img_dir.')
+    parser.add_argument(
+        '--latent_store',
+        type=str,
+        default=None,
+        help='Directory of the inverted latent codes, an interrupted run '
+        'resumes with the images not saved there yet.')
+
+    return parser.parse_args()
+
+
+def main():
+    # ---------- Set up -----------
+    args = parse_args()
+
+    opt = parse(args.opt, is_train=False)
+    opt = parse_opt_wrt_resolution(opt)
+    make_exp_dirs(opt)
+
+    # convert to NoneDict, which returns None for missing keys
+    opt = dict_to_nonedict(opt)
+
+    # set up logger
+    save_log_path = f'{opt["path"]["log"]}'
+    inversion_logger = get_root_logger(
+        logger_name='base',
+        log_level=logging.INFO,
+        log_file=f'{save_log_path}/inversion.log')
+    inversion_logger.info(dict2str(opt))
+
+    os.makedirs(f'{opt["path"]["visualization"]}')
+
+    img_dir = args.img_dir or opt['inversion']['img_dir']
+    store_dir = args.latent_store or opt['inversion'][
+        'latent_store'] or f'{opt["path"]["visualization"]}/latent_store'
+
+    # ---------- create model ----------
+    field_model = create_model(opt)
+
+    # ---------- invert images -----------
+    latent_codes = batch_inversion(opt, field_model, img_dir, store_dir)
+    inversion_logger.info(
+        f'{len(latent_codes)} latent codes are saved in {store_dir}.')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,320 @@
+import argparse
+import asyncio
+import copy
+import json
+import logging
+import os.path
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import torch
+from aiohttp import web
+
+from language.run_encoder import EncoderSession, encode_request
+from models import create_model
+from models.utils import flush_image_writer, init_image_writer
+from utils.dialog_edit_utils import DIALOG_LOG_KEYS, dialog_turn, init_dialog
+from utils.inference_scheduler import InferenceScheduler
+from utils.logger import get_root_logger
+from utils.options import (dict2str, dict_to_nonedict, parse,
+                           parse_args_from_opt, parse_opt_wrt_resolution)
+from utils.util import make_exp_dirs
+
+
+def parse_args():
+    """Parses arguments."""
+    parser = argparse.ArgumentParser(description='')
+    parser.add_argument(
+        '--opt', default=None, type=str, help='Path to option YAML file.')
+    return parser.parse_args()
+
+
+def dumps(obj):
+    """json.dumps that also serializes the numpy labels in the dialog."""
+    return json.dumps(
+        obj,
+        default=lambda value: value.item()
+        if isinstance(value, np.generic) else str(value))
+
+
+class DialogService():
+    """Serve dialog-based editing sessions with resident models.
+
+    The generator, predictor, field functions and language encoder are loaded
+    once. Each session keeps its own dialog state and session model in the
+    session table and is advanced by one round per request. The rounds of the
+    sessions run at the same time in num_workers threads, their synthesis and
+    prediction are batched across the sessions by the inference scheduler.
+    Sessions idle for longer than session_idle_timeout seconds are evicted.
+
+    Routes:
+        POST /sessions: start a session, optional json body
+            {"latent_code_index": int}.
+        POST /sessions/{session_id}/turns: one dialog round, json body
+            {"text": str}.
+        GET /sessions/{session_id}: dialog logs of the session.
+        DELETE /sessions/{session_id}: end the session.
+        GET /metrics: queue depth, batch sizes and latencies of the inference
+            scheduler.
+    """
+
+    def __init__(self, field_model, opt, args, dialog_logger):
+        self.field_model = field_model
+        self.opt = opt
+        self.args = args
+        self.dialog_logger = dialog_logger
+
+        self.service_opt = opt['service']
+        self.sessions = {}
+        scheduler_opt = self.service_opt['scheduler'] or {}
+        self.scheduler = InferenceScheduler(
+            field_model,
+            max_batch_size=scheduler_opt.get('max_batch_size', 8),
+            max_wait=scheduler_opt.get('max_wait', 0.005))
+        self.executor = ThreadPoolExecutor(
+            max_workers=self.service_opt['num_workers'] or 8)
+        # the language encoder and its parse cache are shared by the sessions
+        self.encoder_lock = threading.Lock()
+
+    def create_app(self):
+        app = web.Application()
+        app.add_routes([
+            web.post('/sessions', self.create_session),
+            web.post('/sessions/{session_id}/turns', self.take_turn),
+            web.get('/sessions/{session_id}', self.get_session),
+            web.delete('/sessions/{session_id}', self.delete_session),
+            web.get('/metrics', self.get_metrics)
+        ])
+        app.on_startup.append(self.start_background_tasks)
+        app.on_cleanup.append(self.stop_background_tasks)
+        return app
+
+    async def start_background_tasks(self, app):
+        self.scheduler.start()
+        self.eviction_task = asyncio.ensure_future(self.evict_idle_sessions())
+
+    async def stop_background_tasks(self, app):
+        self.eviction_task.cancel()
+        await self.scheduler.stop()
+        self.executor.shutdown(wait=False)
+
+    async def evict_idle_sessions(self):
+        while True:
+            await asyncio.sleep(self.service_opt['eviction_interval'])
+            now = time.time()
+            for session_id in list(self.sessions.keys()):
+                session = self.sessions[session_id]
+                if now - session['last_active'] > self.service_opt[
+                        'session_idle_timeout'] and not session['busy']:
+                    self.dialog_logger.info(
+                        f'Session {session_id} is idle, evicted.')
+                    del self.sessions[session_id]
+
+    def get_session_or_404(self, request):
+        session_id = request.match_info['session_id']
+        if session_id not in self.sessions:
+            raise web.HTTPNotFound(
+                text=json.dumps({'error': f'Unknown session {session_id}.'}),
+                content_type='application/json')
+        session = self.sessions[session_id]
+        session['last_active'] = time.time()
+        return session
+
+    def load_latent_code(self, latent_code_index):
+        if self.opt['latent_code_path'] is None:
+            latent_code = torch.randn(1, 512, device=torch.device('cuda'))
+        else:
+            if latent_code_index is None:
+                latent_code_index = self.opt['latent_code_index']
+            latent_code = np.load(
+                self.opt['latent_code_path'], allow_pickle=True).item()[
+                    f"{str(latent_code_index).zfill(7)}.png"]
+            latent_code = torch.from_numpy(latent_code).to(
+                torch.device('cuda'))
+        with torch.no_grad():
+            latent_code = self.field_model.stylegan_gen.get_latent(
+                latent_code)
+        return latent_code.cpu().numpy()
+
+    async def run_in_executor(self, func, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, func, *args)
+
+    async def create_session(self, request):
+        body = await request.json() if request.can_read_body else {}
+
+        session_id = uuid.uuid4().hex
+        save_dir = f'{self.opt["path"]["visualization"]}/{session_id}'
+        os.makedirs(save_dir)
+        # each session saves its images into its own directory
+        session_opt = dict_to_nonedict(self.opt)
+        session_opt['path']['visualization'] = save_dir
+        session_model = self.field_model.session_model(self.scheduler)
+
+        def start():
+            latent_code = self.load_latent_code(body.get('latent_code_index'))
+            dialog = init_dialog(session_model, latent_code, session_opt,
+                                 self.dialog_logger)
+            # the images are returned to the client
+            flush_image_writer()
+            return dialog
+
+        dialog = await self.run_in_executor(start)
+        self.sessions[session_id] = {
+            'dialog': dialog,
+            'model': session_model,
+            'opt': session_opt,
+            'save_dir': save_dir,
+            'busy': False,
+            'last_active': time.time()
+        }
+        self.dialog_logger.info(f'Session {session_id} started.')
+
+        return web.json_response(
+            {
+                'session_id': session_id,
+                'attribute_dict': dialog['attribute_dict'],
+                'images': [f'{save_dir}/start_image.png']
+            },
+            dumps=dumps)
+
+    async def take_turn(self, request):
+        session = self.get_session_or_404(request)
+        body = await request.json()
+        if 'text' not in body:
+            raise web.HTTPBadRequest(
+                text=json.dumps({'error': 'Missing "text" in the request.'}),
+                content_type='application/json')
+        if session['dialog']['state_log'][-1] == 'end':
+            raise web.HTTPConflict(
+                text=json.dumps({'error': 'The dialog has ended.'}),
+                content_type='application/json')
+        if session['busy']:
+            raise web.HTTPConflict(
+                text=json.dumps({'error': 'The previous round is running.'}),
+                content_type='application/json')
+
+        dialog = session['dialog']
+        images = []
+
+        def turn():
+            self.dialog_logger.info(
+                f'\n---------------------------------------- Session '
+                f'{request.match_info["session_id"]} Edit '
+                f'{dialog["round_idx"]}'
+                '----------------------------------------\n')
+            # dialog_turn advances the dialog in place, a failed round is
+            # rolled back so that the session can retry it
+            snapshot = copy.deepcopy(dialog)
+            try:
+                with self.encoder_lock:
+                    user_labels = encode_request(
+                        self.args,
+                        system_mode=dialog['system_log'][-1]['system_mode'],
+                        dialog_logger=self.dialog_logger,
+                        input_request=body['text'])
+                system_labels = dialog_turn(
+                    session['model'],
+                    dialog,
+                    user_labels,
+                    session['opt'],
+                    self.args,
+                    self.dialog_logger,
+                    image_paths=images)
+                # the images are returned to the client
+                flush_image_writer()
+            except Exception:
+                dialog.clear()
+                dialog.update(snapshot)
+                raise
+            return system_labels
+
+        session['busy'] = True
+        try:
+            system_labels = await self.run_in_executor(turn)
+        finally:
+            session['busy'] = False
+            session['last_active'] = time.time()
+
+        return web.json_response(
+            {
+                'state': dialog['state_log'][-1],
+                'ended': system_labels is None,
+                'system_feedback':
+                None if system_labels is None else system_labels['text'],
+                'attribute_dict': dialog['attribute_dict'],
+                'images': images
+            },
+            dumps=dumps)
+
+    async def get_session(self, request):
+        session = self.get_session_or_404(request)
+        dialog = session['dialog']
+        return web.json_response(
+            {key: dialog[key]
+             for key in DIALOG_LOG_KEYS},
+            dumps=dumps)
+
+    async def get_metrics(self, request):
+        return web.json_response(self.scheduler.metrics())
+
+    async def delete_session(self, request):
+        self.get_session_or_404(request)
+        session_id = request.match_info['session_id']
+        del self.sessions[session_id]
+        self.dialog_logger.info(f'Session {session_id} ended.')
+        return web.json_response({'session_id': session_id})
+
+
+def main():
+
+    # ---------- Set up -----------
+    args = parse_args()
+    opt = parse(args.opt, is_train=False)
+    opt = parse_opt_wrt_resolution(opt)
+    args = parse_args_from_opt(args, opt)
+    make_exp_dirs(opt)
+
+    # convert to NoneDict, which returns None for missing keys
+    opt = dict_to_nonedict(opt)
+
+    # set up logger
+    save_log_path = f'{opt["path"]["log"]}'
+    dialog_logger = get_root_logger(
+        logger_name='dialog',
+        log_level=logging.INFO,
+        log_file=f'{save_log_path}/dialog.log')
+    dialog_logger.info(dict2str(opt))
+
+    os.makedirs(f'{opt["path"]["visualization"]}')
+    init_image_writer(opt['image_writer'])
+
+    # ---------- Load files -----------
+    dialog_logger.info('loading template files')
+    with open(opt['feedback_templates_file'], 'r') as f:
+        args.feedback_templates = json.load(f)
+        args.feedback_replacement = args.feedback_templates['replacement']
+    with open(opt['pool_file'], 'r') as f:
+        pool = json.load(f)
+        args.synonyms_dict = pool["synonyms"]
+
+    # ---------- load language encoder ----------
+    dialog_logger.info('loading language encoder')
+    args.encoder_session = EncoderSession(args)
+
+    # ---------- create model ----------
+    field_model = create_model(opt)
+
+    # ---------- Serve dialog sessions -----------
+    service = DialogService(field_model, opt, args, dialog_logger)
+    web.run_app(
+        service.create_app(),
+        host=opt['service']['host'],
+        port=opt['service']['port'])
+
+
+if __name__ == '__main__':
+    main()
@@ -5,6 +5,8 @@ import os
 import numpy as np
 
 from models import create_model
+from models.utils import (close_image_writer, flush_image_writer,
+                          init_image_writer)
 from utils.logger import get_root_logger
 from utils.numerical_metrics import compute_num_metrics
 from utils.options import dict2str, dict_to_nonedict, parse
@@ -39,12 +41,16 @@ def main():
 
     editing_logger.info(dict2str(opt))
 
+    init_image_writer(opt['image_writer'])
+
     field_model = create_model(opt)
 
     field_model.load_network(args.pretrained_path)
 
-    field_model.continuous_editing(editing_latent_codes, save_path,
-                                   editing_logger)
+    field_model.continuous_editing_batch(editing_latent_codes,
+                                         save_path, editing_logger)
+    # the metrics are computed on the saved images
+    flush_image_writer()
 
     _, _ = compute_num_metrics(save_path, num_latent_codes,
                                opt['pretrained_arcface'], opt['attr_file'],
@@ -52,6 +58,8 @@ def main():
                                opt['attr_dict'][opt['attribute']],
                                editing_logger)
 
+    close_image_writer()
+
 
 if __name__ == '__main__':
     main()
@@ -6,9 +6,11 @@ import os.path
 import numpy as np
 import torch
 
+from language.run_encoder import EncoderSession
 from models import create_model
+from models.utils import close_image_writer, init_image_writer
 from utils.dialog_edit_utils import dialog_with_real_user
-from utils.inversion_utils import inversion
+from utils.inversion_utils import LatentStore, inversion
 from utils.logger import get_root_logger
 from utils.options import (dict2str, dict_to_nonedict, parse,
                            parse_args_from_opt, parse_opt_wrt_resolution)
@@ -45,6 +47,7 @@ def main():
 
     save_image_path = f'{opt["path"]["visualization"]}'
     os.makedirs(save_image_path)
+    init_image_writer(opt['image_writer'])
 
     # ---------- Load files -----------
     dialog_logger.info('loading template files')
@@ -55,12 +58,21 @@ def main():
         pool = json.load(f)
         args.synonyms_dict = pool["synonyms"]
 
+    # ---------- load language encoder ----------
+    # keep the encoder resident for all the dialog rounds
+    dialog_logger.info('loading language encoder')
+    args.encoder_session = EncoderSession(args)
+
     # ---------- create model ----------
     field_model = create_model(opt)
 
     # ---------- load latent code ----------
     if opt['inversion']['is_real_image']:
         latent_code = inversion(opt, field_model)
+    elif opt['inversion']['latent_store_name'] is not None:
+        # w latent code inverted by batch_inversion.py
+        latent_code = LatentStore(opt['inversion']['latent_store']).load(
+            opt['inversion']['latent_store_name'])
     else:
         if opt['latent_code_path'] is None:
             latent_code = torch.randn(1, 512, device=torch.device('cuda'))
@@ -89,6 +101,7 @@ def main():
     # ---------- Log the dialog history -----------
     for (key, value) in dialog_overall_log.items():
         dialog_logger.info(f'{key}: {value}')
+    close_image_writer()
     dialog_logger.info('successfully end.')
 
 
@@ -6,9 +6,10 @@ import numpy as np
 import torch
 
 from models import create_model
-from models.utils import save_image
+from models.utils import (close_image_writer, init_image_writer,
+                          save_image)
 from utils.editing_utils import edit_target_attribute
-from utils.inversion_utils import inversion
+from utils.inversion_utils import LatentStore, inversion
 from utils.logger import get_root_logger
 from utils.options import (dict2str, dict_to_nonedict, parse,
                            parse_opt_wrt_resolution)
@@ -48,6 +49,7 @@ def main():
 
     save_image_path = f'{opt["path"]["visualization"]}'
     os.makedirs(save_image_path)
+    init_image_writer(opt['image_writer'])
 
     # ---------- create model ----------
     field_model = create_model(opt)
@@ -55,6 +57,10 @@ def main():
     # ---------- load latent code ----------
     if opt['inversion']['is_real_image']:
         latent_code = inversion(opt, field_model)
+    elif opt['inversion']['latent_store_name'] is not None:
+        # w latent code inverted by batch_inversion.py
+        latent_code = LatentStore(opt['inversion']['latent_store']).load(
+            opt['inversion']['latent_store_name'])
     else:
         if opt['latent_code_path'] is None:
             latent_code = torch.randn(1, 512, device=torch.device('cuda'))
@@ -107,6 +113,8 @@ def main():
         elif exception_mode == 'max_edit_num_reached':
             editing_logger.info("Sorry, we are unable to edit this attribute. Perhaps we can try something else.")
 
+    close_image_writer()
+
 
 
 if __name__ == '__main__':
@@ -1,6 +1,7 @@
 import argparse
 import json
 import random
+from collections import OrderedDict
 
 import torch
 
@@ -54,6 +55,9 @@ def parse_args():
     parser.add_argument('--linear_hidden_size', default=256, type=int)
     parser.add_argument('--linear_dropout_rate', default=0, type=float)
 
+    # number of free-form requests whose parse is kept
+    parser.add_argument('--parse_cache_size', default=1024, type=int)
+
     return parser.parse_args()
 
 
@@ -62,164 +66,256 @@ def main():
     encode_request(args)
 
 
-def encode_request(args, system_mode=None, dialog_logger=None, input_request=None):
-    # set up
-    if args.device_name == 'cpu':
-        args.device = torch.device('cpu')
-    elif args.device_name == 'gpu':
-        args.device = torch.device('cuda')
-
-    if dialog_logger is None:
-        output_function = print
-    else:
-        # output_function = dialog_logger.info
-        def output_function(input):
-            # suppress output when called by other scripts
-            pass
+class EncoderSession():
+    """Resident language encoder.
+
+    Loads the system modes, vocabulary, metadata and the pretrained encoder
+    once, so that every later request only pays for tokenization and one
+    forward pass.
+    """
+
+    def __init__(self, args):
+        self.args = args
+
+        # set up
+        if args.device_name == 'cpu':
+            args.device = torch.device('cpu')
+        elif args.device_name == 'gpu':
+            args.device = torch.device('cuda')
+        self.device = args.device
+
+        # load system_mode
+        with open(args.system_mode_file, 'r') as f:
+            system_mode_dict = json.load(f)
+        self.system_mode_list = []
+        for (mode, mode_idx) in system_mode_dict.items():
+            self.system_mode_list.append(mode)
+
+        # load vocabulary
+        with open(args.input_vocab_file, 'r') as f:
+            vocab = json.load(f)
+        self.text_token_to_idx = vocab['text_token_to_idx']
+
+        # prepare encoder
+        self.encoder = Encoder(
+            token_to_idx=self.text_token_to_idx,
+            word_embedding_dim=args.word_embedding_dim,
+            text_embed_size=args.text_embed_size,
+            metadata_file=args.metadata_file,
+            linear_hidden_size=args.linear_hidden_size,
+            linear_dropout_rate=args.linear_dropout_rate)
+        self.encoder = self.encoder.to(self.device)
+        checkpoint = torch.load(
+            args.pretrained_checkpoint, map_location=self.device)
+        self.encoder.load_state_dict(checkpoint['state_dict'], True)
+        self.encoder.eval()
+
+        # load metadata file
+        with open(args.metadata_file, 'r') as f:
+            metadata = json.load(f)
+
+        # find mapping from value to label
+        self.reversed_metadata = {}
+        for idx, (key, val) in enumerate(metadata.items()):
+            reversed_val = reverse_dict(val)  # noqa
+            self.reversed_metadata[key] = reversed_val
+
+        # parsed labels keyed on (system_mode, text), the warm-up vocabulary
+        # is fixed and kept whole, other requests are kept in a bounded LRU
+        self.warm_up_cache = {}
+        self.parse_cache = OrderedDict()
+        self.parse_cache_size = getattr(args, 'parse_cache_size',
+                                        None) or 1024
+
+    def warm_up(self, texts, system_modes=None):
+        """Parse texts for all system modes with one batched forward."""
+        if system_modes is None:
+            system_modes = self.system_mode_list
+        texts = [
+            input_text for input_text in texts if any(
+                (system_mode, input_text) not in self.warm_up_cache
+                for system_mode in system_modes)
+        ]
+        if len(texts) == 0:
             return
+        batch_output_labels = self.forward(texts)
+        for input_text, output_labels in zip(texts, batch_output_labels):
+            for system_mode in system_modes:
+                self.warm_up_cache[(system_mode, input_text)] = self.decode(
+                    output_labels, system_mode, input_text)
+
+    def forward(self, texts):
+        """Encode a list of texts, return the predicted class of each head."""
+        text_encoded = []
+        for input_text in texts:
+            text_tokens = tokenize(text=input_text)  # noqa
+            text_encoded.append(
+                encode(  # noqa
+                    text_tokens=text_tokens,
+                    token_to_idx=self.text_token_to_idx,
+                    allow_unk=self.args.allow_unknown))
+        # pad with <NULL>, the LSTM reads the state of the last valid token
+        max_text_length = max(len(tokens) for tokens in text_encoded)
+        null_idx = self.text_token_to_idx['<NULL>']
+        text_encoded = [
+            tokens + [null_idx] * (max_text_length - len(tokens))
+            for tokens in text_encoded
+        ]
+        text_encoded = to_long_tensor(text_encoded).to(self.device)  # noqa
+
+        # forward pass
+        with torch.no_grad():
+            output = self.encoder(text_encoded)
+
+        preds = torch.stack(
+            [torch.max(output[head_idx], 1)[1]
+             for head_idx in range(len(output))],
+            dim=1).cpu().numpy()
+        return [list(pred) for pred in preds]
+
+    def encode(self, system_mode=None, dialog_logger=None,
+               input_request=None):
+        args = self.args
+
+        if dialog_logger is None:
+            output_function = print
+            compulsory_output_function = print
+        else:
+            # output_function = dialog_logger.info
+            def output_function(input):
+                # suppress output when called by other scripts
+                pass
+                return
+
+            compulsory_output_function = dialog_logger.info
+
+        # ---------------- STEP 1: Input the Request ----------------
+
+        # choose system_mode
+        if __name__ == '__main__':
+            assert system_mode is None
+            system_mode = random.choice(self.system_mode_list)
+            output_function('      PREDEFINED system_mode:', system_mode)
+        else:
+            assert system_mode is not None
+
+        # input request
+        if input_request is None:
+            compulsory_output_function('Enter your request (Press enter when you finish):')
+            input_text = input()
+        else:
+            input_text = input_request
+            # input_text = 'make the bangs slightly longer.'
+        compulsory_output_function('USER INPUT >>> ' + input_text)
+
+        cache_key = (system_mode, input_text)
+        if cache_key in self.warm_up_cache:
+            return dict(self.warm_up_cache[cache_key])
+        if cache_key not in self.parse_cache:
+            # ------------- STEP 2 & 3: Preprocess and Encode Request -------------
+            output_labels = self.forward([input_text])[0]
+
+            # ---------------- STEP 4: Process Encoder Output ----------------
+            self.parse_cache[cache_key] = self.decode(
+                output_labels, system_mode, input_text, output_function)
+            while len(self.parse_cache) > self.parse_cache_size:
+                self.parse_cache.popitem(last=False)
+        self.parse_cache.move_to_end(cache_key)
+
+        return dict(self.parse_cache[cache_key])
+
+    def decode(self,
+               output_labels,
+               system_mode,
+               input_text,
+               output_function=None):
+        args = self.args
+        if output_function is None:
+
+            def output_function(*input):
+                pass
+                return
+
+        if args.verbose:
+            output_function('reversed_metadata:', self.reversed_metadata)
+
+        # convert predicted values to a dict of predicted labels
+        output_semantic_labels = {}  # from LSTM output
+        valid_semantic_labels = {}  # useful information among LSTM output
+        for idx, (key, val) in enumerate(self.reversed_metadata.items()):
+            output_semantic_labels[key] = val[output_labels[idx]]
+            valid_semantic_labels[key] = None
+        if args.verbose:
+            output_function('output_semantic_labels:', output_semantic_labels)
+
+        # extract predicted labels
+        user_mode = output_semantic_labels[system_mode]
+        valid_semantic_labels[system_mode] = user_mode
+
+        request_mode = output_semantic_labels['request_mode']
+        attribute = output_semantic_labels['attribute']
+        score_change_direction = output_semantic_labels[
+            'score_change_direction']
+        if output_semantic_labels['score_change_value'] is None:
+            score_change_value = None
+        else:
+            score_change_value = int(
+                output_semantic_labels['score_change_value'])
+        if output_semantic_labels['target_score'] is None:
+            target_score = None
+        else:
+            target_score = int(output_semantic_labels['target_score'])
+
+        # print to screen
+        output_function('      ENCODED user_mode:' + ' ' + user_mode)
+        valid_semantic_labels['user_mode'] = user_mode
+        if 'pureRequest' in user_mode:
+            output_function('      ENCODED request_mode: ' + ' ' +
+                            request_mode)
+            valid_semantic_labels['request_mode'] = request_mode
+            output_function('      ENCODED attribute:' + ' ' + attribute)
+            valid_semantic_labels['attribute'] = attribute
+            # only output_function labels valid for this request_mode
+            if request_mode == 'change_definite':
+                output_function('      ENCODED score_change_direction:' +
+                                ' ' + (score_change_direction))
+                valid_semantic_labels[
+                    'score_change_direction'] = score_change_direction
+                output_function('      ENCODED score_change_value:' + ' ' +
+                                str(score_change_value))
+                valid_semantic_labels[
+                    'score_change_value'] = score_change_value
+            elif request_mode == 'change_indefinite':
+                output_function('      ENCODED score_change_direction:' +
+                                ' ' + score_change_direction)
+                valid_semantic_labels[
+                    'score_change_direction'] = score_change_direction
+            elif request_mode == 'target':
+                output_function('      ENCODED target_score:' + ' ' +
+                                str(target_score))
+                valid_semantic_labels['target_score'] = target_score
+
+        valid_semantic_labels['text'] = input_text
+
+        if args.verbose:
+            output_function('valid_semantic_labels:' + ' ' +
+                            str(valid_semantic_labels))
+
+        return valid_semantic_labels
 
-        compulsory_output_function = dialog_logger.info
-
-    # ---------------- STEP 1: Input the Request ----------------
-
-    # choose system_mode
-    with open(args.system_mode_file, 'r') as f:
-        system_mode_dict = json.load(f)
-    system_mode_list = []
-    for (mode, mode_idx) in system_mode_dict.items():
-        system_mode_list.append(mode)
-
-    if __name__ == '__main__':
-        assert system_mode is None
-        system_mode = random.choice(system_mode_list)
-        output_function('      PREDEFINED system_mode:', system_mode)
-    else:
-        assert system_mode is not None
-
-    # input request
-    if input_request is None:
-        compulsory_output_function('Enter your request (Press enter when you finish):')
-        input_text = input()
-    else:
-        input_text = input_request
-        # input_text = 'make the bangs slightly longer.'
-    compulsory_output_function('USER INPUT >>> ' + input_text)
-
-    # ---------------- STEP 2: Preprocess Request ----------------
-
-    # output_function("      The system is trying to understand your request:")
-    # output_function("      ########################################")
-
-    # load vocabulary
-    with open(args.input_vocab_file, 'r') as f:
-        vocab = json.load(f)
-    text_token_to_idx = vocab['text_token_to_idx']
-
-    text_tokens = tokenize(text=input_text)  # noqa
-    text_encoded = encode(  # noqa
-        text_tokens=text_tokens,
-        token_to_idx=text_token_to_idx,
-        allow_unk=args.allow_unknown)
-    text_encoded = to_long_tensor([text_encoded]).to(args.device)  # noqa
-
-    # ---------------- STEP 3: Encode Request ----------------
-
-    # prepare encoder
-    encoder = Encoder(
-        token_to_idx=text_token_to_idx,
-        word_embedding_dim=args.word_embedding_dim,
-        text_embed_size=args.text_embed_size,
-        metadata_file=args.metadata_file,
-        linear_hidden_size=args.linear_hidden_size,
-        linear_dropout_rate=args.linear_dropout_rate)
-    encoder = encoder.to(args.device)
-    checkpoint = torch.load(args.pretrained_checkpoint)
-    encoder.load_state_dict(checkpoint['state_dict'], True)
-    encoder.eval()
-
-    # forward pass
-    output = encoder(text_encoded)
-
-    # ---------------- STEP 4: Process Encoder Output ----------------
-
-    output_labels = []
-    for head_idx in range(len(output)):
-        _, pred = torch.max(output[head_idx], 1)
-        head_label = pred.cpu().numpy()[0]
-        output_labels.append(head_label)
-
-    # load metadata file
-    with open(args.metadata_file, 'r') as f:
-        metadata = json.load(f)
-
-    # find mapping from value to label
-    reversed_metadata = {}
-    for idx, (key, val) in enumerate(metadata.items()):
-        reversed_val = reverse_dict(val)  # noqa
-        reversed_metadata[key] = reversed_val
-    if args.verbose:
-        output_function('reversed_metadata:', reversed_metadata)
-
-    # convert predicted values to a dict of predicted labels
-    output_semantic_labels = {}  # from LSTM output
-    valid_semantic_labels = {}  # useful information among LSTM output
-    for idx, (key, val) in enumerate(reversed_metadata.items()):
-        output_semantic_labels[key] = val[output_labels[idx]]
-        valid_semantic_labels[key] = None
-    if args.verbose:
-        output_function('output_semantic_labels:', output_semantic_labels)
-
-    # extract predicted labels
-    user_mode = output_semantic_labels[system_mode]
-    valid_semantic_labels[system_mode] = user_mode
-
-    request_mode = output_semantic_labels['request_mode']
-    attribute = output_semantic_labels['attribute']
-    score_change_direction = output_semantic_labels['score_change_direction']
-    if output_semantic_labels['score_change_value'] is None:
-        score_change_value = None
-    else:
-        score_change_value = int(output_semantic_labels['score_change_value'])
-    if output_semantic_labels['target_score'] is None:
-        target_score = None
-    else:
-        target_score = int(output_semantic_labels['target_score'])
-
-    # print to screen
-    output_function('      ENCODED user_mode:' + ' ' + user_mode)
-    valid_semantic_labels['user_mode'] = user_mode
-    if 'pureRequest' in user_mode:
-        output_function('      ENCODED request_mode: ' + ' ' + request_mode)
-        valid_semantic_labels['request_mode'] = request_mode
-        output_function('      ENCODED attribute:' + ' ' + attribute)
-        valid_semantic_labels['attribute'] = attribute
-        # only output_function labels valid for this request_mode
-        if request_mode == 'change_definite':
-            output_function('      ENCODED score_change_direction:' + ' ' +
-                            (score_change_direction))
-            valid_semantic_labels[
-                'score_change_direction'] = score_change_direction
-            output_function('      ENCODED score_change_value:' + ' ' +
-                            str(score_change_value))
-            valid_semantic_labels['score_change_value'] = score_change_value
-        elif request_mode == 'change_indefinite':
-            output_function('      ENCODED score_change_direction:' + ' ' +
-                            score_change_direction)
-            valid_semantic_labels[
-                'score_change_direction'] = score_change_direction
-        elif request_mode == 'target':
-            output_function('      ENCODED target_score:' + ' ' +
-                            str(target_score))
-            valid_semantic_labels['target_score'] = target_score
-
-    valid_semantic_labels['text'] = input_text
-
-    if args.verbose:
-        output_function('valid_semantic_labels:' + ' ' +
-                        str(valid_semantic_labels))
-    # output_function("      ########################################")
-
-    return valid_semantic_labels
+
+def encode_request(args, system_mode=None, dialog_logger=None, input_request=None):
+    # the session is loaded on the first request and kept on args,
+    # so the following requests reuse the encoder and the parse cache
+    encoder_session = getattr(args, 'encoder_session', None)
+    if encoder_session is None:
+        encoder_session = EncoderSession(args)
+        args.encoder_session = encoder_session
+
+    return encoder_session.encode(
+        system_mode=system_mode,
+        dialog_logger=dialog_logger,
+        input_request=input_request)
 
 
 if __name__ == '__main__':
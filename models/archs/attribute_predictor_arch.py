@@ -1,9 +1,14 @@
 import json
 
+import torch
 import torch.nn as nn
+import torch.nn.functional as F
 import torch.utils.model_zoo as model_zoo
 
-__all__ = ['ResNet', 'resnet50']
+__all__ = ['ResNet', 'resnet50', 'fold_input_normalization']
+
+IMAGENET_MEAN = [0.485, 0.456, 0.406]
+IMAGENET_STD = [0.229, 0.224, 0.225]
 
 model_urls = {
     'resnet18': 'https://download.pytorch.org/models/resnet18-5c106cde.pth',
@@ -217,6 +222,77 @@ class ResNet(nn.Module):
         return y
 
 
+class NormalizedConv2d(nn.Module):
+    """First convolution of the predictor taking unnormalized images.
+
+    The input x is mapped to [0, 1] by clamp(x * input_scale + input_bias,
+    0, 1), area downsampled to input_res if larger, and normalized with the
+    ImageNet statistics before conv. The affine map and the normalization
+    are folded into the weight, the clamp is done in the input range and the
+    zero padding of the normalized image becomes a constant bias map, which
+    is computed once per input size.
+    """
+
+    def __init__(self, conv, input_scale=1., input_bias=0., input_res=128):
+        super(NormalizedConv2d, self).__init__()
+        assert conv.bias is None
+        self.stride = conv.stride
+        self.padding = conv.padding
+        self.input_res = input_res
+        self.clamp_min = -input_bias / input_scale
+        self.clamp_max = (1 - input_bias) / input_scale
+
+        weight = conv.weight.detach()
+        img_mean = torch.tensor(IMAGENET_MEAN).view(1, 3, 1, 1).to(weight)
+        img_std = torch.tensor(IMAGENET_STD).view(1, 3, 1, 1).to(weight)
+        # normalized image = x * scale + shift
+        scale = input_scale / img_std
+        shift = (input_bias - img_mean) / img_std
+
+        self.register_buffer('weight', weight * scale)
+        # shift in the input range: x * scale + shift is
+        # (x + input_shift) * scale
+        self.register_buffer('input_shift', shift / scale)
+        # bias maps keyed on the (height, width) of the input
+        self.bias_maps = {}
+
+    def bias_map(self, height, width):
+        """Response to the shift, which differs at the borders where the
+        normalized image is zero padded."""
+        bias = self.bias_maps.get((height, width))
+        if bias is None or bias.device != self.weight.device:
+            with torch.no_grad():
+                bias = F.conv2d(
+                    self.input_shift.expand(1, 3, height, width),
+                    self.weight,
+                    stride=self.stride,
+                    padding=self.padding)
+            self.bias_maps[(height, width)] = bias
+        return bias
+
+    def forward(self, x):
+        x = torch.clamp(x, self.clamp_min, self.clamp_max)
+        if x.size(-1) > self.input_res:
+            x = F.interpolate(x, (self.input_res, self.input_res), mode='area')
+        return F.conv2d(
+            x, self.weight, stride=self.stride,
+            padding=self.padding) + self.bias_map(x.size(-2), x.size(-1))
+
+
+def fold_input_normalization(predictor,
+                             input_scale=1.,
+                             input_bias=0.,
+                             input_res=128):
+    """Make a loaded predictor take unnormalized images directly.
+
+    conv1 is replaced by NormalizedConv2d, see its docstring for the
+    meaning of the arguments. Call it after loading the checkpoint.
+    """
+    predictor.conv1 = NormalizedConv2d(predictor.conv1, input_scale,
+                                       input_bias, input_res)
+    return predictor
+
+
 def resnet50(pretrained=True, **kwargs):
     """Constructs a ResNet-50 model.
 
@@ -1,5 +1,9 @@
+import math
+from typing import Optional, Tuple
+
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
 
 
 class FieldFunction(nn.Module):
@@ -45,8 +49,150 @@ class FieldFunction(nn.Module):
         return x
 
 
+class MultiFieldFunction(nn.Module):
+    """Field functions of several attributes evaluated in one pass.
+
+    The weights of the given FieldFunctions are stacked along a leading
+    attribute axis, so that each layer becomes a single batched matmul.
+
+    Input: batch_size x latent_dim
+    Output: num_fields x batch_size x latent_dim
+    """
+
+    def __init__(self, field_functions):
+
+        super(MultiFieldFunction, self).__init__()
+
+        layers = [list(field_function.field) for field_function in
+                  field_functions]
+        self.num_fields = len(layers)
+        self.num_layer = len(layers[0])
+
+        self.activations = []
+        self.negative_slopes = []
+        for layer_idx in range(self.num_layer):
+            linear_layers = [field[layer_idx] for field in layers]
+            # [num_fields, in_dim, out_dim]
+            weight = torch.stack([
+                linear_layer.Linear.weight.detach().t()
+                for linear_layer in linear_layers
+            ])
+            # [num_fields, 1, out_dim]
+            bias = torch.stack([
+                linear_layer.Linear.bias.detach()
+                for linear_layer in linear_layers
+            ]).unsqueeze(1)
+            self.register_buffer(f'weight_{layer_idx}', weight.clone())
+            self.register_buffer(f'bias_{layer_idx}', bias.clone())
+
+            self.activations.append(linear_layers[0].activation)
+            if linear_layers[0].activation:
+                self.negative_slopes.append(
+                    linear_layers[0].leaky_relu.negative_slope)
+            else:
+                self.negative_slopes.append(None)
+
+    def forward(self, x):
+        x = x.unsqueeze(0).expand(self.num_fields, -1, -1)
+        for layer_idx in range(self.num_layer):
+            x = torch.baddbmm(
+                getattr(self, f'bias_{layer_idx}'), x,
+                getattr(self, f'weight_{layer_idx}'))
+            if self.activations[layer_idx]:
+                x = F.leaky_relu(
+                    x, negative_slope=self.negative_slopes[layer_idx])
+        return x
+
+
+class StyleMapping(nn.Module):
+    """Offset of the StyleGAN2 style MLP (PixelNorm skipped) w.r.t. zero.
+
+    Computes style(x) - style(0) as Generator.style_forward with
+    skip_norm does. The equalized learning rate scales are folded into the
+    weights, and style(0) is computed once, as the generator is frozen.
+
+    Input: batch_size x style_dim
+    Output: batch_size x style_dim
+    """
+
+    def __init__(self, style_layers, negative_slope=0.2):
+
+        super(StyleMapping, self).__init__()
+
+        self.num_layer = len(style_layers)
+        self.negative_slope = negative_slope
+        # scale of fused_leaky_relu
+        self.act_scale = math.sqrt(2)
+
+        # [num_layer, in_dim, out_dim]
+        weight = torch.stack([
+            (layer.weight * layer.scale).detach().t()
+            for layer in style_layers
+        ])
+        # [num_layer, out_dim]
+        bias = torch.stack(
+            [(layer.bias * layer.lr_mul).detach() for layer in style_layers])
+        self.register_buffer('weight', weight.clone())
+        self.register_buffer('bias', bias.clone())
+
+        with torch.no_grad():
+            offset = self.style_forward(torch.zeros_like(bias[:1]))
+        self.register_buffer('offset', offset)
+
+    def style_forward(self, x):
+        for layer_idx in range(self.num_layer):
+            x = F.leaky_relu(
+                torch.addmm(self.bias[layer_idx], x, self.weight[layer_idx]),
+                negative_slope=self.negative_slope) * self.act_scale
+        return x
+
+    def forward(self, x):
+        return self.style_forward(x) - self.offset
+
+
+class FieldEditOperator(nn.Module):
+    """One editing step along the field.
+
+    delta_w = style(field(w)) - style(0) is added to the first
+    replaced_layers layers of the w plus latent code (w broadcast to all the
+    layers if not given) with one broadcasted add. Can be exported with
+    torch.jit.script.
+
+    Input: w: batch_size x latent_dim,
+        w plus: batch_size x num_layers x latent_dim or None, alpha
+    Output: delta_w: batch_size x latent_dim,
+        edited w plus: batch_size x num_layers x latent_dim
+    """
+
+    def __init__(self, field_function, style_mapping, replaced_layers,
+                 num_layers):
+
+        super(FieldEditOperator, self).__init__()
+
+        self.field_function = field_function
+        self.style_mapping = style_mapping
+
+        layer_mask = torch.zeros(1, num_layers, 1)
+        layer_mask[:, :replaced_layers] = 1
+        self.register_buffer(
+            'layer_mask', layer_mask.to(style_mapping.offset.device))
+
+    def forward(self,
+                latent_code_w: torch.Tensor,
+                latent_code_w_plus: Optional[torch.Tensor] = None,
+                alpha: float = 1.) -> Tuple[torch.Tensor, torch.Tensor]:
+        delta_w = self.style_mapping(self.field_function(latent_code_w))
+        if latent_code_w_plus is None:
+            latent_code_w_plus = latent_code_w.unsqueeze(1)
+        edited_latent_code = latent_code_w_plus + (
+            alpha * delta_w).unsqueeze(1) * self.layer_mask
+        return delta_w, edited_latent_code
+
+
 class LinearLayer(nn.Module):
 
+    __constants__ = ['activation']
+
     def __init__(
         self,
         in_dim=512,
@@ -105,6 +105,7 @@ if __name__ == "__main__":
     checkpoint = torch.load(args.ckpt)
 
     g_ema.load_state_dict(checkpoint["g_ema"])
+    g_ema.set_latent_stats_cache(args.ckpt)
 
     if args.truncation < 1:
         with torch.no_grad():
@@ -0,0 +1,91 @@
+"""
+Persisted W space statistics of a generator checkpoint.
+
+The mean and std of the W space are estimated by mapping n_latent random z
+latent codes, which is the same for every run with the same checkpoint. The
+statistics are saved next to the checkpoint, keyed on the checkpoint path and
+the hash of its content, and loaded instead of sampled again.
+"""
+
+import hashlib
+import logging
+import os
+
+import torch
+
+logger = logging.getLogger('base')
+
+
+def latent_stats_path(ckpt_path):
+    return f'{os.path.splitext(ckpt_path)[0]}_latent_stats.pth'
+
+
+def compute_latent_stats(generator, n_latent):
+    with torch.no_grad():
+        noise_sample = torch.randn(
+            n_latent, generator.style_dim, device=generator.input.input.device)
+        latent_out = generator.style_forward(noise_sample)
+
+        latent_mean = latent_out.mean(0)
+        latent_std = ((latent_out - latent_mean).pow(2).sum() / n_latent)**0.5
+
+    return {'mean': latent_mean, 'std': latent_std}
+
+
+def checkpoint_hash(ckpt_path):
+    digest = hashlib.sha1()
+    with open(ckpt_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def load_latent_stats(generator, ckpt_path, n_latent):
+    """Statistics of n_latent samples of the generator loaded from ckpt_path.
+
+    The saved statistics are used if they were computed for the same
+    checkpoint content, otherwise they are computed and saved. The content
+    hash is only recomputed when the size or mtime of the checkpoint changed.
+
+    Returns a dict of 'mean' ([style_dim]) and 'std' (scalar) on the device
+    of the generator.
+    """
+    stats_path = latent_stats_path(ckpt_path)
+    ckpt_stat = os.stat(ckpt_path)
+    ckpt_info = {
+        'ckpt_path': os.path.abspath(ckpt_path),
+        'ckpt_size': ckpt_stat.st_size,
+        'ckpt_mtime': ckpt_stat.st_mtime
+    }
+
+    saved = None
+    if os.path.exists(stats_path):
+        saved = torch.load(
+            stats_path, map_location=generator.input.input.device)
+        if any(saved.get(key) != value for key, value in ckpt_info.items()):
+            # the checkpoint was moved or rewritten, compare the content
+            if saved.get('ckpt_hash') != checkpoint_hash(ckpt_path):
+                saved = None
+            else:
+                saved.update(ckpt_info)
+        elif n_latent in saved['stats']:
+            return saved['stats'][n_latent]
+
+    if saved is None:
+        saved = dict(ckpt_info, ckpt_hash=checkpoint_hash(ckpt_path), stats={})
+    if n_latent not in saved['stats']:
+        logger.info(f'Computing the W space statistics of {ckpt_path} with '
+                    f'{n_latent} samples.')
+        saved['stats'][n_latent] = compute_latent_stats(generator, n_latent)
+    stats = saved['stats'][n_latent]
+
+    # write to a temporary file first so that a concurrent reader never sees
+    # a partial file, a read-only checkpoint directory only skips the saving
+    try:
+        torch.save(saved, f'{stats_path}.{os.getpid()}.tmp')
+        os.replace(f'{stats_path}.{os.getpid()}.tmp', stats_path)
+    except OSError as error:
+        logger.warning(f'Cannot save the W space statistics to {stats_path}: '
+                       f'{error}')
+
+    return stats
@@ -31,10 +31,13 @@ class PerceptualLoss(torch.nn.Module):
             colorspace=colorspace,
             spatial=self.spatial,
             gpu_ids=gpu_ids)
+        self.target_feats = None
 
-    def forward(self, pred, target, normalize=False):
+    def forward(self, pred, target=None, normalize=False, target_feats=None):
         """
         Pred and target are Variables.
+        If target is None, target_feats from target_features are used, or the
+        target set by set_target if target_feats is None too.
         If normalize is True, assumes the images are between [0,1] and then scales them between [-1,+1]
         If normalize is False, assumes the images are already between [-1,+1]
 
@@ -43,11 +46,40 @@ class PerceptualLoss(torch.nn.Module):
         """
 
         if normalize:
-            target = 2 * target - 1
             pred = 2 * pred - 1
+            if target is not None:
+                target = 2 * target - 1
+
+        if target is None:
+            if target_feats is None:
+                target_feats = self.target_feats
+            if target_feats is None:
+                raise ValueError(
+                    'No target is given and no target is set by set_target.')
+            return self.model.forward(None, pred, feats0=target_feats)
 
         return self.model.forward(target, pred)
 
+    def target_features(self, target, normalize=False):
+        """
+        Precompute the features of a constant target, e.g., the image to be
+        inverted, so that forward(pred, target_feats=...) only runs pred
+        through the network. The target is Nx3xHxW, normalized as in forward.
+        The features of several targets can be concatenated per layer.
+        """
+        if normalize:
+            target = 2 * target - 1
+
+        with torch.no_grad():
+            return self.model.compute_features(target)
+
+    def set_target(self, target, normalize=False):
+        """Keep the features of target for forward(pred)."""
+        self.target_feats = self.target_features(target, normalize)
+
+    def clear_target(self):
+        self.target_feats = None
+
 
 def normalize_tensor(in_feat, eps=1e-10):
     norm_factor = torch.sqrt(torch.sum(in_feat**2, dim=1, keepdim=True))
@@ -127,14 +127,29 @@ class DistModel(BaseModel):
             networks.print_network(self.net)
             print('-----------------------------------------------')
 
-    def forward(self, in0, in1, retPerLayer=False):
+    def compute_features(self, in0):
+        ''' Function computes the normalized per-layer features of in0, only for the net-lin and net models
+        INPUTS
+            in0 - torch.Tensor object of shape Nx3xXxY - image patch scaled to [-1,1]
+        OUTPUT
+            list of the normalized features of each layer
+        '''
+        net = self.net.module if isinstance(
+            self.net, torch.nn.DataParallel) else self.net
+        return net.compute_features(in0)
+
+    def forward(self, in0, in1, retPerLayer=False, feats0=None):
         ''' Function computes the distance between image patches in0 and in1
         INPUTS
             in0, in1 - torch.Tensor object of shape Nx3xXxY - image patch scaled to [-1,1]
+            feats0 - optional features of in0 from compute_features, in0 is not used if given
         OUTPUT
             computed distances between in0 and in1
         '''
 
+        if feats0 is not None:
+            return self.net.forward(
+                None, in1, retPerLayer=retPerLayer, feats0=feats0)
         return self.net.forward(in0, in1, retPerLayer=retPerLayer)
 
     # ***** TRAINING FUNCTIONS *****
@@ -5,6 +5,8 @@ import random
 import sys
 
 import torch
+from models.archs.stylegan2.latent_stats import (compute_latent_stats,
+                                                 load_latent_stats)
 from models.archs.stylegan2.op import (FusedLeakyReLU, fused_leaky_relu,
                                        upfirdn2d)
 from torch import nn
@@ -237,18 +239,30 @@ class ModulatedConv2d(nn.Module):
             f"{self.__class__.__name__}({self.in_channel}, {self.out_channel}, {self.kernel_size}, "
             f"upsample={self.upsample}, downsample={self.downsample})")
 
-    def forward(self, input, style):
-        batch, in_channel, height, width = input.shape
+    def modulate(self, style):
+        batch = style.shape[0]
 
-        style = self.modulation(style).view(batch, 1, in_channel, 1, 1)
+        style = self.modulation(style).view(batch, 1, self.in_channel, 1, 1)
         weight = self.scale * self.weight * style
 
         if self.demodulate:
             demod = torch.rsqrt(weight.pow(2).sum([2, 3, 4]) + 1e-8)
             weight = weight * demod.view(batch, self.out_channel, 1, 1, 1)
 
-        weight = weight.view(batch * self.out_channel, in_channel,
-                             self.kernel_size, self.kernel_size)
+        return weight
+
+    def forward(self, input, style, weight=None):
+        """weight: modulated weight of style computed ahead by modulate,
+        shared by the whole batch if its batch size is 1."""
+        batch, in_channel, height, width = input.shape
+
+        if weight is None:
+            weight = self.modulate(style)
+        else:
+            weight = weight.expand(batch, -1, -1, -1, -1)
+
+        weight = weight.reshape(batch * self.out_channel, in_channel,
+                                self.kernel_size, self.kernel_size)
 
         if self.upsample:
             input = input.view(1, batch * in_channel, height, width)
@@ -339,8 +353,8 @@ class StyledConv(nn.Module):
         # self.activate = ScaledLeakyReLU(0.2)
         self.activate = FusedLeakyReLU(out_channel)
 
-    def forward(self, input, style, noise=None):
-        out = self.conv(input, style)
+    def forward(self, input, style, noise=None, weight=None):
+        out = self.conv(input, style, weight)
         out = self.noise(out, noise=noise)
         # out = out + self.bias
         out = self.activate(out)
@@ -364,8 +378,8 @@ class ToRGB(nn.Module):
             in_channel, 3, 1, style_dim, demodulate=False)
         self.bias = nn.Parameter(torch.zeros(1, 3, 1, 1))
 
-    def forward(self, input, style, skip=None):
-        out = self.conv(input, style)
+    def forward(self, input, style, skip=None, weight=None):
+        out = self.conv(input, style, weight)
         out = out + self.bias
 
         if skip is not None:
@@ -470,6 +484,66 @@ class Generator(nn.Module):
 
         self.n_latent = self.log_size * 2 - 2
 
+        # checkpoint whose persisted W space statistics are used, and the
+        # statistics loaded so far, keyed on the number of samples
+        self.latent_stats_ckpt = None
+        self.latent_stats = {}
+
+    def set_latent_stats_cache(self, ckpt_path):
+        """Load the W space statistics persisted next to ckpt_path, the
+        checkpoint the weights are loaded from, instead of sampling them.
+        """
+        self.latent_stats_ckpt = ckpt_path
+        self.latent_stats = {}
+
+    def get_latent_stats(self, n_latent):
+        """Mean ([style_dim]) and std (scalar) of n_latent mapped samples."""
+        if self.latent_stats_ckpt is None:
+            return compute_latent_stats(self, n_latent)
+        if n_latent not in self.latent_stats:
+            self.latent_stats[n_latent] = load_latent_stats(
+                self, self.latent_stats_ckpt, n_latent)
+        return self.latent_stats[n_latent]
+
+    def modulated_convs(self):
+        """The modulated convs in the order of forward.
+
+        Returns a list of (w plus layer, conv), the w plus layer is the one
+        the conv takes its style from. A to_rgb shares its w plus layer with
+        the first conv of the next resolution.
+        """
+        modulated_convs = [(0, self.conv1.conv), (1, self.to_rgb1.conv)]
+        layer = 1
+        for conv1, conv2, to_rgb in zip(self.convs[::2], self.convs[1::2],
+                                        self.to_rgbs):
+            modulated_convs += [(layer, conv1.conv), (layer + 1, conv2.conv),
+                                (layer + 2, to_rgb.conv)]
+            layer += 2
+        return modulated_convs
+
+    def modulated_weights(self, latent, layers):
+        """Modulated weights of the convs whose w plus layer is in layers.
+
+        E.g., the layers that are not replaced when editing with fixed
+        layers keep their style for all the edits of a latent code, the
+        weights of the convs styled by them are computed once and passed to
+        forward, which then skips the modulation of these convs.
+
+        Args:
+            latent (Tensor): w plus latent code [1, n_latent, style_dim].
+            layers (list[int]): Indices of the w plus layers.
+
+        Returns:
+            dict: {index in modulated_convs: weight
+                [1, out_channel, in_channel, k, k]}
+        """
+        with torch.no_grad():
+            return {
+                conv_idx: conv.modulate(latent[:, layer])
+                for conv_idx, (layer, conv) in enumerate(
+                    self.modulated_convs()) if layer in layers
+            }
+
     def make_noise(self):
         device = self.input.input.device
 
@@ -482,9 +556,7 @@ class Generator(nn.Module):
         return noises
 
     def mean_latent(self, n_latent):
-        latent_in = torch.randn(
-            n_latent, self.style_dim, device=self.input.input.device)
-        latent = self.style_forward(latent_in).mean(0, keepdim=True)
+        latent = self.get_latent_stats(n_latent)['mean'].unsqueeze(0)
 
         return latent
 
@@ -512,7 +584,22 @@ class Generator(nn.Module):
         input_is_latent=False,
         noise=None,
         randomize_noise=True,
+        exit_res=None,
+        modulated_weights=None,
     ):
+        """modulated_weights: {index in modulated_convs: weight} computed by
+        modulated_weights for the style that all the samples share in these
+        convs, which is not checked."""
+        if modulated_weights is None:
+            modulated_weights = {}
+
+        if exit_res is not None:
+            # the skip branch is only available at the to_rgb resolutions
+            if exit_res not in [2**i for i in range(2, self.log_size + 1)]:
+                raise ValueError(
+                    f'exit_res should be a power of two between 4 and '
+                    f'{self.size}, but got {exit_res}.')
+
         if not input_is_latent:
             styles = [self.style_forward(s) for s in styles]
 
@@ -554,19 +641,40 @@ class Generator(nn.Module):
             latent = torch.cat([latent, latent2], 1)
 
         out = self.input(latent)
-        out = self.conv1(out, latent[:, 0], noise=noise[0])
+        out = self.conv1(
+            out, latent[:, 0], noise=noise[0], weight=modulated_weights.get(0))
 
-        skip = self.to_rgb1(out, latent[:, 1])
+        skip = self.to_rgb1(out, latent[:, 1], weight=modulated_weights.get(1))
 
         i = 1
+        # index of conv1 in modulated_convs
+        conv_idx = 2
         for conv1, conv2, noise1, noise2, to_rgb in zip(
                 self.convs[::2], self.convs[1::2], noise[1::2], noise[2::2],
                 self.to_rgbs):
-            out = conv1(out, latent[:, i], noise=noise1)
-            out = conv2(out, latent[:, i + 1], noise=noise2)
-            skip = to_rgb(out, latent[:, i + 2], skip)
+            if skip.shape[-1] == exit_res:
+                # early exit, the rgb skip is a low resolution preview of
+                # the final image
+                break
+
+            out = conv1(
+                out,
+                latent[:, i],
+                noise=noise1,
+                weight=modulated_weights.get(conv_idx))
+            out = conv2(
+                out,
+                latent[:, i + 1],
+                noise=noise2,
+                weight=modulated_weights.get(conv_idx + 1))
+            skip = to_rgb(
+                out,
+                latent[:, i + 2],
+                skip,
+                weight=modulated_weights.get(conv_idx + 2))
 
             i += 2
+            conv_idx += 3
 
         image = skip
 
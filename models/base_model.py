@@ -1,3 +1,4 @@
+import copy
 import logging
 import math
 from collections import OrderedDict
@@ -8,16 +9,27 @@ import matplotlib.pyplot as plt
 import torch
 import torch.nn as nn
 
-from models.archs.attribute_predictor_arch import resnet50
+from models.archs.attribute_predictor_arch import (fold_input_normalization,
+                                                   resnet50)
 from models.archs.field_function_arch import FieldFunction
 from models.archs.stylegan2.model import Generator
 from models.losses.arcface_loss import ArcFaceLoss
 from models.losses.discriminator_loss import DiscriminatorLoss
-from models.utils import (postprocess, predictor_to_label, save_image,
-                          transform_image)
+from models.utils import (PREDICTOR_RES, TRANSFORM_IMAGE_BIAS,
+                          TRANSFORM_IMAGE_SCALE, TrajectoryCache,
+                          flush_image_writer, latent_hash, output_to_labels,
+                          postprocess, predictor_to_label, save_image)
 
 logger = logging.getLogger('base')
 
+MATERIALIZE_MODES = ['none', 'final', 'all']
+
+
+def check_materialize(materialize):
+    if materialize not in MATERIALIZE_MODES:
+        raise ValueError(f'materialize should be one of {MATERIALIZE_MODES}, '
+                         f'but got {materialize}.')
+
 
 class BaseModel():
     """Base model.
@@ -62,6 +74,8 @@ class BaseModel():
             checkpoint = torch.load(opt['generator_ckpt'])
             self.stylegan_gen.load_state_dict(checkpoint, strict=True)
             self.img_resize = True
+        # the W space statistics are persisted next to the checkpoint
+        self.stylegan_gen.set_latent_stats_cache(opt['generator_ckpt'])
 
         # define attribute predictor
         self.predictor = resnet50(attr_file=opt['attr_file'])
@@ -71,6 +85,10 @@ class BaseModel():
         checkpoint = torch.load(opt['predictor_ckpt'])
         self.predictor.load_state_dict(checkpoint['state_dict'], strict=True)
         self.predictor.eval()
+        # the predictor takes the generator output directly
+        self.predictor = fold_input_normalization(
+            self.predictor, TRANSFORM_IMAGE_SCALE, TRANSFORM_IMAGE_BIAS,
+            PREDICTOR_RES)
 
         # define field function
         self.field_function = FieldFunction(
@@ -82,6 +100,31 @@ class BaseModel():
         self.field_function = self.field_function.to(self.device)
 
         self.fix_layers = False
+        # number of editing steps synthesized and classified in one batch
+        self.speculative_steps = opt['speculative_steps'] or 1
+        # resolution at which the trials that are only classified exit the
+        # generator, the saved frames are always rendered at full resolution
+        self.trial_res = opt['trial_res']
+        if self.trial_res is not None and not (
+                PREDICTOR_RES <= self.trial_res <= opt['img_res']):
+            # the early exit image is only area downsampled to the predictor
+            # input as the full resolution image is, never upsampled
+            raise ValueError(
+                f'trial_res should be between {PREDICTOR_RES} and '
+                f'{opt["img_res"]}, but got {self.trial_res}.')
+        # the modulated weights of the w plus layers that the edits do not
+        # change are computed once per edit, see frozen_modulated_weights
+        self.cache_modulation = not self.is_train and bool(
+            opt['cache_modulation'])
+        # trajectories of the recent edits, for the follow-up edits to resume
+        # from; the field functions change during training, so not cached
+        self.trajectory_cache = None
+        if not self.is_train and opt['trajectory_cache_size']:
+            self.trajectory_cache = TrajectoryCache(
+                opt['trajectory_cache_size'])
+        # the synthesis and prediction of a session model are batched with
+        # the other sessions by the scheduler, see session_model
+        self.inference_scheduler = None
         if self.is_train:
             self.init_training_settings()
             self.log_dict = OrderedDict()
@@ -132,8 +175,7 @@ class BaseModel():
         # modify latent code via field function
         edited_dict = self.modify_latent_code(original_latent_code)
         edited_image = self.synthesize_image(edited_dict['edited_latent_code'])
-        predictor_output = self.predictor(
-            transform_image(edited_image, self.img_resize))
+        predictor_output = self.predictor(edited_image)
 
         # compute loss function
         loss_total = 0
@@ -228,26 +270,103 @@ class BaseModel():
         self.field_function.load_state_dict(checkpoint, strict=True)
         self.field_function.eval()
 
-    def synthesize_image(self, sample_latent_code):
+    def session_model(self, inference_scheduler):
+        """Model for one of the concurrent sessions of the dialog service.
+
+        The networks are shared with this model, while the active field
+        function, target attribute and trajectory cache are the session's
+        own, so that the rounds of the sessions run at the same time. The
+        synthesis and prediction go through inference_scheduler, which
+        batches them with the requests of the other sessions; the modulated
+        weights are not cached, as each edit would need its own batch.
+        """
+        model = copy.copy(self)
+        model.inference_scheduler = inference_scheduler
+        model.cache_modulation = False
+        if self.trajectory_cache is not None:
+            model.trajectory_cache = TrajectoryCache(
+                self.trajectory_cache.max_size)
+        return model
+
+    def synthesize_image(self,
+                         sample_latent_code,
+                         exit_res=None,
+                         modulated_weights=None):
         synthesized_img, _ = self.stylegan_gen(
             [sample_latent_code],
             truncation=self.truncation,
             input_is_latent=self.input_is_latent,
             truncation_latent=self.truncation_latent,
-            randomize_noise=self.randomize_noise)
+            randomize_noise=self.randomize_noise,
+            exit_res=exit_res,
+            modulated_weights=modulated_weights)
 
         return synthesized_img
 
-    def synthesize_and_predict(self, sample_latent_code):
-        synthesized_img = self.synthesize_image(sample_latent_code)
+    def frozen_modulated_weights(self, edited_latent_code):
+        """Modulated weights of the convs styled by the w plus layers from
+        replaced_layers on.
 
-        current_predictor_output = self.predictor(
-            transform_image(synthesized_img, self.img_resize))
+        With fixed layers, the edits only change the first replaced_layers
+        layers, the others keep the style of edited_latent_code for all the
+        trials of an edit. The weights of the convs they style are computed
+        once here and passed to the synthesis of the trials. The caller
+        keeps them for the edit of edited_latent_code only, so that nothing
+        is shared between edits or sessions.
+
+        Returns None if cache_modulation is off or layers are not fixed.
+        """
+        if not self.cache_modulation or not self.fix_layers or \
+                edited_latent_code is None:
+            return None
+        return self.stylegan_gen.modulated_weights(
+            edited_latent_code[:1],
+            range(self.opt['replaced_layers'], self.stylegan_gen.n_latent))
+
+    def predict_image(self, synthesized_img):
+        # images larger than PREDICTOR_RES, early exit ones included, are
+        # area downsampled inside the predictor
+        return self.predictor(synthesized_img)
+
+    def synthesize_and_predict(self,
+                               sample_latent_code,
+                               exit_res=None,
+                               modulated_weights=None):
+        if self.inference_scheduler is not None:
+            synthesized_img, predicted_labels, predicted_scores = \
+                self.inference_scheduler.submit(
+                    sample_latent_code,
+                    sample_latent_code.dim() == 3, exit_res)
+            return synthesized_img, predicted_labels[0], predicted_scores[0]
+
+        synthesized_img = self.synthesize_image(sample_latent_code, exit_res,
+                                                modulated_weights)
+
+        current_predictor_output = self.predict_image(synthesized_img)
         predicted_label, predicted_score = predictor_to_label(
             current_predictor_output)
 
         return synthesized_img, predicted_label, predicted_score
 
+    def synthesize_and_predict_batch(self,
+                                     sample_latent_codes,
+                                     exit_res=None,
+                                     modulated_weights=None):
+        if self.inference_scheduler is not None:
+            return self.inference_scheduler.submit(
+                sample_latent_codes,
+                sample_latent_codes.dim() == 3, exit_res)
+
+        synthesized_img = self.synthesize_image(sample_latent_codes, exit_res,
+                                                modulated_weights)
+
+        current_predictor_output = self.predict_image(synthesized_img)
+        predicted_labels, predicted_scores = output_to_labels(
+            current_predictor_output)
+
+        return synthesized_img, predicted_labels.tolist(
+        ), predicted_scores.tolist()
+
     def inference(self, batch_idx, epoch, save_dir):
         self.field_function.eval()
 
@@ -283,7 +402,341 @@ class BaseModel():
 
         self.field_function.train()
 
-    def continuous_editing(self, latent_codes, save_dir, editing_logger):
+    def integrate_field(self, sample_latent_code, edited_latent_code, alpha):
+        """Move one step along the field.
+
+        Returns the next input to the field function, the next w plus
+        latent code (None when layers are not fixed) and the latent code to
+        be synthesized.
+        """
+        with torch.no_grad():
+            if self.fix_layers:
+                # for fix layers, the input to the field_function is w
+                # space, but the input to the stylegan is w plus space
+                edited_dict = self.modify_latent_code_bidirection(
+                    sample_latent_code, edited_latent_code, alpha)
+                sample_latent_code = sample_latent_code + alpha * edited_dict[
+                    'field']
+                edited_latent_code = edited_dict['edited_latent_code']
+            else:
+                # for other modes, the input to the field function and
+                # stylegan are same (both w space or z space)
+                edited_dict = self.modify_latent_code_bidirection(
+                    latent_code_w=sample_latent_code, alpha=1)
+                sample_latent_code = edited_dict['edited_latent_code']
+
+        return (sample_latent_code, edited_latent_code,
+                edited_dict['edited_latent_code'])
+
+    def render_trial(self,
+                     image,
+                     synthesis_latent_code,
+                     modulated_weights=None):
+        """Render a trial image to be saved at full resolution.
+
+        Trials are classified at trial_res, only the frames that are saved
+        pay for the full resolution synthesis. Trials reused from the
+        trajectory cache have no image and are synthesized here.
+        """
+        if image is not None and (self.trial_res is None or
+                                  self.trial_res == self.opt['img_res']):
+            return image
+        with torch.no_grad():
+            return self.synthesize_image(
+                synthesis_latent_code, modulated_weights=modulated_weights)
+
+    def new_trajectory(self,
+                       sample_latent_code,
+                       edited_latent_code,
+                       synthesis_latent_code=None,
+                       label=None,
+                       score=None):
+        """Start a trajectory at the latent codes.
+
+        A trajectory is the list of the steps along the field, each a dict
+        of the field input, w plus latent code, synthesis latent code and,
+        once evaluated, the predicted label and score.
+        """
+        return [{
+            'latent_code': sample_latent_code,
+            'edited_latent_code': edited_latent_code,
+            'synthesis_latent_code': synthesis_latent_code,
+            'label': label,
+            'score': score
+        }]
+
+    def trajectory_key(self, sample_latent_code, edited_latent_code, alpha):
+        return (latent_hash(sample_latent_code, edited_latent_code),
+                self.target_attr_idx, alpha)
+
+    def lookup_trajectory(self, sample_latent_code, edited_latent_code,
+                          alpha):
+        """Find the cached trajectory passing through the latent codes in the
+        direction of alpha.
+
+        Returns (trajectory, step of the latent codes on it), or None if the
+        cache is disabled or misses.
+        """
+        if self.trajectory_cache is None:
+            return None
+        return self.trajectory_cache.get(
+            self.trajectory_key(sample_latent_code, edited_latent_code, alpha))
+
+    def remember_trajectory(self, trajectory, step, alpha):
+        """Cache the trajectory for edits starting at its step."""
+        if self.trajectory_cache is None:
+            return
+        self.trajectory_cache.put(
+            self.trajectory_key(trajectory[step]['latent_code'],
+                                trajectory[step]['edited_latent_code'],
+                                alpha), trajectory, step)
+
+    def evaluate_trajectory(self,
+                            trajectory,
+                            steps,
+                            alpha,
+                            keep_images=True,
+                            modulated_weights=None):
+        """Synthesize and classify the steps of the trajectory in one batch.
+
+        The field is integrated up to the last step if needed. Steps that
+        are already classified, e.g., by an earlier edit from the cache,
+        keep their labels and are not synthesized again. modulated_weights
+        are the frozen_modulated_weights of the trajectory, if any.
+
+        Returns the images of the steps at trial_res, which are None for
+        the steps classified before and if not keep_images.
+        """
+        while len(trajectory) <= max(steps):
+            sample_latent_code, edited_latent_code, synthesis_latent_code = \
+                self.integrate_field(trajectory[-1]['latent_code'],
+                                     trajectory[-1]['edited_latent_code'],
+                                     alpha)
+            trajectory.extend(
+                self.new_trajectory(sample_latent_code, edited_latent_code,
+                                    synthesis_latent_code))
+
+        new_steps = [step for step in steps if trajectory[step]['label'] is None]
+        images = {}
+        if len(new_steps) > 0:
+            with torch.no_grad():
+                edited_images, edited_labels, edited_scores = \
+                    self.synthesize_and_predict_batch(
+                        torch.cat([
+                            trajectory[step]['synthesis_latent_code']
+                            for step in new_steps
+                        ]), self.trial_res, modulated_weights)
+            for idx, step in enumerate(new_steps):
+                trajectory[step]['label'] = edited_labels[idx]
+                trajectory[step]['score'] = edited_scores[idx]
+                if keep_images:
+                    # clone so that a kept candidate does not hold the
+                    # whole batch
+                    images[step] = edited_images[idx:idx + 1].clone()
+
+        return [images.get(step) for step in steps]
+
+    def speculate_trajectory(self,
+                             trajectory,
+                             step,
+                             alpha,
+                             num_steps,
+                             keep_images=True,
+                             modulated_weights=None):
+        """Evaluate the num_steps steps of the trajectory after step with one
+        batched synthesis and prediction.
+
+        Returns a list of (field input, w plus latent code, image, label,
+        score, synthesis latent code) for the consecutive steps. The images
+        are at trial_res, use render_trial for the frames to be saved. The
+        images are None for the cached steps and if not keep_images.
+        """
+        steps = list(range(step + 1, step + num_steps + 1))
+        edited_images = self.evaluate_trajectory(trajectory, steps, alpha,
+                                                 keep_images,
+                                                 modulated_weights)
+
+        return [(trajectory[step]['latent_code'],
+                 trajectory[step]['edited_latent_code'], edited_image,
+                 trajectory[step]['label'], trajectory[step]['score'],
+                 trajectory[step]['synthesis_latent_code'])
+                for step, edited_image in zip(steps, edited_images)]
+
+    def speculate_trials(self,
+                         sample_latent_code,
+                         edited_latent_code,
+                         alpha,
+                         num_steps,
+                         keep_images=True,
+                         modulated_weights=None):
+        """Integrate the field num_steps ahead of the latent codes and
+        evaluate all the candidates with one batched synthesis and
+        prediction, see speculate_trajectory.
+        """
+        return self.speculate_trajectory(
+            self.new_trajectory(sample_latent_code, edited_latent_code), 0,
+            alpha, num_steps, keep_images, modulated_weights)
+
+    def binary_search_edit(self,
+                           trajectory,
+                           start_step,
+                           alpha,
+                           direction,
+                           target_cls,
+                           start_label,
+                           render=True,
+                           modulated_weights=None):
+        """Find the number of edit steps by exponential probing and bisection.
+
+        The field is integrated step by step as in the linear scan, but only
+        the probed steps are synthesized and classified. The gaps between
+        probed steps whose labels differ by more than one class are bisected
+        too, so that every class on the way to the target is seen and the
+        number of stages matches the linear scan. When the target class is
+        reached, the steps of the target stage are scanned to pick the most
+        confident one, as the linear scan does. Only the chosen step is
+        returned, the best steps of the intermediate stages are not.
+
+        The search starts at start_step of the trajectory and reuses the
+        steps classified before. The image of the chosen step is rendered at
+        full resolution if render, otherwise it is None.
+
+        The label is assumed not to go back and forth between two probed
+        steps of the same class.
+
+        Returns a dict of the chosen step, whose 'step' counts from
+        start_step, or None if the trajectory does not allow the search to
+        reproduce the linear scan, in which case the caller falls back to
+        the linear scan: the target is not reached within max_trials_num
+        steps, a probed label moves against the direction, or a class is
+        skipped between two consecutive steps.
+        """
+        max_steps = self.opt['max_trials_num'] + 1
+        start_target_label = int(start_label[self.target_attr_idx])
+        # target attribute label of the probed steps
+        probed_labels = {0: start_target_label}
+
+        def monotone(steps):
+            labels = [probed_labels[step] for step in steps]
+            if direction == 'negative':
+                labels = [-label for label in labels]
+            return all(prev <= cur for prev, cur in zip(labels, labels[1:]))
+
+        def probe(step):
+            image, = self.evaluate_trajectory(
+                trajectory, [start_step + step],
+                alpha,
+                modulated_weights=modulated_weights)
+            probed_labels[step] = int(
+                trajectory[start_step + step]['label'][self.target_attr_idx])
+            return {
+                'step': step,
+                'image': image,
+                'label': trajectory[start_step + step]['label'],
+                'score': trajectory[start_step + step]['score']
+            }
+
+        def reached(label):
+            if direction == 'positive':
+                return label[self.target_attr_idx] >= target_cls
+            else:
+                return label[self.target_attr_idx] <= target_cls
+
+        # exponential probing
+        lo, lo_label = 0, start_target_label
+        hi_result = None
+        step = 1
+        while True:
+            result = probe(step)
+            if reached(result['label']):
+                hi_result = result
+                break
+            lo, lo_label = step, int(result['label'][self.target_attr_idx])
+            if step == max_steps:
+                break
+            step = min(step * 2, max_steps)
+        if hi_result is None:
+            return None
+
+        # bisection
+        while hi_result['step'] - lo > 1:
+            result = probe((lo + hi_result['step']) // 2)
+            if reached(result['label']):
+                hi_result = result
+            else:
+                lo, lo_label = result['step'], int(
+                    result['label'][self.target_attr_idx])
+
+        best_result = hi_result
+        if int(hi_result['label'][self.target_attr_idx]) != target_cls:
+            # the target class is skipped, the linear scan only keeps this
+            # step if no other class appears before it
+            if lo_label != start_target_label or not monotone(
+                    sorted(probed_labels)):
+                return None
+            num_edits = 1
+        else:
+            # bisect the gaps spanning more than one class, the linear scan
+            # has a stage for every class on the way
+            steps = sorted(probed_labels)
+            idx = 0
+            while idx < len(steps) - 1:
+                if abs(probed_labels[steps[idx + 1]] -
+                       probed_labels[steps[idx]]) <= 1:
+                    idx += 1
+                elif steps[idx + 1] - steps[idx] == 1:
+                    # an intermediate class is skipped
+                    return None
+                else:
+                    mid = (steps[idx] + steps[idx + 1]) // 2
+                    probe(mid)
+                    steps.insert(idx + 1, mid)
+            if not monotone(steps):
+                return None
+            num_edits = abs(target_cls - start_target_label)
+            boundary_cls = self.opt['max_cls_num'] if direction == 'positive' \
+                else self.opt['min_cls_num']
+            if target_cls != boundary_cls:
+                # pick the most confident step of the target stage
+                for step in range(hi_result['step'] + 1,
+                                  hi_result['step'] + max_steps + 1):
+                    result = probe(step)
+                    if int(result['label']
+                           [self.target_attr_idx]) != target_cls:
+                        if not reached(result['label']):
+                            # the label goes back, the linear scan
+                            # counts another stage
+                            return None
+                        break
+                    if result['score'][self.target_attr_idx] > best_result[
+                            'score'][self.target_attr_idx]:
+                        best_result = result
+
+        best_step = trajectory[start_step + best_result['step']]
+        if render:
+            best_result['image'] = self.render_trial(
+                best_result['image'], best_step['synthesis_latent_code'],
+                modulated_weights)
+        else:
+            best_result['image'] = None
+        best_result['latent_code'] = best_step['latent_code']
+        best_result['edited_latent_code'] = best_step['edited_latent_code']
+        best_result['num_edits'] = num_edits
+        return best_result
+
+    def continuous_editing(self,
+                           latent_codes,
+                           save_dir,
+                           editing_logger,
+                           materialize='all'):
+        """Edit each latent code stage by stage up to max_cls_num.
+
+        materialize: which images are written, 'all' for the original image
+            and the best image of each stage, 'final' for the best image of
+            the last stage and 'none' for labels only.
+        """
+        check_materialize(materialize)
+        keep_images = materialize != 'none'
         total_num = latent_codes.shape[0]
 
         for sample_id in range(total_num):
@@ -306,7 +759,8 @@ class BaseModel():
             target_score = start_score[self.target_attr_idx]
 
             save_name = f'{sample_id:03d}_num_edits_0_class_{target_attr_label}.png'  # noqa
-            save_image(original_image, f'{save_dir}/{save_name}')
+            if materialize == 'all':
+                save_image(original_image, f'{save_dir}/{save_name}')
 
             editing_logger.info(f'{save_name}: {start_label}, {start_score}')
             # skip images with low confidence
@@ -325,38 +779,32 @@ class BaseModel():
             num_trials = 0
             num_edits = 0
 
-            current_stage_scores_list = []
-            current_stage_labels_list = []
-            current_stage_images_list = []
-            current_stage_target_scores_list = []
+            # the most confident candidate of the current stage
+            stage_best = None
 
             previous_target_attr_label = target_attr_label
 
             if self.fix_layers:
                 edited_latent_code = sample_latent_code.unsqueeze(1).repeat(
                     1, self.w_space_channel_num, 1)
+            else:
+                edited_latent_code = None
+            modulated_weights = self.frozen_modulated_weights(
+                edited_latent_code)
+
+            # candidates evaluated ahead of the sequential logic
+            speculated_trials = []
 
             while target_attr_label < self.opt['max_cls_num']:
                 num_trials += 1
-                with torch.no_grad():
-                    # modify sampled latent code
-                    if self.fix_layers:
-                        # for fix layers, the input to the field_function is w
-                        # space, but the input to the stylegan is w plus space
-                        edited_dict = self.modify_latent_code(
-                            sample_latent_code, edited_latent_code)
-                        sample_latent_code = sample_latent_code + edited_dict[
-                            'field']
-                        edited_latent_code = edited_dict['edited_latent_code']
-                    else:
-                        # for other modes, the input to the field function and
-                        # stylegan are same (both w space or z space)
-                        edited_dict = self.modify_latent_code(
-                            sample_latent_code)
-                        sample_latent_code = edited_dict['edited_latent_code']
-
-                    edited_image, edited_label, edited_score = \
-                        self.synthesize_and_predict(edited_dict['edited_latent_code'])  # noqa
+                if len(speculated_trials) == 0:
+                    speculated_trials = self.speculate_trials(
+                        sample_latent_code, edited_latent_code, 1,
+                        self.speculative_steps, keep_images,
+                        modulated_weights)
+                sample_latent_code, edited_latent_code, edited_image, \
+                    edited_label, edited_score, synthesis_latent_code = \
+                    speculated_trials.pop(0)
 
                 target_attr_label = edited_label[self.target_attr_idx]
                 target_attr_score = edited_score[self.target_attr_idx]
@@ -364,42 +812,41 @@ class BaseModel():
                     num_edits += 1
 
                 if num_edits > 0:
-                    if target_attr_label == previous_target_attr_label:
-                        current_stage_images_list.append(edited_image)
-                        current_stage_labels_list.append(edited_label)
-                        current_stage_scores_list.append(edited_score)
-                        current_stage_target_scores_list.append(
-                            target_attr_score)
-                    else:
+                    if target_attr_label != previous_target_attr_label:
                         if num_edits > 1:
                             # save images for previous stage
-                            max_value = max(current_stage_target_scores_list)
-                            max_index = current_stage_target_scores_list.index(
-                                max_value)
-                            saved_image = current_stage_images_list[max_index]
-                            saved_label = current_stage_labels_list[max_index]
-                            saved_score = current_stage_scores_list[max_index]
                             save_name = f'{sample_id:03d}_num_edits_{num_edits - 1}_class_{previous_target_attr_label}.png'  # noqa
-                            save_image(saved_image, f'{save_dir}/{save_name}')
+                            if materialize == 'all':
+                                save_image(
+                                    self.render_trial(
+                                        stage_best['image'],
+                                        stage_best['synthesis_latent_code'],
+                                        modulated_weights),
+                                    f'{save_dir}/{save_name}')
                             editing_logger.info(
-                                f'{save_name}: {saved_label}, {saved_score}')
+                                f'{save_name}: {stage_best["label"]}, '
+                                f'{stage_best["score"]}')
 
-                        current_stage_images_list = []
-                        current_stage_labels_list = []
-                        current_stage_scores_list = []
-                        current_stage_target_scores_list = []
+                        stage_best = None
                         num_trials = 0
 
-                        current_stage_images_list.append(edited_image)
-                        current_stage_labels_list.append(edited_label)
-                        current_stage_scores_list.append(edited_score)
-                        current_stage_target_scores_list.append(
-                            target_attr_score)
+                    if stage_best is None or \
+                            target_attr_score > stage_best['target_score']:
+                        stage_best = {
+                            'image': edited_image,
+                            'label': edited_label,
+                            'score': edited_score,
+                            'target_score': target_attr_score,
+                            'synthesis_latent_code': synthesis_latent_code
+                        }
 
                 previous_target_attr_label = target_attr_label
-                if self.opt['print_every']:
+                if self.opt['print_every'] and keep_images:
                     save_name = f'{sample_id:03d}_num_edits_{num_edits}_num_trials_{num_trials}_class_{target_attr_label}.png'  # noqa\
-                    saved_image(edited_image, f'{save_dir}/{save_name}')
+                    saved_image(
+                        self.render_trial(edited_image, synthesis_latent_code,
+                                          modulated_weights),
+                        f'{save_dir}/{save_name}')
                     editing_logger.info(
                         f'{save_name}: {edited_label}, {edited_score}')
 
@@ -409,18 +856,205 @@ class BaseModel():
 
             if num_edits > 0:
                 # save images for previous stage
-                max_value = max(current_stage_target_scores_list)
-                max_index = current_stage_target_scores_list.index(max_value)
-                saved_image = current_stage_images_list[max_index]
-                saved_label = current_stage_labels_list[max_index]
-                saved_score = current_stage_scores_list[max_index]
                 save_name = f'{sample_id:03d}_num_edits_{num_edits}_class_{previous_target_attr_label}.png'  # noqa
-                save_image(saved_image, f'{save_dir}/{save_name}')
+                if keep_images:
+                    save_image(
+                        self.render_trial(stage_best['image'],
+                                          stage_best['synthesis_latent_code'],
+                                          modulated_weights),
+                        f'{save_dir}/{save_name}')
                 editing_logger.info(
-                    f'{save_name}: {saved_label}, {saved_score}')
+                    f'{save_name}: {stage_best["label"]}, '
+                    f'{stage_best["score"]}')
 
             editing_logger.info(f'{sample_id:03d}: Finish editing.')
 
+    def continuous_editing_batch(self,
+                                 latent_codes,
+                                 save_dir,
+                                 editing_logger,
+                                 materialize='all'):
+        """Batched version of continuous_editing.
+
+        The field trajectories of editing_batch_size samples advance
+        together, each step synthesizes and classifies the samples that are
+        still being edited with one batched call. Every sample keeps its own
+        stopping criteria and best candidate of the current stage, so the
+        saved images and the log are the same as continuous_editing.
+        """
+        check_materialize(materialize)
+        keep_images = materialize != 'none'
+        total_num = latent_codes.shape[0]
+        batch_size = self.opt['editing_batch_size'] or 8
+
+        for batch_start in range(0, total_num, batch_size):
+            sample_ids = list(
+                range(batch_start, min(batch_start + batch_size, total_num)))
+            sample_latent_codes = torch.from_numpy(
+                latent_codes[sample_ids[0]:sample_ids[-1] + 1]).to(
+                    torch.device('cuda'))
+
+            if self.latent_code_is_w_space and self.transform_z_to_w:
+                # translate original z space latent code to w space
+                with torch.no_grad():
+                    sample_latent_codes = self.stylegan_gen.get_latent(
+                        sample_latent_codes)
+
+            # synthesize, the start labels are predicted at full resolution
+            # as in continuous_editing
+            with torch.no_grad():
+                original_images, start_labels, start_scores = \
+                    self.synthesize_and_predict_batch(sample_latent_codes)
+
+            if self.fix_layers:
+                edited_latent_codes = sample_latent_codes.unsqueeze(1).repeat(
+                    1, self.w_space_channel_num, 1)
+            else:
+                edited_latent_codes = None
+
+            # log lines of each sample, written in the order of
+            # continuous_editing when the batch is done
+            sample_logs = [[] for _ in sample_ids]
+            # editing state of the samples that are still being edited
+            sample_states = {}
+            for idx, sample_id in enumerate(sample_ids):
+                target_attr_label = int(start_labels[idx][self.target_attr_idx])
+                target_score = start_scores[idx][self.target_attr_idx]
+
+                save_name = f'{sample_id:03d}_num_edits_0_class_{target_attr_label}.png'  # noqa
+                if materialize == 'all':
+                    save_image(original_images[idx:idx + 1],
+                               f'{save_dir}/{save_name}')
+
+                sample_logs[idx].append(
+                    f'{save_name}: {start_labels[idx]}, {start_scores[idx]}')
+                # skip images with low confidence
+                if target_score < self.opt['confidence_thresh']:
+                    sample_logs[idx].append(
+                        f'Sample {sample_id:03d} is not confident, skip.')
+                    continue
+
+                # skip images that are already the max_cls_num
+                if target_attr_label == self.opt['max_cls_num']:
+                    sample_logs[idx].append(
+                        f'Sample {sample_id:03d} is already the max_cls_num, '
+                        'skip.')
+                    continue
+
+                sample_states[idx] = {
+                    'num_trials': 0,
+                    'num_edits': 0,
+                    # the most confident candidate of the current stage
+                    'stage_best': None,
+                    'previous_target_attr_label': target_attr_label
+                }
+            del original_images
+
+            while len(sample_states) > 0:
+                active_ids = sorted(sample_states.keys())
+                active_idx = torch.tensor(
+                    active_ids, device=sample_latent_codes.device)
+
+                # one step along the field for all the active samples
+                next_latent_codes, next_edited_latent_codes, \
+                    synthesis_latent_codes = self.integrate_field(
+                        sample_latent_codes[active_idx],
+                        None if edited_latent_codes is None else
+                        edited_latent_codes[active_idx], 1)
+                sample_latent_codes[active_idx] = next_latent_codes
+                if edited_latent_codes is not None:
+                    edited_latent_codes[active_idx] = next_edited_latent_codes
+
+                with torch.no_grad():
+                    edited_images, edited_labels, edited_scores = \
+                        self.synthesize_and_predict_batch(
+                            synthesis_latent_codes, self.trial_res)
+
+                for batch_idx, idx in enumerate(active_ids):
+                    sample_id = sample_ids[idx]
+                    state = sample_states[idx]
+                    log = sample_logs[idx]
+                    state['num_trials'] += 1
+
+                    edited_label = edited_labels[batch_idx]
+                    edited_score = edited_scores[batch_idx]
+                    target_attr_label = edited_label[self.target_attr_idx]
+                    target_attr_score = edited_score[self.target_attr_idx]
+                    previous_target_attr_label = state[
+                        'previous_target_attr_label']
+                    if target_attr_label != previous_target_attr_label:
+                        state['num_edits'] += 1
+
+                    if state['num_edits'] > 0:
+                        if target_attr_label != previous_target_attr_label:
+                            stage_best = state['stage_best']
+                            if state['num_edits'] > 1:
+                                # save images for previous stage
+                                save_name = f'{sample_id:03d}_num_edits_{state["num_edits"] - 1}_class_{previous_target_attr_label}.png'  # noqa
+                                if materialize == 'all':
+                                    save_image(
+                                        self.render_trial(
+                                            stage_best['image'],
+                                            stage_best[
+                                                'synthesis_latent_code']),
+                                        f'{save_dir}/{save_name}')
+                                log.append(f'{save_name}: '
+                                           f'{stage_best["label"]}, '
+                                           f'{stage_best["score"]}')
+
+                            state['stage_best'] = None
+                            state['num_trials'] = 0
+
+                        if state['stage_best'] is None or target_attr_score > \
+                                state['stage_best']['target_score']:
+                            state['stage_best'] = {
+                                'image':
+                                edited_images[batch_idx:batch_idx + 1].clone()
+                                if keep_images else None,
+                                'label': edited_label,
+                                'score': edited_score,
+                                'target_score': target_attr_score,
+                                'synthesis_latent_code':
+                                synthesis_latent_codes[batch_idx:batch_idx + 1]
+                            }
+
+                    state['previous_target_attr_label'] = target_attr_label
+                    if self.opt['print_every'] and keep_images:
+                        save_name = f'{sample_id:03d}_num_edits_{state["num_edits"]}_num_trials_{state["num_trials"]}_class_{target_attr_label}.png'  # noqa
+                        save_image(
+                            self.render_trial(
+                                edited_images[batch_idx:batch_idx + 1],
+                                synthesis_latent_codes[batch_idx:batch_idx +
+                                                       1]),
+                            f'{save_dir}/{save_name}')
+                        log.append(
+                            f'{save_name}: {edited_label}, {edited_score}')
+
+                    if state['num_trials'] > self.opt['max_trials_num']:
+                        log.append('Maximum edits num reached.')
+                    elif target_attr_label < self.opt['max_cls_num']:
+                        continue
+
+                    # the editing of this sample is finished
+                    if state['num_edits'] > 0:
+                        # save images for previous stage
+                        stage_best = state['stage_best']
+                        save_name = f'{sample_id:03d}_num_edits_{state["num_edits"]}_class_{target_attr_label}.png'  # noqa
+                        if keep_images:
+                            save_image(
+                                self.render_trial(
+                                    stage_best['image'],
+                                    stage_best['synthesis_latent_code']),
+                                f'{save_dir}/{save_name}')
+                        log.append(f'{save_name}: {stage_best["label"]}, '
+                                   f'{stage_best["score"]}')
+                    log.append(f'{sample_id:03d}: Finish editing.')
+                    del sample_states[idx]
+
+            for log in sample_logs:
+                for line in log:
+                    editing_logger.info(line)
+
     def continuous_editing_with_target(self,
                                        latent_codes,
                                        target_cls,
@@ -429,7 +1063,26 @@ class BaseModel():
                                        edited_latent_code,
                                        prefix,
                                        print_intermediate_result=False,
-                                       display_img=False):
+                                       display_img=False,
+                                       materialize=None,
+                                       image_paths=None):
+        """Edit each latent code stage by stage up to target_cls.
+
+        materialize: which images are written, 'all' for the best image of
+            each stage, 'final' for the best image of the last stage and
+            'none' for latent codes and labels only. Defaults to 'all' if
+            print_intermediate_result, 'final' otherwise.
+        image_paths: list the paths of the written images are appended to.
+        """
+        if materialize is None:
+            materialize = 'all' if print_intermediate_result else 'final'
+        check_materialize(materialize)
+
+        def save(image, save_path):
+            save_image(image, save_path)
+            if image_paths is not None:
+                image_paths.append(save_path)
+        keep_images = materialize != 'none'
         total_num = latent_codes.shape[0]
 
         for sample_id in range(total_num):
@@ -439,7 +1092,8 @@ class BaseModel():
 
             exception_mode = 'normal'
 
-            # synthesize
+            # synthesize, the start label is predicted at full resolution as
+            # in continuous_editing, only the trials are at trial_res
             if edited_latent_code is None:
                 if self.latent_code_is_w_space and self.transform_z_to_w:
                     # translate original z space latent code to w space
@@ -489,18 +1143,60 @@ class BaseModel():
             num_trials = 0
             num_edits = 0
 
-            current_stage_scores_list = []
-            current_stage_labels_list = []
-            current_stage_images_list = []
-            current_stage_target_scores_list = []
-            current_stage_latent_code_list = []
-            current_stage_editing_latent_code_list = []
+            # the most confident candidate of the current stage
+            stage_best = None
 
             previous_target_attr_label = target_attr_label
 
             if self.fix_layers:
                 if edited_latent_code is None:
                     edited_latent_code = sample_latent_code.unsqueeze(1).repeat(1, self.w_space_channel_num, 1)
+            modulated_weights = self.frozen_modulated_weights(edited_latent_code)
+
+            # a follow-up edit of the same attribute in the same direction
+            # resumes from the frontier of the cached trajectory
+            cached_trajectory = self.lookup_trajectory(sample_latent_code, edited_latent_code, alpha)
+            if cached_trajectory is None:
+                trajectory = self.new_trajectory(sample_latent_code, edited_latent_code, label=start_label, score=start_score)
+                step = 0
+                self.remember_trajectory(trajectory, step, alpha)
+            else:
+                trajectory, step = cached_trajectory
+
+            # the binary search only yields the final stage, the frames of
+            # the intermediate stages need the linear scan
+            if self.opt['edit_search'] == 'binary' and \
+                    materialize != 'all' and not print_intermediate_result:
+                search_result = self.binary_search_edit(
+                    trajectory,
+                    step,
+                    alpha,
+                    direction,
+                    target_cls,
+                    start_label,
+                    render=keep_images,
+                    modulated_weights=modulated_weights)
+                if search_result is not None:
+                    self.remember_trajectory(trajectory, step + search_result['step'], alpha)
+                    saved_label = search_result['label']
+                    saved_score = search_result['score']
+                    saved_latent_code = search_result['latent_code']
+                    saved_editing_latent_code = search_result['edited_latent_code']
+                    save_name = f'{prefix}_{sample_id:03d}_num_edits_{search_result["num_edits"]}_class_{saved_label[self.target_attr_idx]}_attr_idx_{self.target_attr_idx}.png'  # noqa
+                    if keep_images:
+                        save(search_result['image'], f'{save_dir}/{save_name}')
+                    if display_img and keep_images:
+                        flush_image_writer()
+                        plt.figure()
+                        plt.imshow(mpimg.imread(f'{save_dir}/{save_name}'))
+                        plt.axis('off')
+                        plt.show()
+                    if editing_logger:
+                        editing_logger.info(f'{save_name}: {saved_label}, {saved_score}')
+                    continue
+
+            # candidates evaluated ahead of the sequential logic
+            speculated_trials = []
 
             while ((direction == 'positive') and
                    (target_attr_label <= target_cls) and
@@ -509,22 +1205,15 @@ class BaseModel():
                     (target_attr_label >= target_cls) and
                     (target_attr_label > self.opt['min_cls_num'])):
                 num_trials += 1
-                with torch.no_grad():
-                    # modify sampled latent code
-                    if self.fix_layers:
-                        # for fix layers, the input to the field_function is w
-                        # space, but the input to the stylegan is w plus space
-                        edited_dict = self.modify_latent_code_bidirection(sample_latent_code, edited_latent_code, alpha)
-                        sample_latent_code = sample_latent_code + alpha * edited_dict['field']
-                        edited_latent_code = edited_dict['edited_latent_code']
-                    else:
-                        # for other modes, the input to the field function and
-                        # stylegan are same (both w space or z space)
-                        edited_dict = self.modify_latent_code_bidirection(latent_code_w=sample_latent_code, alpha=1)
-                        sample_latent_code = edited_dict['edited_latent_code']
-
-                    edited_image, edited_label, edited_score = \
-                        self.synthesize_and_predict(edited_dict['edited_latent_code'])  # noqa
+                # modify sampled latent code
+                if len(speculated_trials) == 0:
+                    speculated_trials = self.speculate_trajectory(
+                        trajectory, step, alpha, self.speculative_steps,
+                        keep_images, modulated_weights)
+                sample_latent_code, edited_latent_code, edited_image, \
+                    edited_label, edited_score, synthesis_latent_code = \
+                    speculated_trials.pop(0)
+                step += 1
 
                 target_attr_label = edited_label[self.target_attr_idx]
                 target_attr_score = edited_score[self.target_attr_idx]
@@ -538,10 +1227,13 @@ class BaseModel():
                         saved_latent_code = sample_latent_code
                         saved_editing_latent_code = edited_latent_code
                         save_name = f'{prefix}_{sample_id:03d}_num_edits_{num_edits + 1}_class_{target_attr_label}_attr_idx_{self.target_attr_idx}.png'  # noqa
-                        saved_image = edited_image
                         saved_score = edited_score
-                        save_image(saved_image, f'{save_dir}/{save_name}')
-                        if display_img:
+                        self.remember_trajectory(trajectory, step, alpha)
+                        if keep_images:
+                            saved_image = self.render_trial(edited_image, synthesis_latent_code, modulated_weights)
+                            save(saved_image, f'{save_dir}/{save_name}')
+                        if display_img and keep_images:
+                            flush_image_writer()
                             plt.figure()
                             plt.imshow(mpimg.imread(f'{save_dir}/{save_name}'))
                             plt.axis('off')
@@ -556,43 +1248,34 @@ class BaseModel():
                     num_edits += 1
 
                 if num_edits > 0:
-                    if target_attr_label == previous_target_attr_label:
-                        current_stage_images_list.append(edited_image)
-                        current_stage_labels_list.append(edited_label)
-                        current_stage_scores_list.append(edited_score)
-                        current_stage_target_scores_list.append(target_attr_score)
-                        current_stage_latent_code_list.append(sample_latent_code)
-                        current_stage_editing_latent_code_list.append(edited_latent_code)
-                    else:
+                    if target_attr_label != previous_target_attr_label:
                         if num_edits > 1:
                             # save images for previous stage
-                            max_value = max(current_stage_target_scores_list)
-                            max_index = current_stage_target_scores_list.index(max_value)
-                            saved_image = current_stage_images_list[max_index]
-                            saved_label = current_stage_labels_list[max_index]
-                            saved_score = current_stage_scores_list[max_index]
-                            saved_latent_code = current_stage_latent_code_list[max_index]
-                            saved_editing_latent_code = current_stage_editing_latent_code_list[max_index]
+                            saved_label = stage_best['label']
+                            saved_score = stage_best['score']
+                            saved_latent_code = stage_best['latent_code']
+                            saved_editing_latent_code = stage_best['edited_latent_code']
                             save_name = f'{prefix}_{sample_id:03d}_num_edits_{num_edits - 1}_class_{previous_target_attr_label}_attr_idx_{self.target_attr_idx}.png'  # noqa
-                            if print_intermediate_result:
-                                save_image(saved_image, f'{save_dir}/{save_name}')
+                            if materialize == 'all':
+                                saved_image = self.render_trial(stage_best['image'], stage_best['synthesis_latent_code'], modulated_weights)
+                                save(saved_image, f'{save_dir}/{save_name}')
                             if editing_logger:
                                 editing_logger.info(f'{save_name}: {saved_label}, {saved_score}')
 
-                        current_stage_images_list = []
-                        current_stage_labels_list = []
-                        current_stage_scores_list = []
-                        current_stage_target_scores_list = []
-                        current_stage_latent_code_list = []
-                        current_stage_editing_latent_code_list = []
+                        stage_best = None
                         num_trials = 0
 
-                        current_stage_images_list.append(edited_image)
-                        current_stage_labels_list.append(edited_label)
-                        current_stage_scores_list.append(edited_score)
-                        current_stage_target_scores_list.append(target_attr_score)
-                        current_stage_latent_code_list.append(sample_latent_code)
-                        current_stage_editing_latent_code_list.append(edited_latent_code)
+                    if stage_best is None or target_attr_score > stage_best['target_score']:
+                        stage_best = {
+                            'image': edited_image,
+                            'label': edited_label,
+                            'score': edited_score,
+                            'target_score': target_attr_score,
+                            'latent_code': sample_latent_code,
+                            'edited_latent_code': edited_latent_code,
+                            'synthesis_latent_code': synthesis_latent_code,
+                            'step': step
+                        }
 
                 previous_target_attr_label = target_attr_label
 
@@ -612,16 +1295,17 @@ class BaseModel():
 
             if num_edits > 0:
                 # save images for previous stage
-                max_value = max(current_stage_target_scores_list)
-                max_index = current_stage_target_scores_list.index(max_value)
-                saved_image = current_stage_images_list[max_index]
-                saved_label = current_stage_labels_list[max_index]
-                saved_score = current_stage_scores_list[max_index]
-                saved_latent_code = current_stage_latent_code_list[max_index]
-                saved_editing_latent_code = current_stage_editing_latent_code_list[max_index]
+                saved_label = stage_best['label']
+                saved_score = stage_best['score']
+                saved_latent_code = stage_best['latent_code']
+                saved_editing_latent_code = stage_best['edited_latent_code']
+                self.remember_trajectory(trajectory, stage_best['step'], alpha)
                 save_name = f'{prefix}_{sample_id:03d}_num_edits_{num_edits}_class_{previous_target_attr_label}_attr_idx_{self.target_attr_idx}.png'  # noqa
-                save_image(saved_image, f'{save_dir}/{save_name}')
-                if display_img:
+                if keep_images:
+                    saved_image = self.render_trial(stage_best['image'], stage_best['synthesis_latent_code'], modulated_weights)
+                    save(saved_image, f'{save_dir}/{save_name}')
+                if display_img and keep_images:
+                    flush_image_writer()
                     plt.figure()
                     plt.imshow(mpimg.imread(f'{save_dir}/{save_name}'))
                     plt.axis('off')
@@ -630,3 +1314,203 @@ class BaseModel():
                     editing_logger.info(f'{save_name}: {saved_label}, {saved_score}')
 
         return saved_latent_code, saved_editing_latent_code, saved_label, exception_mode
+
+    def continuous_editing_with_target_batch(self,
+                                             latent_codes,
+                                             edited_latent_codes,
+                                             attributes,
+                                             target_cls,
+                                             save_dir,
+                                             prefix,
+                                             materialize='none',
+                                             image_paths=None):
+        """Batched version of the linear scan of
+        continuous_editing_with_target, e.g., for the rounds of a batch of
+        simulated dialogs.
+
+        The samples may edit different attributes towards different target
+        classes. Each step integrates the fields of all the samples that
+        are still being edited with one evaluation of the field bank, and
+        synthesizes and classifies them with one batched call. Every sample
+        keeps its own stopping criteria and best candidate of the current
+        stage, so the results are the same as editing the samples one by
+        one. The trajectory cache is not used.
+
+        Args:
+            latent_codes (Tensor): [N, 512] field input of each sample.
+            edited_latent_codes (list): w plus latent code [1, n_latent, 512]
+                of each sample, None if not edited yet.
+            attributes (list[str]): Attribute edited in each sample.
+            target_cls (list[int]): Target class of each sample.
+            materialize (str): 'final' writes the image of the result of
+                each sample, 'none' writes nothing.
+            image_paths (list | None): List the paths of the written images
+                are appended to.
+
+        Returns:
+            tuple: Lists of the field input ([1, 512]), w plus latent code,
+                labels and exception mode of each sample.
+        """
+        assert self.fix_layers
+        if materialize not in ['none', 'final']:
+            raise ValueError(f'materialize should be none or final in the '
+                             f'batched edit, but got {materialize}.')
+        num = latent_codes.shape[0]
+        device = latent_codes.device
+        attr_indices = [
+            int(self.opt['attr_to_idx'][attr]) for attr in attributes
+        ]
+
+        sample_latent_codes = latent_codes.clone()
+        first_edit = torch.tensor(
+            [code is None for code in edited_latent_codes], device=device)
+        if self.latent_code_is_w_space and self.transform_z_to_w and \
+                first_edit.any():
+            # translate original z space latent code to w space
+            with torch.no_grad():
+                sample_latent_codes[first_edit] = self.stylegan_gen.get_latent(
+                    sample_latent_codes[first_edit])
+        # a w latent code is synthesized as its repeat to all the layers
+        w_plus_codes = torch.cat([
+            sample_latent_codes[idx:idx + 1].unsqueeze(1).repeat(
+                1, self.w_space_channel_num, 1)
+            if edited_latent_code is None else edited_latent_code
+            for idx, edited_latent_code in enumerate(edited_latent_codes)
+        ])
+
+        # synthesize, the start labels are predicted at full resolution as
+        # in continuous_editing_with_target, only the trials are at trial_res
+        with torch.no_grad():
+            _, start_labels, start_scores = self.synthesize_and_predict_batch(
+                w_plus_codes)
+
+        # images that are not edited return their input
+        results = [{
+            'latent_code': latent_codes[idx:idx + 1],
+            'edited_latent_code': edited_latent_codes[idx],
+            'label': start_labels[idx],
+            'exception_mode': 'normal'
+        } for idx in range(num)]
+
+        # editing state of the samples that are still being edited
+        sample_states = {}
+        for idx in range(num):
+            target_attr_label = int(start_labels[idx][attr_indices[idx]])
+            # skip images with low confidence
+            if start_scores[idx][attr_indices[idx]] < \
+                    self.opt['confidence_thresh']:
+                continue
+            # skip images that are already the target class num
+            if target_attr_label == target_cls[idx]:
+                results[idx]['exception_mode'] = 'already_at_target_class'
+                continue
+            sample_states[idx] = {
+                'direction':
+                'positive' if target_attr_label < target_cls[idx] else
+                'negative',
+                'num_trials': 0,
+                'num_edits': 0,
+                # the most confident candidate of the current stage
+                'stage_best': None,
+                'previous_target_attr_label': target_attr_label
+            }
+        alphas = torch.tensor([
+            -1. if idx in sample_states and
+            sample_states[idx]['direction'] == 'negative' else 1.
+            for idx in range(num)
+        ],
+                              device=device)
+
+        while len(sample_states) > 0:
+            active_ids = sorted(sample_states.keys())
+            active_idx = torch.tensor(active_ids, device=device)
+
+            # one step along the field for all the active samples
+            next_latent_codes, next_w_plus_codes, synthesis_latent_codes = \
+                self.integrate_field_batch(
+                    sample_latent_codes[active_idx], w_plus_codes[active_idx],
+                    [attributes[idx] for idx in active_ids],
+                    alphas[active_idx])
+            sample_latent_codes[active_idx] = next_latent_codes
+            w_plus_codes[active_idx] = next_w_plus_codes
+
+            with torch.no_grad():
+                _, edited_labels, edited_scores = \
+                    self.synthesize_and_predict_batch(
+                        synthesis_latent_codes, self.trial_res)
+
+            for batch_idx, idx in enumerate(active_ids):
+                state = sample_states[idx]
+                attr_idx = attr_indices[idx]
+                positive = state['direction'] == 'positive'
+                state['num_trials'] += 1
+
+                edited_label = edited_labels[batch_idx]
+                target_attr_label = edited_label[attr_idx]
+                target_attr_score = edited_scores[batch_idx][attr_idx]
+                candidate = {
+                    'latent_code':
+                    next_latent_codes[batch_idx:batch_idx + 1],
+                    'edited_latent_code':
+                    next_w_plus_codes[batch_idx:batch_idx + 1],
+                    'synthesis_latent_code':
+                    synthesis_latent_codes[batch_idx:batch_idx + 1],
+                    'label': edited_label,
+                    'target_score': target_attr_score
+                }
+
+                if (positive and target_attr_label > target_cls[idx]) or (
+                        not positive and target_attr_label < target_cls[idx]):
+                    # the target class is skipped
+                    if state['num_edits'] == 0:
+                        state['num_edits'] = 1
+                        state['stage_best'] = candidate
+                    finished = True
+                else:
+                    if target_attr_label != \
+                            state['previous_target_attr_label']:
+                        state['num_edits'] += 1
+                        state['stage_best'] = None
+                        state['num_trials'] = 0
+
+                    if state['num_edits'] > 0 and (
+                            state['stage_best'] is None or target_attr_score >
+                            state['stage_best']['target_score']):
+                        state['stage_best'] = candidate
+
+                    state['previous_target_attr_label'] = target_attr_label
+
+                    if state['num_trials'] > self.opt['max_trials_num']:
+                        if state['num_edits'] == 0:
+                            results[idx]['exception_mode'] = \
+                                'max_edit_num_reached'
+                        finished = True
+                    elif positive:
+                        finished = \
+                            target_attr_label >= self.opt['max_cls_num']
+                    else:
+                        finished = \
+                            target_attr_label <= self.opt['min_cls_num']
+
+                if not finished:
+                    continue
+                del sample_states[idx]
+                stage_best = state['stage_best']
+                if stage_best is None:
+                    continue
+                results[idx].update(
+                    latent_code=stage_best['latent_code'],
+                    edited_latent_code=stage_best['edited_latent_code'],
+                    label=stage_best['label'])
+                if materialize == 'final':
+                    save_path = f'{save_dir}/{prefix}_{idx:03d}_num_edits_{state["num_edits"]}_class_{stage_best["label"][attr_idx]}_attr_idx_{attr_idx}.png'  # noqa
+                    save_image(
+                        self.render_trial(
+                            None, stage_best['synthesis_latent_code']),
+                        save_path)
+                    if image_paths is not None:
+                        image_paths.append(save_path)
+
+        return tuple([result[key] for result in results] for key in [
+            'latent_code', 'edited_latent_code', 'label', 'exception_mode'
+        ])
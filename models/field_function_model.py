@@ -2,6 +2,10 @@ import logging
 
 import torch
 
+from models.archs.field_function_arch import (FieldEditOperator,
+                                              FieldFunction,
+                                              MultiFieldFunction,
+                                              StyleMapping)
 from models.base_model import BaseModel
 
 logger = logging.getLogger('base')
@@ -14,30 +18,128 @@ class FieldFunctionModel(BaseModel):
         self.replaced_layers = opt['replaced_layers']
         self.fix_layers = True
 
-    def modify_latent_code(self, latent_code_w, latent_code_w_plus=None):
+        # the style mapping and its offset are computed once per generator,
+        # the edit operator wraps it with the active field function
+        self.style_mapping = StyleMapping(
+            self.stylegan_gen.style[1:]).to(self.device)
+        self.edit_operator = None
+
+        # preload the pretrained field functions of all the attributes, so
+        # that switching the edited attribute does not touch the disk
+        self.field_bank = {}
+        if opt['pretrained_field'] is not None:
+            self.load_field_bank(opt['pretrained_field'])
+
+    def new_field_function(self):
+        return FieldFunction(
+            num_layer=self.opt['num_layer'],
+            latent_dim=512,
+            hidden_dim=self.opt['hidden_dim'],
+            leaky_relu_neg_slope=self.opt['leaky_relu_neg_slope']).to(
+                self.device)
+
+    def load_field_bank(self, pretrained_fields):
+        for attr, pretrained_field in pretrained_fields.items():
+            logger.info(f'Loading field function of {attr} from: '
+                        f'{pretrained_field}')
+            field_function = self.new_field_function()
+            checkpoint = torch.load(pretrained_field)
+            field_function.load_state_dict(checkpoint, strict=True)
+            field_function.eval()
+            self.field_bank[attr] = field_function
+
+        # fuse all the loaded fields for evaluating them at once
+        self.field_attr_list = [
+            attr for attr in self.opt['attr_list'] if attr in self.field_bank
+        ]
+        self.multi_field_function = MultiFieldFunction([
+            self.field_bank[attr] for attr in self.field_attr_list
+        ]).to(self.device)
+
+    def select_field(self, attr):
+        """Make the preloaded field function of attr the active one."""
+        if attr not in self.field_bank:
+            self.load_field_bank({attr: self.opt['pretrained_field'][attr]})
+        self.field_function = self.field_bank[attr]
+
+    def load_network(self, pretrained_field):
+        # the active field may be an entry of the field bank, load into a
+        # fresh field function so that the bank keeps its weights
+        if any(self.field_function is field_function
+               for field_function in self.field_bank.values()):
+            self.field_function = self.new_field_function()
+        super(FieldFunctionModel, self).load_network(pretrained_field)
+
+    def get_edit_operator(self):
+        if self.edit_operator is None or \
+                self.edit_operator.field_function is not self.field_function:
+            self.edit_operator = FieldEditOperator(
+                self.field_function, self.style_mapping, self.replaced_layers,
+                self.w_space_channel_num)
+        return self.edit_operator
+
+    def export_edit_operator(self, save_path):
+        """Save the edit operator of the active field with TorchScript."""
+        torch.jit.script(self.get_edit_operator()).save(save_path)
+
+    def compute_all_fields(self, latent_code_w):
+        """Edit directions of all the attributes in the field bank.
+
+        Returns a dict of [num_fields, batch_size, 512] tensors, ordered as
+        self.field_attr_list: 'field' is the output of the field functions
+        and 'delta_w' is its offset after the style mapping.
+        """
         assert self.input_is_latent
 
         return_dict = {}
-        # field function mapping
-        field = self.field_function(latent_code_w)
+        field = self.multi_field_function(latent_code_w)
+        num_fields, batch_size, latent_dim = field.shape
+        delta_w = self.style_mapping(
+            field.reshape(num_fields * batch_size,
+                          latent_dim)).view(num_fields, batch_size, latent_dim)
+
+        return_dict['field'] = field
+        return_dict['delta_w'] = delta_w
+        return return_dict
+
+    def integrate_field_batch(self, sample_latent_codes, edited_latent_codes,
+                              attributes, alphas):
+        """integrate_field for samples that move along the fields of
+        different attributes, with one evaluation of the field bank.
+
+        Args:
+            sample_latent_codes (Tensor): [batch_size, 512] w latent codes.
+            edited_latent_codes (Tensor): [batch_size, n_latent, 512] w plus
+                latent codes.
+            attributes (list[str]): Attribute of the field of each sample.
+            alphas (Tensor): [batch_size] step direction of each sample.
+        """
+        missing_fields = {
+            attr: self.opt['pretrained_field'][attr]
+            for attr in set(attributes) if attr not in self.field_bank
+        }
+        if len(missing_fields) > 0:
+            self.load_field_bank(missing_fields)
+        device = sample_latent_codes.device
+        field_idx = torch.tensor(
+            [self.field_attr_list.index(attr) for attr in attributes],
+            device=device)
+
         with torch.no_grad():
-            offset_w = self.stylegan_gen.style_forward(
-                torch.zeros_like(field), skip_norm=True)
-        delta_w = self.stylegan_gen.style_forward(
-            field, skip_norm=True) - offset_w
-
-        if latent_code_w_plus is None:
-            edited_latent_code = latent_code_w.unsqueeze(1).repeat(
-                1, self.w_space_channel_num, 1)
-        else:
-            edited_latent_code = latent_code_w_plus.clone()
-            return_dict['field'] = delta_w
+            delta_w = self.compute_all_fields(sample_latent_codes)['delta_w']
+            delta_w = alphas.view(-1, 1) * delta_w[
+                field_idx, torch.arange(len(attributes), device=device)]
+            sample_latent_codes = sample_latent_codes + delta_w
+            # as the edit operator, only the first replaced_layers change
+            edited_latent_codes = edited_latent_codes.clone()
+            edited_latent_codes[:, :self.replaced_layers] += \
+                delta_w.unsqueeze(1)
 
-        for layer_idx in range(self.replaced_layers):
-            edited_latent_code[:, layer_idx, :] += delta_w
+        return sample_latent_codes, edited_latent_codes, edited_latent_codes
 
-        return_dict['edited_latent_code'] = edited_latent_code
-        return return_dict
+    def modify_latent_code(self, latent_code_w, latent_code_w_plus=None):
+        return self.modify_latent_code_bidirection(latent_code_w,
+                                                   latent_code_w_plus)
 
     def modify_latent_code_bidirection(self,
                                        latent_code_w,
@@ -46,23 +148,11 @@ class FieldFunctionModel(BaseModel):
         assert self.input_is_latent
 
         return_dict = {}
-        # field function mapping
-        field = self.field_function(latent_code_w)
-        with torch.no_grad():
-            offset_w = self.stylegan_gen.style_forward(
-                torch.zeros_like(field), skip_norm=True)
-        delta_w = self.stylegan_gen.style_forward(
-            field, skip_norm=True) - offset_w
-
-        if latent_code_w_plus is None:
-            edited_latent_code = latent_code_w.unsqueeze(1).repeat(
-                1, self.w_space_channel_num, 1)
-        else:
-            edited_latent_code = latent_code_w_plus.clone()
+        # field function mapping and the w plus update in one operator
+        delta_w, edited_latent_code = self.get_edit_operator()(
+            latent_code_w, latent_code_w_plus, float(alpha))
+        if latent_code_w_plus is not None:
             return_dict['field'] = delta_w
 
-        for layer_idx in range(self.replaced_layers):
-            edited_latent_code[:, layer_idx, :] += alpha * delta_w
-
         return_dict['edited_latent_code'] = edited_latent_code
         return return_dict
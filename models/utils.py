@@ -1,4 +1,8 @@
+import hashlib
 import random
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, wait
 
 import cv2
 import numpy as np
@@ -43,6 +47,14 @@ def postprocess(images, channel_order='BGR', min_val=-1.0, max_val=1.0):
     return images
 
 
+# input resolution of the attribute predictor
+PREDICTOR_RES = 128
+# transform_image maps generator output x to clamp(x * scale + bias, 0, 1)
+# before the normalization
+TRANSFORM_IMAGE_SCALE = 0.5
+TRANSFORM_IMAGE_BIAS = 0.5 + 0.5 / 255
+
+
 def transform_image(image, resize=False):
     # transform image range to [0, 1]
     image = (image + 1) * 255 / 2
@@ -50,7 +62,8 @@ def transform_image(image, resize=False):
     image = torch.clamp(image + 0.5, 0, 255)
     image = image / 255.
     if resize:
-        image = F.interpolate(image, (128, 128), mode='area')
+        image = F.interpolate(
+            image, (PREDICTOR_RES, PREDICTOR_RES), mode='area')
 
     # normalize image to imagenet range
     img_mean = torch.Tensor([0.485, 0.456,
@@ -71,53 +84,189 @@ def set_random_seed(seed):
     torch.cuda.manual_seed_all(seed)
 
 
-def output_to_label(output):
+def output_to_labels(output, to_cpu=True):
     """
     INPUT
     - output: [num_attr, batch_size, num_classes]
     OUTPUT
-    - scores: [num_attr, batch_size, num_classes] (softmaxed)
-    - label: [num_attr, batch_size]
+    - labels: [batch_size, num_attr] LongTensor
+    - scores: [batch_size, num_attr] FloatTensor (softmaxed score of labels)
+    All the attributes and samples are decoded at once, with a single copy
+    to the host if to_cpu.
     """
-    scores = []
-    labels = []
-    for attr_idx in range(len(output)):
-        _, label = torch.max(input=output[attr_idx], dim=1)
-        label = label.cpu().numpy()[0]
-        labels.append(label)
-
-        score_per_attr = output[attr_idx].cpu().numpy()[0]
-        # softmax
-        score_per_attr = (np.exp(score_per_attr) /
-                          np.sum(np.exp(score_per_attr)))[label]
-        scores.append(score_per_attr)
-
-    scores = torch.FloatTensor(scores)
-    labels = torch.LongTensor(labels)
+    labels = torch.stack(
+        [torch.max(input=output_per_attr, dim=1)[1]
+         for output_per_attr in output],
+        dim=1)
+    scores = torch.cat([
+        F.softmax(output_per_attr, dim=1).gather(
+            1, labels[:, attr_idx:attr_idx + 1])
+        for attr_idx, output_per_attr in enumerate(output)
+    ], dim=1)
+
+    if to_cpu:
+        labels_scores = torch.stack([labels.to(scores.dtype), scores]).cpu()
+        labels, scores = labels_scores[0].long(), labels_scores[1]
 
     return labels, scores
 
 
-def predictor_to_label(predictor_output):
+def output_to_label(output):
+    """
+    INPUT
+    - output: [num_attr, batch_size, num_classes]
+    OUTPUT
+    - scores: [num_attr] (softmaxed score of label) of the first sample
+    - label: [num_attr] of the first sample
+    """
+    labels, scores = output_to_labels(output)
 
-    scores = []
-    labels = []
-    for attr_idx in range(len(predictor_output)):
-        _, label = torch.max(input=predictor_output[attr_idx], dim=1)
-        label = label.cpu().numpy()[0]
-        labels.append(label)
+    return labels[0], scores[0]
 
-        score_per_attr = predictor_output[attr_idx].cpu().numpy()[0]
-        # softmax
-        score_per_attr = (np.exp(score_per_attr) /
-                          np.sum(np.exp(score_per_attr)))[label]
-        scores.append(score_per_attr)
 
-    return labels, scores
+def predictor_to_label(predictor_output, batch_idx=0):
+    labels, scores = output_to_labels(predictor_output)
 
+    return labels[batch_idx].tolist(), scores[batch_idx].tolist()
 
-def save_image(img, save_path, need_post_process=True):
+
+def latent_hash(*latent_codes):
+    """Hash of the values of the latent codes, None entries included."""
+    digest = hashlib.sha1()
+    for latent_code in latent_codes:
+        if latent_code is None:
+            digest.update(b'none')
+        else:
+            digest.update(latent_code.detach().cpu().numpy().tobytes())
+    return digest.hexdigest()
+
+
+class TrajectoryCache():
+    """Bounded LRU cache of the editing trajectories.
+
+    Maps the key of a point on a trajectory, e.g., (latent hash, attribute,
+    direction), to (trajectory, step of the point). The trajectory is shared
+    by all its points, so the steps evaluated from one point are seen from
+    the others. The least recently used points are dropped beyond max_size,
+    a trajectory is freed with its last point.
+    """
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.entries = OrderedDict()
+
+    def get(self, key):
+        if key not in self.entries:
+            return None
+        self.entries.move_to_end(key)
+        return self.entries[key]
+
+    def put(self, key, trajectory, step):
+        self.entries[key] = (trajectory, step)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    def clear(self):
+        self.entries.clear()
+
+    def __len__(self):
+        return len(self.entries)
+
+
+class ImageWriter():
+    """Write images in a bounded pool of background threads.
+
+    The GPU to CPU copy, postprocess and PNG encoding of a frame run in the
+    pool, so the caller can go on rendering the next frame. At most
+    max_pending frames are in flight, save_image blocks when the pool is
+    saturated. Call flush() before reading the images back.
+    """
+
+    def __init__(self, num_workers=2, max_pending=16, png_compression=None):
+        self.executor = ThreadPoolExecutor(max_workers=num_workers)
+        self.pending = threading.BoundedSemaphore(max_pending)
+        self.png_compression = png_compression
+        self.futures = set()
+        self.lock = threading.Lock()
+
+    def submit(self, img, save_path, need_post_process=True):
+        self.pending.acquire()
+        future = self.executor.submit(write_image, img, save_path,
+                                      need_post_process, self.png_compression)
+        with self.lock:
+            self.futures.add(future)
+        future.add_done_callback(self.done)
+
+    def done(self, future):
+        self.pending.release()
+        if future.exception() is None:
+            with self.lock:
+                self.futures.discard(future)
+
+    def flush(self):
+        """Wait for all the submitted images, raise the first write error."""
+        with self.lock:
+            futures = list(self.futures)
+        wait(futures)
+        with self.lock:
+            self.futures.difference_update(futures)
+        for future in futures:
+            future.result()
+
+    def close(self):
+        self.flush()
+        self.executor.shutdown()
+
+
+_image_writer = None
+_png_compression = None
+
+
+def init_image_writer(writer_opt):
+    """Set up how save_image writes images.
+
+    Args:
+        writer_opt (dict | None): num_workers (0 writes inline), max_pending
+            and png_compression (cv2 PNG compression level 0-9, None for the
+            OpenCV default).
+    """
+    global _image_writer, _png_compression
+    close_image_writer()
+    if writer_opt is None:
+        return
+    _png_compression = writer_opt.get('png_compression')
+    if writer_opt.get('num_workers'):
+        _image_writer = ImageWriter(
+            num_workers=writer_opt['num_workers'],
+            max_pending=writer_opt.get('max_pending') or 16,
+            png_compression=_png_compression)
+
+
+def flush_image_writer():
+    if _image_writer is not None:
+        _image_writer.flush()
+
+
+def close_image_writer():
+    global _image_writer
+    if _image_writer is not None:
+        _image_writer.close()
+        _image_writer = None
+
+
+def write_image(img, save_path, need_post_process=True, png_compression=None):
     if need_post_process:
-        cv2.imwrite(save_path, postprocess(img.cpu().detach().numpy())[0])
+        img = postprocess(img.cpu().detach().numpy())[0]
+    if png_compression is not None and save_path.endswith('.png'):
+        cv2.imwrite(save_path, img,
+                    [cv2.IMWRITE_PNG_COMPRESSION, png_compression])
     else:
         cv2.imwrite(save_path, img)
+
+
+def save_image(img, save_path, need_post_process=True):
+    if _image_writer is not None:
+        _image_writer.submit(img, save_path, need_post_process)
+    else:
+        write_image(img, save_path, need_post_process, _png_compression)
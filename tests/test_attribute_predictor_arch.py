@@ -0,0 +1,66 @@
+import copy
+import json
+
+import pytest
+import torch
+import torch.nn.functional as F
+
+from models.archs.attribute_predictor_arch import (IMAGENET_MEAN,
+                                                   IMAGENET_STD, BasicBlock,
+                                                   ResNet,
+                                                   fold_input_normalization)
+from models.utils import (PREDICTOR_RES, TRANSFORM_IMAGE_BIAS,
+                          TRANSFORM_IMAGE_SCALE)
+
+
+def transform_image(image):
+    """models.utils.transform_image(image, resize=True) on the device of the
+    image, the original puts the statistics on cuda."""
+    image = (image + 1) * 255 / 2
+    image = torch.clamp(image + 0.5, 0, 255)
+    image = image / 255.
+    if image.size(-1) > PREDICTOR_RES:
+        image = F.interpolate(
+            image, (PREDICTOR_RES, PREDICTOR_RES), mode='area')
+    img_mean = torch.tensor(IMAGENET_MEAN).view(1, 3, 1, 1)
+    img_std = torch.tensor(IMAGENET_STD).view(1, 3, 1, 1)
+    return (image - img_mean) / img_std
+
+
+@pytest.fixture
+def predictor(tmp_path):
+    attr_file = tmp_path / 'attributes.json'
+    attr_file.write_text(
+        json.dumps({
+            'attr_info': {
+                '1': {
+                    'name': 'Bangs',
+                    'value': [0, 1, 2, 3, 4, 5]
+                },
+                '2': {
+                    'name': 'Smiling',
+                    'value': [0, 1, 2, 3, 4, 5]
+                }
+            }
+        }))
+    torch.manual_seed(0)
+    return ResNet(BasicBlock, [1, 1, 1, 1], str(attr_file)).eval()
+
+
+# inputs smaller than PREDICTOR_RES are taken as they are
+@pytest.mark.parametrize('res', [64, PREDICTOR_RES, 2 * PREDICTOR_RES])
+def test_fold_input_normalization(predictor, res):
+    folded_predictor = fold_input_normalization(
+        copy.deepcopy(predictor), TRANSFORM_IMAGE_SCALE, TRANSFORM_IMAGE_BIAS,
+        PREDICTOR_RES)
+
+    torch.manual_seed(1)
+    # generator outputs slightly exceed [-1, 1], which exercises the clamp
+    image = torch.randn(2, 3, res, res).clamp(-1.2, 1.2)
+    with torch.no_grad():
+        expected = predictor(transform_image(image))
+        output = folded_predictor(image)
+
+    for expected_per_attr, output_per_attr in zip(expected, output):
+        assert torch.allclose(
+            output_per_attr, expected_per_attr, rtol=1e-4, atol=1e-4)
@@ -0,0 +1,148 @@
+import random
+
+import pytest
+import torch
+
+from models.base_model import BaseModel
+
+MAX_TRIALS_NUM = 6
+MIN_CLS_NUM = 0
+MAX_CLS_NUM = 5
+
+
+class StubModel(BaseModel):
+    """Moves a scalar position along the field, the label of a step is
+    looked up in a synthetic label profile."""
+
+    def __init__(self, labels, scores):
+        self.opt = {
+            'max_trials_num': MAX_TRIALS_NUM,
+            'min_cls_num': MIN_CLS_NUM,
+            'max_cls_num': MAX_CLS_NUM
+        }
+        self.target_attr_idx = 0
+        self.trial_res = None
+        self.labels = labels
+        self.scores = scores
+
+    def integrate_field(self, sample_latent_code, edited_latent_code, alpha):
+        sample_latent_code = sample_latent_code + alpha
+        return sample_latent_code, edited_latent_code, sample_latent_code
+
+    def synthesize_and_predict_batch(self,
+                                     sample_latent_codes,
+                                     exit_res=None,
+                                     modulated_weights=None):
+        steps = [
+            min(int(abs(position)), len(self.labels) - 1)
+            for position in sample_latent_codes.view(-1).tolist()
+        ]
+        return (torch.zeros(len(steps), 1),
+                [[self.labels[step]] for step in steps],
+                [[self.scores[step]] for step in steps])
+
+
+def linear_scan(labels, scores, direction, target_cls):
+    """The stage logic of the linear scan in continuous_editing_with_target.
+
+    Returns (step, num_edits) of the saved result, or None if it keeps the
+    input.
+    """
+    positive = direction == 'positive'
+    label = labels[0]
+    previous_label = label
+    num_trials, num_edits, step = 0, 0, 0
+    stage_best = None
+    while (positive and label <= target_cls and label < MAX_CLS_NUM) or (
+            not positive and label >= target_cls and label > MIN_CLS_NUM):
+        num_trials += 1
+        step += 1
+        label = labels[min(step, len(labels) - 1)]
+        score = scores[min(step, len(labels) - 1)]
+        if (positive and label > target_cls) or (not positive and
+                                                 label < target_cls):
+            if num_edits == 0:
+                return step, 1
+            break
+        if label != previous_label:
+            num_edits += 1
+        if num_edits > 0:
+            if label != previous_label:
+                stage_best = None
+                num_trials = 0
+            if stage_best is None or score > stage_best[1]:
+                stage_best = (step, score)
+        previous_label = label
+        if num_trials > MAX_TRIALS_NUM:
+            break
+    if num_edits > 0:
+        return stage_best[0], num_edits
+    return None
+
+
+def random_profile(rng, direction, start_cls, length=32):
+    """Label profile that mostly moves one class per stage, with skipped
+    classes now and then. binary_search_edit assumes that the label does not
+    go back and forth between two probed steps, so it never goes back."""
+    sign = 1 if direction == 'positive' else -1
+    labels = []
+    label = start_cls
+    while len(labels) < length:
+        labels.extend([label] * rng.randint(1, 4))
+        move = rng.choices([1, 2], weights=[8, 1])[0]
+        label = min(max(label + sign * move, MIN_CLS_NUM), MAX_CLS_NUM)
+    scores = [rng.random() for _ in labels]
+    return labels[:length], scores[:length]
+
+
+@pytest.mark.parametrize('direction', ['positive', 'negative'])
+def test_binary_search_matches_linear_scan(direction):
+    rng = random.Random(0)
+    num_found = 0
+    for _ in range(200):
+        if direction == 'positive':
+            start_cls = rng.randint(MIN_CLS_NUM, MAX_CLS_NUM - 1)
+            target_cls = rng.randint(start_cls + 1, MAX_CLS_NUM)
+        else:
+            start_cls = rng.randint(MIN_CLS_NUM + 1, MAX_CLS_NUM)
+            target_cls = rng.randint(MIN_CLS_NUM, start_cls - 1)
+        labels, scores = random_profile(rng, direction, start_cls)
+
+        model = StubModel(labels, scores)
+        trajectory = model.new_trajectory(
+            torch.zeros(1, 1), None, label=[labels[0]], score=[scores[0]])
+        result = model.binary_search_edit(
+            trajectory,
+            0,
+            1 if direction == 'positive' else -1,
+            direction,
+            target_cls, [labels[0]],
+            render=False)
+
+        if result is None:
+            # the caller falls back to the linear scan
+            continue
+        num_found += 1
+        assert (result['step'], result['num_edits']) == linear_scan(
+            labels, scores, direction, target_cls)
+        assert result['label'] == [labels[result['step']]]
+
+    # the search must not fall back for most of the profiles
+    assert num_found > 100
+
+
+def test_binary_search_staircase():
+    labels = [1] + [2] * 5 + [3] * 4 + [4] * 10
+    scores = [0.5] * len(labels)
+    scores[8] = 0.9
+
+    model = StubModel(labels, scores)
+    trajectory = model.new_trajectory(
+        torch.zeros(1, 1), None, label=[1], score=[0.5])
+    result = model.binary_search_edit(
+        trajectory, 0, 1, 'positive', 3, [1], render=False)
+
+    assert (result['step'], result['num_edits']) == (8, 2)
+    assert linear_scan(labels, scores, 'positive', 3) == (8, 2)
+    # steps between the probes are not classified
+    assert trajectory[3]['label'] is None
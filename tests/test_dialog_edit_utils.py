@@ -0,0 +1,157 @@
+import json
+import logging
+import os.path
+from types import SimpleNamespace
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+
+from utils.dialog_edit_utils import (SIMULATED_QUERIES, SIMULATED_QUERY_LIST,
+                                     EditTracker, train_with_batch_simulator)
+from utils.dialog_fsm import ATTRIBUTE_LIST
+
+TEMPLATE_DIR = os.path.join(
+    os.path.dirname(__file__), '..', 'language', 'templates')
+NUM_CLASSES = 6
+
+# user mode of an edit request and of "That's all" after each system mode
+REQUEST_USER_MODES = {
+    'start': 'start_pureRequest',
+    'suggestion': 'no_pureRequest',
+    'whether_enough': 'no_pureRequest',
+    'whats_next': 'pureRequest'
+}
+END_USER_MODES = {
+    'suggestion': 'no_end',
+    'whether_enough': 'yes_end',
+    'whats_next': 'end'
+}
+
+
+class StubEncoderSession():
+    """Parses the simulated queries without the language encoder."""
+
+    def __init__(self):
+        self.queries = {
+            query: (ATTRIBUTE_LIST[attr_idx], direction)
+            for attr_idx, queries in enumerate(SIMULATED_QUERIES)
+            for query, direction in zip(queries, ['negative', 'positive'])
+        }
+        self.warmed_up = []
+
+    def warm_up(self, texts, system_modes=None):
+        self.warmed_up.extend(texts)
+
+    def encode(self, system_mode=None, dialog_logger=None,
+               input_request=None):
+        if input_request not in self.queries:
+            return {
+                'text': input_request,
+                'user_mode': END_USER_MODES[system_mode],
+                'request_mode': 'end',
+                'attribute': None,
+                'score_change_direction': None,
+                'score_change_value': None,
+                'target_score': None
+            }
+        attribute, direction = self.queries[input_request]
+        return {
+            'text': input_request,
+            'user_mode': REQUEST_USER_MODES[system_mode],
+            'request_mode': 'change_indefinite',
+            'attribute': attribute,
+            'score_change_direction': direction,
+            'score_change_value': None,
+            'target_score': None
+        }
+
+
+class StubFieldModel():
+    """Predicts fixed start labels, an edit reaches its target class."""
+
+    def __init__(self, labels):
+        self.labels = labels
+        self.edit_calls = []
+
+    def synthesize_image(self, latent_codes):
+        return latent_codes
+
+    def predictor(self, images):
+        return [
+            F.one_hot(self.labels[:, attr_idx], NUM_CLASSES).float()
+            for attr_idx in range(len(ATTRIBUTE_LIST))
+        ]
+
+    def continuous_editing_with_target_batch(self,
+                                             latent_codes,
+                                             edited_latent_codes,
+                                             attributes,
+                                             target_cls,
+                                             save_dir,
+                                             prefix,
+                                             materialize='none',
+                                             image_paths=None):
+        self.edit_calls.append(attributes)
+        results = ([], [], [], [])
+        for idx, (attribute, target) in enumerate(zip(attributes,
+                                                      target_cls)):
+            label = self.labels[idx].tolist()
+            label[ATTRIBUTE_LIST.index(attribute)] = target
+            results[0].append(latent_codes[idx:idx + 1] + 0.1)
+            results[1].append(
+                latent_codes[idx:idx + 1].unsqueeze(1).repeat(1, 18, 1))
+            results[2].append(label)
+            results[3].append('normal')
+        return results
+
+
+def test_train_with_batch_simulator(tmp_path):
+    np.random.seed(0)
+    torch.manual_seed(0)
+    batch_size = 4
+    start_labels = torch.randint(0, 3, (batch_size, len(ATTRIBUTE_LIST)))
+    # every dialog starts with an edit request
+    tgt_labels = start_labels.clone()
+    tgt_labels[:, 0] += 2
+
+    with open(os.path.join(TEMPLATE_DIR, 'feedback.json'), 'r') as f:
+        feedback_templates = json.load(f)
+    with open(os.path.join(TEMPLATE_DIR, 'pool.json'), 'r') as f:
+        synonyms_dict = json.load(f)['synonyms']
+    args = SimpleNamespace(
+        encoder_session=StubEncoderSession(),
+        feedback_templates=feedback_templates,
+        feedback_replacement=feedback_templates['replacement'],
+        synonyms_dict=synonyms_dict,
+        whether_enough_general_prob=0.2)
+    field_model = StubFieldModel(start_labels)
+    policy = EditTracker()
+
+    dialog_logs, feat_distances, score_distances, loss, _, log_probs = \
+        train_with_batch_simulator(
+            field_model,
+            policy,
+            np.random.randn(batch_size, 512).astype(np.float32),
+            tgt_labels.numpy(),
+            np.random.randn(batch_size, 512).astype(np.float32),
+            {'path': {
+                'visualization': str(tmp_path)
+            }},
+            args,
+            logging.getLogger('test'),
+            train=True,
+            num_rounds=1)
+
+    # the simulated queries are parsed before the first round
+    assert args.encoder_session.warmed_up == SIMULATED_QUERY_LIST
+    # the edits of all the dialogs of the round are made in one call
+    assert field_model.edit_calls == [['Bangs'] * batch_size]
+    assert len(dialog_logs) == batch_size
+    for dialog_log in dialog_logs:
+        assert dialog_log['state_log'] == ['start', 'edit']
+        assert dialog_log['edit_log'][0]['attribute'] == 'Bangs'
+    assert len(feat_distances) == len(score_distances) == 1
+    assert len(log_probs) == 1
+    loss.backward()
+    assert policy.mean.weight.grad is not None
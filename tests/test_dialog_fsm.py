@@ -0,0 +1,195 @@
+import itertools
+import random
+
+import numpy as np
+import pytest
+
+from utils import dialog_fsm
+from utils.dialog_edit_utils import (decide_next_edit, decide_next_feedback,
+                                     decide_next_state)
+
+
+def reference_next_state(state, system_mode, user_mode):
+    try:
+        return decide_next_state(state, system_mode, user_mode)
+    except (AssertionError, ValueError, UnboundLocalError):
+        return None
+
+
+@pytest.mark.parametrize(
+    'state, system_mode, user_mode',
+    list(
+        itertools.product(dialog_fsm.STATE_LIST, dialog_fsm.SYSTEM_MODE_LIST,
+                          dialog_fsm.USER_MODE_LIST)))
+def test_next_state_table(state, system_mode, user_mode):
+    next_state = reference_next_state(state, system_mode, user_mode)
+    codes = (np.array([dialog_fsm.STATE_TO_IDX[state]]),
+             np.array([dialog_fsm.SYSTEM_MODE_TO_IDX[system_mode]]),
+             np.array([dialog_fsm.USER_MODE_TO_IDX[user_mode]]))
+    if next_state is None:
+        with pytest.raises(ValueError):
+            dialog_fsm.decide_next_state_batch(*codes)
+    else:
+        assert dialog_fsm.STATE_LIST[dialog_fsm.decide_next_state_batch(
+            *codes)[0]] == next_state
+
+
+def random_user_labels(user_mode, rng):
+    request_mode = rng.choice(
+        ['change_definite', 'change_indefinite', 'target'])
+    user_labels = {
+        'user_mode': user_mode,
+        'request_mode': request_mode,
+        'attribute': rng.choice(dialog_fsm.ATTRIBUTE_LIST),
+        'score_change_direction': None,
+        'score_change_value': None,
+        'target_score': None
+    }
+    if request_mode == 'target':
+        user_labels['target_score'] = rng.randint(0, 5)
+    else:
+        user_labels['score_change_direction'] = rng.choice(
+            ['positive', 'negative'])
+        if request_mode == 'change_definite':
+            user_labels['score_change_value'] = rng.randint(1, 3)
+    return user_labels
+
+
+def test_next_edit_batch():
+    rng = random.Random(0)
+    cases = []
+    for previous_state, system_mode, user_mode, has_edit_log in \
+            itertools.product(dialog_fsm.STATE_LIST,
+                              dialog_fsm.SYSTEM_MODE_LIST,
+                              dialog_fsm.USER_MODE_LIST, [False, True]):
+        # the edit is decided for the state the dialog moves to
+        state = reference_next_state(previous_state, system_mode, user_mode)
+        if state is None or state == 'end':
+            continue
+        for _ in range(4):
+            user_labels = random_user_labels(user_mode, rng)
+            system_labels = {
+                'system_mode': system_mode,
+                'attribute': rng.choice(dialog_fsm.ATTRIBUTE_LIST)
+            }
+            previous_edit = {
+                'attribute': rng.choice(dialog_fsm.ATTRIBUTE_LIST),
+                'score_change_direction': rng.choice(
+                    ['positive', 'negative']),
+                'score_change_value': 1,
+                'target_score': None
+            }
+            edit_log = [previous_edit] if has_edit_log else []
+            attribute_dict = {
+                attr: rng.randint(0, 5)
+                for attr in dialog_fsm.ATTRIBUTE_LIST
+            }
+            try:
+                edit_labels = decide_next_edit(edit_log, system_labels,
+                                               user_labels, state,
+                                               attribute_dict, None)
+            except (AssertionError, ValueError):
+                continue
+            cases.append((state, system_labels, user_labels, edit_log,
+                          attribute_dict, edit_labels))
+    assert len(cases) > 0
+
+    user_modes, user_edits = dialog_fsm.user_labels_to_codes(
+        [case[2] for case in cases])
+    edits = dialog_fsm.decide_next_edit_batch(
+        np.array([dialog_fsm.STATE_TO_IDX[case[0]] for case in cases]),
+        np.array([
+            dialog_fsm.SYSTEM_MODE_TO_IDX[case[1]['system_mode']]
+            for case in cases
+        ]), user_modes, np.array([len(case[3]) > 0 for case in cases]),
+        user_edits,
+        dialog_fsm.edit_labels_to_codes(
+            [case[3][-1] if case[3] else None for case in cases]),
+        np.array([
+            dialog_fsm.ATTRIBUTE_TO_IDX[case[1]['attribute']]
+            for case in cases
+        ]),
+        np.array([[case[4][attr] for attr in dialog_fsm.ATTRIBUTE_LIST]
+                  for case in cases]))
+
+    assert dialog_fsm.edit_codes_to_labels(edits) == [
+        case[5] for case in cases
+    ]
+
+
+def sample_feedback(state, round_idx, not_used_attribute, num_samples):
+    random.seed(0)
+    counts = {}
+    for _ in range(num_samples):
+        system_labels = decide_next_feedback(
+            system_labels={
+                'system_mode': 'whats_next',
+                'attribute': None
+            },
+            user_labels={
+                'user_mode': 'pureRequest',
+                'attribute': 'Bangs'
+            },
+            state=state,
+            edit_labels={'attribute': 'Bangs'},
+            not_used_attribute=not_used_attribute,
+            round_idx=round_idx,
+            exception_mode='normal')
+        counts[system_labels['system_mode']] = counts.get(
+            system_labels['system_mode'], 0) + 1
+    return {mode: count / num_samples for mode, count in counts.items()}
+
+
+@pytest.mark.parametrize('state', ['edit', 'no_edit'])
+@pytest.mark.parametrize('round_idx', [0, 1, 5])
+@pytest.mark.parametrize('num_not_used', [0, 2, 5])
+def test_feedback_prob_table(state, round_idx, num_not_used):
+    num_samples = 20000
+    not_used_attribute = dialog_fsm.ATTRIBUTE_LIST[:num_not_used]
+    reference = sample_feedback(state, round_idx, list(not_used_attribute),
+                                num_samples)
+
+    not_used_mask = np.zeros((num_samples, len(dialog_fsm.ATTRIBUTE_LIST)),
+                             dtype=bool)
+    not_used_mask[:, :num_not_used] = True
+    system_modes, attributes = dialog_fsm.decide_next_feedback_batch(
+        np.full(num_samples, dialog_fsm.STATE_TO_IDX[state]),
+        np.full(num_samples, dialog_fsm.SYSTEM_MODE_TO_IDX['whats_next']),
+        np.full(num_samples, dialog_fsm.USER_MODE_TO_IDX['pureRequest']),
+        round_idx, not_used_mask, np.zeros(num_samples, dtype=bool),
+        np.zeros(num_samples, dtype=np.int64),
+        np.zeros(num_samples, dtype=np.int64),
+        np.full(num_samples, dialog_fsm.NONE), np.random.default_rng(0))
+
+    for system_mode in dialog_fsm.SYSTEM_MODE_LIST[1:]:
+        prob = (system_modes ==
+                dialog_fsm.SYSTEM_MODE_TO_IDX[system_mode]).mean()
+        assert prob == pytest.approx(
+            reference.get(system_mode, 0.), abs=0.02)
+    # suggestions only pick not used attributes
+    is_suggestion = system_modes == dialog_fsm.SYSTEM_MODE_TO_IDX[
+        'suggestion']
+    assert (attributes[is_suggestion] < num_not_used).all()
+
+
+def test_feedback_batch_overrides():
+    edit = dialog_fsm.STATE_TO_IDX['edit']
+    system_modes, attributes = dialog_fsm.decide_next_feedback_batch(
+        np.array([edit, edit]),
+        np.array([
+            dialog_fsm.SYSTEM_MODE_TO_IDX['suggestion'],
+            dialog_fsm.SYSTEM_MODE_TO_IDX['suggestion']
+        ]),
+        np.array([
+            dialog_fsm.USER_MODE_TO_IDX['yes'],
+            dialog_fsm.USER_MODE_TO_IDX['yes']
+        ]), 0, np.ones((2, len(dialog_fsm.ATTRIBUTE_LIST)), dtype=bool),
+        np.array([False, True]), np.array([0, 0]), np.array([3, 3]),
+        np.array([3, 3]), np.random.default_rng(0))
+
+    # accepted suggestion is followed by whether_enough on the suggestion
+    assert system_modes[0] == dialog_fsm.SYSTEM_MODE_TO_IDX['whether_enough']
+    assert attributes[0] == 3
+    # exceptions always ask what's next
+    assert system_modes[1] == dialog_fsm.SYSTEM_MODE_TO_IDX['whats_next']
+    assert attributes[1] == dialog_fsm.NONE
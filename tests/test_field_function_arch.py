@@ -0,0 +1,123 @@
+import math
+
+import pytest
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+from models.archs.field_function_arch import (FieldEditOperator,
+                                              FieldFunction,
+                                              MultiFieldFunction,
+                                              StyleMapping)
+
+NUM_LAYERS = 6
+REPLACED_LAYERS = 4
+
+
+@pytest.mark.parametrize('num_fields', [1, 3])
+@pytest.mark.parametrize('num_layer', [2, 4])
+def test_multi_field_function(num_fields, num_layer):
+    torch.manual_seed(0)
+    field_functions = [
+        FieldFunction(
+            num_layer=num_layer,
+            latent_dim=16,
+            hidden_dim=32,
+            leaky_relu_neg_slope=0.2).eval() for _ in range(num_fields)
+    ]
+    multi_field_function = MultiFieldFunction(field_functions)
+
+    x = torch.randn(5, 16)
+    with torch.no_grad():
+        fields = multi_field_function(x)
+        expected = torch.stack(
+            [field_function(x) for field_function in field_functions])
+
+    assert fields.shape == (num_fields, 5, 16)
+    assert torch.allclose(fields, expected, atol=1e-5)
+
+
+class EqualLinear(nn.Module):
+    """EqualLinear of the StyleGAN2 style MLP with the fused_leaky_relu
+    activation, without the compiled ops of models.archs.stylegan2."""
+
+    def __init__(self, in_dim, out_dim, lr_mul=0.01):
+        super(EqualLinear, self).__init__()
+        self.weight = nn.Parameter(torch.randn(out_dim, in_dim).div_(lr_mul))
+        self.bias = nn.Parameter(torch.randn(out_dim))
+        self.scale = (1 / math.sqrt(in_dim)) * lr_mul
+        self.lr_mul = lr_mul
+
+    def forward(self, input):
+        out = F.linear(input, self.weight * self.scale)
+        return F.leaky_relu(
+            out + self.bias * self.lr_mul, negative_slope=0.2) * math.sqrt(2)
+
+
+def style_forward(style_layers, x):
+    for layer in style_layers:
+        x = layer(x)
+    return x
+
+
+def edit_latent_code(field_function, style_layers, latent_code_w,
+                     latent_code_w_plus=None, alpha=1):
+    """The field edit before StyleMapping and FieldEditOperator."""
+    field = field_function(latent_code_w)
+    offset_w = style_forward(style_layers, torch.zeros_like(field))
+    delta_w = style_forward(style_layers, field) - offset_w
+
+    if latent_code_w_plus is None:
+        edited_latent_code = latent_code_w.unsqueeze(1).repeat(
+            1, NUM_LAYERS, 1)
+    else:
+        edited_latent_code = latent_code_w_plus.clone()
+    for layer_idx in range(REPLACED_LAYERS):
+        edited_latent_code[:, layer_idx, :] += alpha * delta_w
+    return delta_w, edited_latent_code
+
+
+@pytest.fixture
+def field_edit():
+    torch.manual_seed(0)
+    field_function = FieldFunction(
+        num_layer=4, latent_dim=16, hidden_dim=32).eval()
+    style_layers = nn.ModuleList([EqualLinear(16, 16) for _ in range(3)])
+    style_mapping = StyleMapping(style_layers)
+    edit_operator = FieldEditOperator(field_function, style_mapping,
+                                      REPLACED_LAYERS, NUM_LAYERS)
+    return field_function, style_layers, style_mapping, edit_operator
+
+
+def test_style_mapping(field_edit):
+    _, style_layers, style_mapping, _ = field_edit
+    x = torch.randn(5, 16)
+    with torch.no_grad():
+        expected = style_forward(style_layers, x) - style_forward(
+            style_layers, torch.zeros_like(x))
+        assert torch.allclose(style_mapping(x), expected, atol=1e-5)
+
+
+@pytest.mark.parametrize('has_w_plus', [False, True])
+@pytest.mark.parametrize('alpha', [1., -1.])
+def test_field_edit_operator(field_edit, tmp_path, has_w_plus, alpha):
+    field_function, style_layers, _, edit_operator = field_edit
+    latent_code_w = torch.randn(5, 16)
+    latent_code_w_plus = torch.randn(5, NUM_LAYERS,
+                                     16) if has_w_plus else None
+
+    scripted_path = str(tmp_path / 'edit_operator.pt')
+    torch.jit.script(edit_operator).save(scripted_path)
+    scripted_operator = torch.jit.load(scripted_path)
+
+    with torch.no_grad():
+        expected_delta_w, expected_latent_code = edit_latent_code(
+            field_function, style_layers, latent_code_w, latent_code_w_plus,
+            alpha)
+        for operator in [edit_operator, scripted_operator]:
+            delta_w, edited_latent_code = operator(latent_code_w,
+                                                   latent_code_w_plus, alpha)
+            assert torch.allclose(delta_w, expected_delta_w, atol=1e-5)
+            assert edited_latent_code.shape == (5, NUM_LAYERS, 16)
+            assert torch.allclose(
+                edited_latent_code, expected_latent_code, atol=1e-5)
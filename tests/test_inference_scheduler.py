@@ -0,0 +1,65 @@
+import asyncio
+
+import pytest
+import torch
+
+from utils.inference_scheduler import (InferenceScheduler, StandInModel,
+                                       run_stand_in_client)
+
+NUM_SESSIONS = 16
+NUM_TURNS = 4
+
+
+@pytest.mark.parametrize('threaded', [False, True])
+def test_stand_in_client_is_batched(threaded):
+    torch.manual_seed(0)
+    metrics = asyncio.run(
+        run_stand_in_client(
+            num_sessions=NUM_SESSIONS,
+            num_turns=NUM_TURNS,
+            max_batch_size=8,
+            max_wait=0.05,
+            threaded=threaded))
+
+    batch_size_hist = metrics['batch_size_hist']
+    assert metrics['num_requests'] == NUM_SESSIONS * NUM_TURNS
+    assert sum(batch_size * num_batches for batch_size, num_batches in
+               batch_size_hist.items()) == NUM_SESSIONS * NUM_TURNS
+    assert max(batch_size_hist) <= 8
+    # the concurrent sessions share the forwards
+    assert sum(batch_size_hist.values()) < NUM_SESSIONS * NUM_TURNS / 2
+    assert metrics['queue_depth'] == 0
+    assert len(metrics['latency']) == 4
+
+
+def test_requests_of_several_latent_codes():
+    model = StandInModel(img_res=128, forward_time=0)
+
+    async def run():
+        scheduler = InferenceScheduler(model, max_batch_size=8, max_wait=0.05)
+        scheduler.start()
+        latent_codes = [
+            torch.randn(3, 512),
+            torch.randn(2, model.stylegan_gen.n_latent, 512),
+            torch.randn(1, 512)
+        ]
+        results = await asyncio.gather(
+            scheduler.synthesize_and_predict_batch(latent_codes[0]),
+            scheduler.synthesize_and_predict_batch(
+                latent_codes[1], is_w_plus=True),
+            scheduler.synthesize_and_predict_batch(
+                latent_codes[2], exit_res=64))
+        await scheduler.stop()
+        return latent_codes, results, scheduler.metrics()
+
+    latent_codes, results, metrics = asyncio.run(run())
+
+    # the requests are batched, the trial resolution in a batch of its own
+    assert metrics['batch_size_hist'] == {3: 1}
+    for latent_code, (images, labels, scores), res in zip(
+            latent_codes, results, [128, 128, 64]):
+        assert images.shape == (latent_code.size(0), 3, res, res)
+        _, expected_labels, expected_scores = \
+            model.synthesize_and_predict_batch(latent_code)
+        assert labels == expected_labels
+        assert scores == expected_scores
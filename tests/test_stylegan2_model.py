@@ -0,0 +1,41 @@
+import pytest
+import torch
+
+# the fused ops of the generator are compiled CUDA extensions
+pytestmark = pytest.mark.skipif(
+    not torch.cuda.is_available(), reason='the generator needs CUDA')
+
+
+@pytest.fixture
+def generator():
+    from models.archs.stylegan2.model import Generator
+    torch.manual_seed(0)
+    return Generator(64, 512, 2, channel_multiplier=1).cuda().eval()
+
+
+def test_modulated_convs(generator):
+    layers = [layer for layer, _ in generator.modulated_convs()]
+    assert len(layers) == 2 + 3 * len(generator.to_rgbs)
+    assert max(layers) == generator.n_latent - 1
+
+
+@pytest.mark.parametrize('replaced_layers', [1, 3, 4, 7])
+def test_forward_with_modulated_weights(generator, replaced_layers):
+    latent = torch.randn(1, generator.n_latent, 512, device='cuda')
+    modulated_weights = generator.modulated_weights(
+        latent, range(replaced_layers, generator.n_latent))
+
+    # trials of an edit only change the first replaced_layers layers
+    edited_latent = latent.repeat(3, 1, 1)
+    edited_latent[:, :replaced_layers] += torch.randn(
+        3, replaced_layers, 512, device='cuda')
+    with torch.no_grad():
+        expected, _ = generator([edited_latent],
+                                input_is_latent=True,
+                                randomize_noise=False)
+        image, _ = generator([edited_latent],
+                             input_is_latent=True,
+                             randomize_noise=False,
+                             modulated_weights=modulated_weights)
+
+    assert torch.allclose(image, expected, atol=1e-4)
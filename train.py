@@ -10,6 +10,8 @@ import torch
 
 from data.latent_code_dataset import LatentCodeDataset
 from models import create_model
+from models.utils import (close_image_writer, flush_image_writer,
+                          init_image_writer)
 from utils.logger import MessageLogger, get_root_logger, init_tb_logger
 from utils.numerical_metrics import compute_num_metrics
 from utils.options import dict2str, dict_to_nonedict, parse
@@ -87,6 +89,7 @@ def main():
     best_predictor = None
 
     field_model = create_model(opt)
+    init_image_writer(opt['image_writer'])
 
     data_time, iter_time = 0, 0
     current_iter = 0
@@ -138,8 +141,10 @@ def main():
                 log_level=logging.INFO,
                 log_file=f'{save_path}/editing.log')
 
-            field_model.continuous_editing(editing_latent_codes, save_path,
-                                           editing_logger)
+            field_model.continuous_editing_batch(editing_latent_codes,
+                                                 save_path, editing_logger)
+            # the metrics are computed on the saved images
+            flush_image_writer()
 
             arcface_sim, predictor_score = compute_num_metrics(
                 save_path, num_latent_codes, opt['pretrained_arcface'],
@@ -167,6 +172,8 @@ def main():
                 field_model.field_function,
                 f'{opt["path"]["models"]}/ckpt_epoch{epoch}.pth')
 
+    close_image_writer()
+
 
 if __name__ == '__main__':
     main()
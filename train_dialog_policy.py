@@ -0,0 +1,127 @@
+import argparse
+import json
+import logging
+import os.path
+
+import numpy as np
+import torch
+
+from language.run_encoder import EncoderSession
+from models import create_model
+from models.utils import close_image_writer, init_image_writer
+from utils.dialog_edit_utils import EditTracker, train_with_batch_simulator
+from utils.logger import get_root_logger
+from utils.options import (dict2str, dict_to_nonedict, parse,
+                           parse_args_from_opt, parse_opt_wrt_resolution)
+from utils.util import make_exp_dirs
+
+
+def parse_args():
+    """Parses arguments."""
+    parser = argparse.ArgumentParser(description='')
+    parser.add_argument(
+        '--opt', default=None, type=str, help='Path to option YAML file.')
+    return parser.parse_args()
+
+
+def sample_latent_codes(field_model, batch_size):
+    """Random w latent codes and their predicted attribute labels."""
+    with torch.no_grad():
+        latent_codes = field_model.stylegan_gen.get_latent(
+            torch.randn(batch_size, 512, device=torch.device('cuda')))
+        _, labels, _ = field_model.synthesize_and_predict_batch(latent_codes)
+    return latent_codes.cpu().numpy(), labels
+
+
+def main():
+
+    # ---------- Set up -----------
+    args = parse_args()
+    opt = parse(args.opt, is_train=False)
+    opt = parse_opt_wrt_resolution(opt)
+    args = parse_args_from_opt(args, opt)
+    make_exp_dirs(opt)
+
+    # convert to NoneDict, which returns None for missing keys
+    opt = dict_to_nonedict(opt)
+    policy_opt = opt['dialog_policy']
+
+    # set up logger
+    save_log_path = f'{opt["path"]["log"]}'
+    dialog_logger = get_root_logger(
+        logger_name='dialog',
+        log_level=logging.INFO,
+        log_file=f'{save_log_path}/train_dialog_policy.log')
+    dialog_logger.info(dict2str(opt))
+
+    save_image_path = f'{opt["path"]["visualization"]}'
+    os.makedirs(save_image_path)
+    init_image_writer(opt['image_writer'])
+
+    # ---------- Load files -----------
+    dialog_logger.info('loading template files')
+    with open(opt['feedback_templates_file'], 'r') as f:
+        args.feedback_templates = json.load(f)
+        args.feedback_replacement = args.feedback_templates['replacement']
+    with open(opt['pool_file'], 'r') as f:
+        pool = json.load(f)
+        args.synonyms_dict = pool["synonyms"]
+
+    # ---------- load language encoder ----------
+    dialog_logger.info('loading language encoder')
+    args.encoder_session = EncoderSession(args)
+
+    # ---------- create model ----------
+    field_model = create_model(opt)
+    policy = EditTracker().cuda()
+    optimizer = torch.optim.Adam(policy.parameters(), lr=policy_opt['lr'])
+
+    # ---------- train the policy on simulated dialogs -----------
+    feat_distances, score_distances = [], []
+    for current_iter in range(1, policy_opt['num_iters'] + 1):
+        latent_codes, _ = sample_latent_codes(field_model,
+                                              policy_opt['batch_size'])
+        tgt_latent_codes, tgt_labels = sample_latent_codes(
+            field_model, policy_opt['batch_size'])
+
+        policy.train()
+        _, feat_distance, score_distance, loss, _, _ = \
+            train_with_batch_simulator(
+                field_model,
+                policy,
+                tgt_latent_codes,
+                tgt_labels,
+                latent_codes,
+                opt,
+                args,
+                dialog_logger,
+                train=True,
+                num_rounds=policy_opt['num_rounds'])
+
+        optimizer.zero_grad()
+        # no dialog reaches the policy when all end in the first round
+        if isinstance(loss, torch.Tensor):
+            loss.backward()
+            optimizer.step()
+
+        feat_distances.append(feat_distance[-1])
+        score_distances.append(score_distance[-1])
+        if current_iter % policy_opt['print_freq'] == 0:
+            dialog_logger.info(
+                f'iter: {current_iter}, loss: {float(loss):.4f}, '
+                f'feat_distance: {np.mean(feat_distances):.4f}, '
+                f'score_distance: {np.mean(score_distances):.4f}')
+            feat_distances, score_distances = [], []
+        if current_iter % policy_opt['save_freq'] == 0:
+            torch.save(
+                policy.state_dict(),
+                f'{opt["path"]["results_root"]}/policy_{current_iter}.pth')
+
+    torch.save(policy.state_dict(),
+               f'{opt["path"]["results_root"]}/policy_latest.pth')
+    close_image_writer()
+    dialog_logger.info('successfully end.')
+
+
+if __name__ == '__main__':
+    main()
@@ -2,14 +2,21 @@ import random
 
 import matplotlib.image as mpimg
 import matplotlib.pyplot as plt
+import numpy as np
 import torch
 import torch.nn as nn
 from language.generate_feedback import instantiate_feedback
-from language.run_encoder import encode_request
-from models.utils import save_image
+from language.run_encoder import EncoderSession, encode_request
+from models.utils import flush_image_writer, output_to_labels, save_image
 
 from utils.editing_utils import edit_target_attribute
 
+# probabilities used by decide_next_feedback
+WHETHER_ENOUGH_FIRST_ROUND_PROB = 0.8
+WHATS_NEXT_PROB_LIST = [0.5, 0.4, 0.3, 0.3]
+WHATS_NEXT_DEFAULT_PROB = 0.2
+SUGGESTION_PROB_PER_ATTRIBUTE = 0.2
+
 
 class EditTracker(torch.nn.Module):
     """
@@ -37,8 +44,15 @@ class EditTracker(torch.nn.Module):
             log_prob = None
         return output, state_, log_prob
 
-    def supervised_loss(self, latent, tgt_latent):
-        return self.criterion(latent, tgt_latent)
+    def supervised_loss(self, latent, tgt_latent, mask=None):
+        """
+        MSE of the latent codes, only over the samples of the
+        [batch_size, 1] mask if given
+        """
+        if mask is None:
+            return self.criterion(latent, tgt_latent)
+        squared_error = ((latent - tgt_latent) ** 2 * mask).sum()
+        return squared_error / (mask.sum().clamp(min=1) * latent.size(1))
 
     def reinforce_loss(self, logProb_seq, featDist_seq):
         loss = 0.
@@ -96,6 +110,51 @@ def gen_simulated_query(src_label, tgt_label):
     return outputs, score / 5
 
 
+# simulated user queries, indexed by [attribute][direction > 0]
+SIMULATED_QUERIES = [
+    ['make the bangs shorter', 'make the bangs longer'],
+    ['remove eyeglasses', 'add eyeglasses'],
+    ['remove some beard', 'add more beard'],
+    ['less smiling', 'add more smiling'],
+    ['make it younger', 'make it older'],
+]
+SIMULATED_QUERY_LIST = [
+    query for queries in SIMULATED_QUERIES for query in queries
+] + ['That\'s all']
+
+
+def warm_up_simulated_queries(args):
+    """Load the encoder session onto args if needed and parse the closed set
+    of simulated queries for all the system modes up front, so that the
+    simulated rounds only look them up. Later calls find them parsed.
+    """
+    if getattr(args, 'encoder_session', None) is None:
+        args.encoder_session = EncoderSession(args)
+    args.encoder_session.warm_up(SIMULATED_QUERY_LIST)
+
+
+def gen_simulated_query_batch(src_labels, tgt_labels):
+    """
+    Batched version of gen_simulated_query.
+    Input: src_labels, tgt_labels: [batch_size, num_attr] LongTensor
+    Output: list of queries, scores: [batch_size] FloatTensor
+    """
+    diff = tgt_labels - src_labels
+    # argmax returns the first maximal value, which matches the strict
+    # comparison in gen_simulated_query
+    target_idx = diff.abs().argmax(dim=1)
+    target_num = diff.gather(1, target_idx.unsqueeze(1)).squeeze(1)
+    scores = diff.abs().sum(dim=1).float() / 5
+
+    queries = []
+    for idx, num in zip(target_idx.tolist(), target_num.tolist()):
+        if num == 0:
+            queries.append('That\'s all')
+        else:
+            queries.append(SIMULATED_QUERIES[idx][int(num > 0)])
+    return queries, scores
+
+
 def dialog_with_simulator(field_model,
                           tgt_latent_code,
                           tgt_label,
@@ -106,6 +165,8 @@ def dialog_with_simulator(field_model,
                           dialog_logger,
                           policy=None,
                           display_img=False):
+    warm_up_simulated_queries(args)
+
     # initialize dialog recorder
     state_log = ['start']
     edit_log = []
@@ -129,6 +190,7 @@ def dialog_with_simulator(field_model,
     save_image(start_image, f'{opt["path"]["visualization"]}/start_image.png')
 
     if display_img:
+        flush_image_writer()
         plt.figure()
         plt.imshow(
             mpimg.imread(f'{opt["path"]["visualization"]}/start_image.png'))
@@ -284,6 +346,8 @@ def train_with_simulator(field_model,
                          args,
                          dialog_logger,
                          display_img=False):
+    warm_up_simulated_queries(args)
+
     # initialize dialog recorder
     state_log = ['start']
     edit_log = []
@@ -363,7 +427,9 @@ def train_with_simulator(field_model,
             latent_code,
             edited_latent_code,
             field_model,
-            display_img=display_img)
+            display_img=display_img,
+            # only the labels and latent codes are used for training
+            materialize='final' if display_img else 'none')
         text_image_log.append(attribute_dict.copy())
 
         # #################### POLICY ####################
@@ -433,27 +499,292 @@ def train_with_simulator(field_model,
     return dialog_overall_log, feat_distances, score_distances, loss, feat_dists, log_probs
 
 
-def dialog_with_real_user(field_model,
-                          latent_code,
-                          opt,
-                          args,
-                          dialog_logger,
-                          display_img=False):
-    # initialize dialog recorder
-    state_log = ['start']
-    edit_log = []
-    system_log = [{"text": None, "system_mode": 'start', "attribute": None}]
-    user_log = []
-    not_used_attribute = [
-        'Bangs', "Eyeglasses", "No_Beard", "Smiling", "Young"
-    ]
-    text_log = []
-    text_image_log = []
+def train_with_batch_simulator(field_model,
+                               policy,
+                               tgt_latent_codes,
+                               tgt_labels,
+                               latent_codes,
+                               opt,
+                               args,
+                               dialog_logger,
+                               train=True,
+                               num_rounds=3,
+                               display_img=False):
+    """
+    Advance a batch of simulated dialogs in lockstep.
+
+    Input:
+    - tgt_latent_codes, latent_codes: [batch_size, 512] numpy array
+    - tgt_labels: [batch_size, num_attr] array-like
+    Latent codes, attribute labels and the EditTracker states are kept as
+    batch tensors; dialogs that have ended are masked out of the policy
+    update, so their latent codes (and hence feature distances) stay fixed.
+    The states, edits and feedback modes of the dialogs are decided together
+    with the compiled tables of utils/dialog_fsm.py.
+    """
+    # dialog_fsm compiles its tables from the decide functions of this module
+    from utils import dialog_fsm
+
+    # the batch lives on the device of the policy
+    device = next(policy.parameters()).device
+    batch_size = latent_codes.shape[0]
+    # the feedback of all the dialogs is sampled from one generator, seeded
+    # from the global numpy state so that set_random_seed still applies
+    rng = np.random.default_rng(np.random.randint(2**31))
+
+    warm_up_simulated_queries(args)
+
+    latent_codes = torch.from_numpy(latent_codes).to(device)
+    tgt_latent_codes = torch.from_numpy(tgt_latent_codes).to(device)
+    tgt_labels = torch.as_tensor(tgt_labels, dtype=torch.long, device=device)
+
+    # initialize dialog recorders
+    state_logs = [['start'] for _ in range(batch_size)]
+    edit_logs = [[] for _ in range(batch_size)]
+    system_logs = [[{"text": None, "system_mode": 'start', "attribute": None}]
+                   for _ in range(batch_size)]
+    user_logs = [[] for _ in range(batch_size)]
+    text_logs = [[] for _ in range(batch_size)]
+    not_used_mask = np.ones((batch_size, len(dialog_fsm.ATTRIBUTE_LIST)),
+                            dtype=bool)
+    edited_latent_codes = [None] * batch_size
+
+    # one forward for the start images of the whole batch
+    with torch.no_grad():
+        start_image = field_model.synthesize_image(latent_codes)
+        predictor_output = field_model.predictor(start_image)
+        attr_labels, _ = output_to_labels(predictor_output, to_cpu=False)
+    del start_image
 
-    # initialize first round's variables
-    round_idx = 0
+    active = torch.ones(batch_size, dtype=torch.bool, device=device)
+    loss, log_probs, feat_dists, states = 0., [], [], None
+    feat_distances, score_distances = [], []
+    feat_dists.append((latent_codes - tgt_latent_codes) ** 2)
 
-    edited_latent_code = None
+    for round_idx in range(num_rounds):
+        user_queries, _ = gen_simulated_query_batch(attr_labels, tgt_labels)
+        latent_codes_new = latent_codes.clone()
+        attr_labels_cpu = attr_labels.cpu().numpy()
+
+        # -------------------- TAKE USER INPUT --------------------
+        # the simulated queries are parsed already, this is a lookup
+        active_ids = active.nonzero(as_tuple=False).view(-1).tolist()
+        user_labels_list = [
+            encode_request(
+                args,
+                system_mode=system_logs[dialog_idx][-1]['system_mode'],
+                dialog_logger=dialog_logger,
+                input_request=user_queries[dialog_idx])
+            for dialog_idx in active_ids
+        ]
+        user_modes, user_edits = dialog_fsm.user_labels_to_codes(
+            user_labels_list)
+        has_user_attribute = user_edits['attribute'] != dialog_fsm.NONE
+        not_used_mask[np.array(active_ids)[has_user_attribute],
+                      user_edits['attribute'][has_user_attribute]] = False
+
+        # #################### DECIDE STATE ####################
+        system_modes = np.array([
+            dialog_fsm.SYSTEM_MODE_TO_IDX[system_logs[dialog_idx][-1]
+                                          ['system_mode']]
+            for dialog_idx in active_ids
+        ])
+        system_attributes = np.array([
+            dialog_fsm.to_code(system_logs[dialog_idx][-1]['attribute'],
+                               dialog_fsm.ATTRIBUTE_TO_IDX)
+            for dialog_idx in active_ids
+        ])
+        fsm_states = dialog_fsm.decide_next_state_batch(
+            np.array([
+                dialog_fsm.STATE_TO_IDX[state_logs[dialog_idx][-1]]
+                for dialog_idx in active_ids
+            ]), system_modes, user_modes)
+
+        is_end = fsm_states == dialog_fsm.STATE_TO_IDX['end']
+        for dialog_idx, user_labels in zip(
+                np.array(active_ids)[is_end].tolist(),
+                [user_labels_list[i] for i in np.flatnonzero(is_end)]):
+            user_logs[dialog_idx].append(user_labels)
+            state_logs[dialog_idx].append('end')
+            text_logs[dialog_idx].append('USER:   ' + user_labels['text'])
+            active[dialog_idx] = False
+
+        # #################### DECIDE EDIT ####################
+        going = ~is_end
+        going_ids = np.array(active_ids)[going].tolist()
+        edits = dialog_fsm.decide_next_edit_batch(
+            fsm_states[going], system_modes[going], user_modes[going],
+            np.array([len(edit_logs[dialog_idx]) > 0
+                      for dialog_idx in going_ids]),
+            {key: value[going]
+             for key, value in user_edits.items()},
+            dialog_fsm.edit_labels_to_codes([
+                edit_logs[dialog_idx][-1] if edit_logs[dialog_idx] else None
+                for dialog_idx in going_ids
+            ]), system_attributes[going], attr_labels_cpu[going_ids])
+        turns = {
+            dialog_idx: {
+                'user_labels': user_labels_list[active_idx],
+                'state': dialog_fsm.STATE_LIST[fsm_states[active_idx]],
+                'edit_labels': edit_labels,
+                'exception_mode': 'normal'
+            }
+            for dialog_idx, active_idx, edit_labels in zip(
+                going_ids,
+                np.flatnonzero(going).tolist(),
+                dialog_fsm.edit_codes_to_labels(edits))
+        }
+
+        # #################### EDIT ####################
+        # the dialogs that edit an attribute are edited together, one
+        # generator and predictor forward per step for all of them
+        edit_ids = [
+            dialog_idx for dialog_idx, turn in turns.items()
+            if turn['edit_labels']['attribute'] is not None
+        ]
+        if len(edit_ids) > 0:
+            image_paths = []
+            edit_results = field_model.continuous_editing_with_target_batch(
+                latent_codes[torch.tensor(edit_ids, device=device)],
+                [edited_latent_codes[dialog_idx] for dialog_idx in edit_ids],
+                [
+                    turns[dialog_idx]['edit_labels']['attribute']
+                    for dialog_idx in edit_ids
+                ], [
+                    turns[dialog_idx]['edit_labels']['target_score']
+                    for dialog_idx in edit_ids
+                ],
+                save_dir=opt['path']['visualization'],
+                prefix=f'edit_order_{round_idx}',
+                # only the labels and latent codes are used for training
+                materialize='final' if display_img else 'none',
+                image_paths=image_paths)
+            for dialog_idx, latent_code_new, edited_latent_code, label, \
+                    exception_mode in zip(edit_ids, *edit_results):
+                latent_codes_new[dialog_idx] = latent_code_new[0]
+                edited_latent_codes[dialog_idx] = edited_latent_code
+                attr_labels[dialog_idx] = torch.as_tensor(
+                    [int(attr_label) for attr_label in label], device=device)
+                turns[dialog_idx]['exception_mode'] = exception_mode
+            if display_img:
+                flush_image_writer()
+                for image_path in image_paths:
+                    plt.figure()
+                    plt.imshow(mpimg.imread(image_path))
+                    plt.axis('off')
+                    plt.show()
+
+        # #################### DECIDE SYSTEM ####################
+        feedback_modes, feedback_attributes = \
+            dialog_fsm.decide_next_feedback_batch(
+                fsm_states[going], system_modes[going], user_modes[going],
+                round_idx, not_used_mask[going_ids],
+                np.array([
+                    turns[dialog_idx]['exception_mode'] != 'normal'
+                    for dialog_idx in going_ids
+                ], dtype=bool), user_edits['attribute'][going],
+                edits['attribute'], system_attributes[going], rng)
+        for dialog_idx, feedback_mode, feedback_attribute in zip(
+                going_ids, feedback_modes.tolist(),
+                feedback_attributes.tolist()):
+            turn = turns[dialog_idx]
+            system_labels = instantiate_feedback(
+                args,
+                system_mode=dialog_fsm.SYSTEM_MODE_LIST[feedback_mode],
+                attribute=dialog_fsm.from_code(feedback_attribute,
+                                               dialog_fsm.ATTRIBUTE_LIST),
+                exception_mode=turn['exception_mode'])
+            if system_labels['attribute'] is not None:
+                not_used_mask[dialog_idx, dialog_fsm.ATTRIBUTE_TO_IDX[
+                    system_labels['attribute']]] = False
+
+            # -------------------- UPDATE LOG --------------------
+            state_logs[dialog_idx].append(turn['state'])
+            edit_logs[dialog_idx].append(turn['edit_labels'])
+            system_logs[dialog_idx].append(system_labels)
+            user_logs[dialog_idx].append(turn['user_labels'])
+            text_logs[dialog_idx].append('USER:   ' +
+                                         turn['user_labels']['text'])
+            text_logs[dialog_idx].append('SYSTEM: ' + system_labels['text'])
+            text_logs[dialog_idx].append('')
+
+        # #################### POLICY ####################
+        # one policy step for the whole batch, ended dialogs are masked out
+        mask = active.view(batch_size, 1).float()
+        with torch.set_grad_enabled(train):
+            edit_code, new_states, log_prob = policy(
+                (latent_codes_new - latent_codes).unsqueeze(1),
+                states,
+                train=train)
+        if states is None:
+            states = new_states
+        else:
+            states = tuple(
+                torch.where(active.view(1, batch_size, 1), new_state, state)
+                for new_state, state in zip(new_states, states))
+        latent_codes = latent_codes + edit_code[:, 0] / 20 * mask
+
+        if train:
+            log_probs.append(log_prob[:, 0] * mask)
+            loss = loss + policy.supervised_loss(latent_codes,
+                                                 tgt_latent_codes, mask)
+        feat_dists.append((latent_codes.detach().clone() -
+                           tgt_latent_codes) ** 2)
+        latent_codes = latent_codes.detach()
+
+        # -------------------- UPDATE Metric --------------------
+        _, scores = gen_simulated_query_batch(attr_labels, tgt_labels)
+        feat_distances.append(feat_dists[-1].mean(dim=1).cpu().numpy())
+        score_distances.append(scores.cpu().numpy())
+
+        if not active.any():
+            break
+
+    # pad the metrics of dialogs ended before the last round
+    while len(feat_distances) < num_rounds:
+        feat_distances.append(feat_distances[-1])
+        score_distances.append(score_distances[-1])
+
+    dialog_overall_logs = [{
+        'state_log': state_logs[dialog_idx],
+        'edit_log': edit_logs[dialog_idx],
+        'system_log': system_logs[dialog_idx],
+        'user_log': user_logs[dialog_idx],
+        'text_log': text_logs[dialog_idx],
+    } for dialog_idx in range(batch_size)]
+    dialog_logger.info(f'{batch_size} dialogs successfully ended.')
+
+    return dialog_overall_logs, feat_distances, score_distances, loss, feat_dists, log_probs
+
+
+def init_dialog(field_model,
+                latent_code,
+                opt,
+                dialog_logger,
+                display_img=False):
+    """
+    Synthesize the start image and initialize the dialog recorder.
+    Output: dialog dict holding the logs, latent codes and attribute labels
+    """
+    # initialize dialog recorder
+    dialog = {
+        'state_log': ['start'],
+        'edit_log': [],
+        'system_log': [{
+            "text": None,
+            "system_mode": 'start',
+            "attribute": None
+        }],
+        'user_log': [],
+        'not_used_attribute':
+        ['Bangs', "Eyeglasses", "No_Beard", "Smiling", "Young"],
+        'text_log': [],
+        'text_image_log': [],
+        # initialize first round's variables
+        'round_idx': 0,
+        'latent_code': latent_code,
+        'edited_latent_code': None
+    }
 
     with torch.no_grad():
         start_image, start_label, start_score = \
@@ -462,6 +793,7 @@ def dialog_with_real_user(field_model,
     save_image(start_image, f'{opt["path"]["visualization"]}/start_image.png')
 
     if display_img:
+        flush_image_writer()
         plt.figure()
         plt.imshow(
             mpimg.imread(f'{opt["path"]["visualization"]}/start_image.png'))
@@ -469,116 +801,156 @@ def dialog_with_real_user(field_model,
         plt.show()
 
     # initialize attribtue_dict
-    attribute_dict = {
+    dialog['attribute_dict'] = {
         "Bangs": start_label[0],
         "Eyeglasses": start_label[1],
         "No_Beard": start_label[2],
         "Smiling": start_label[3],
         "Young": start_label[4],
     }
-    dialog_logger.info('START IMAGE  >>> ' + str(attribute_dict))
+    dialog_logger.info('START IMAGE  >>> ' + str(dialog['attribute_dict']))
+
+    return dialog
+
+
+def dialog_turn(field_model,
+                dialog,
+                user_labels,
+                opt,
+                args,
+                dialog_logger,
+                display_img=False,
+                image_paths=None):
+    """
+    Advance the dialog by one round, given the encoded user request.
+    Output: system labels of the round, None if the user ends the dialog
+    image_paths: list the paths of the images of the round are appended to
+    """
+    dialog['text_image_log'].append('USER:   ' + user_labels['text'])
+
+    # update not_used_attribute
+    if user_labels['attribute'] in dialog['not_used_attribute']:
+        dialog['not_used_attribute'].remove(user_labels['attribute'])
+
+    # #################### DECIDE STATE ####################
+    state = decide_next_state(
+        state=dialog['state_log'][-1],
+        system_mode=dialog['system_log'][-1]['system_mode'],
+        user_mode=user_labels['user_mode'])
+
+    if state == 'end':
+        dialog['user_log'].append(user_labels)
+        dialog['state_log'].append(state)
+        dialog['text_log'].append('USER:   ' + user_labels['text'])
+        return None
+
+    # #################### DECIDE EDIT ####################
+    edit_labels = decide_next_edit(
+        edit_log=dialog['edit_log'],
+        system_labels=dialog['system_log'][-1],
+        user_labels=user_labels,
+        state=state,
+        attribute_dict=dialog['attribute_dict'],
+        dialog_logger=dialog_logger)
+
+    dialog['text_image_log'].append(edit_labels)
+
+    attribute_dict, exception_mode, dialog['latent_code'], dialog['edited_latent_code'] = edit_target_attribute(  # noqa
+        opt,
+        dialog['attribute_dict'],
+        edit_labels,
+        dialog['round_idx'],
+        dialog['latent_code'],
+        dialog['edited_latent_code'],
+        field_model,
+        display_img=display_img,
+        image_paths=image_paths)
+    if state == 'no_edit':
+        dialog_logger.info('NO EDIT  >>> ' + str(attribute_dict))
+    else:
+        dialog_logger.info('UPDATED IMAGE >>> ' + str(attribute_dict))
+    dialog['text_image_log'].append(attribute_dict.copy())
+
+    # #################### DECIDE SYSTEM ####################
+    # decide system feedback hard labels
+    temp_system_labels = decide_next_feedback(
+        system_labels=dialog['system_log'][-1],
+        user_labels=user_labels,
+        state=state,
+        edit_labels=edit_labels,
+        not_used_attribute=dialog['not_used_attribute'],
+        round_idx=dialog['round_idx'],
+        exception_mode=exception_mode)
+
+    # instantiate feedback
+    system_labels = instantiate_feedback(
+        args,
+        system_mode=temp_system_labels['system_mode'],
+        attribute=temp_system_labels['attribute'],
+        exception_mode=exception_mode)
+
+    dialog_logger.info('SYSTEM FEEDBACK >>> ' + system_labels['text'])
+
+    # update not_used_attribute
+    if system_labels['attribute'] in dialog['not_used_attribute']:
+        dialog['not_used_attribute'].remove(system_labels['attribute'])
+
+    # -------------------- UPDATE LOG --------------------
+    dialog['state_log'].append(state)
+    dialog['edit_log'].append(edit_labels)
+    dialog['system_log'].append(system_labels)
+    dialog['user_log'].append(user_labels)
+    dialog['text_log'].append('USER:   ' + user_labels['text'])
+    dialog['text_log'].append('SYSTEM: ' + system_labels['text'])
+    dialog['text_log'].append('')
+    dialog['text_image_log'].append('SYSTEM: ' + system_labels['text'])
+    dialog['text_image_log'].append('')
+
+    dialog['round_idx'] += 1
+
+    return system_labels
+
+
+DIALOG_LOG_KEYS = [
+    'state_log', 'edit_log', 'system_log', 'user_log', 'text_log',
+    'text_image_log'
+]
+
+
+def dialog_with_real_user(field_model,
+                          latent_code,
+                          opt,
+                          args,
+                          dialog_logger,
+                          display_img=False):
+    dialog = init_dialog(
+        field_model, latent_code, opt, dialog_logger, display_img=display_img)
 
     while True:
 
         dialog_logger.info('\n---------------------------------------- Edit ' +
-                           str(round_idx) +
+                           str(dialog['round_idx']) +
                            '----------------------------------------\n')
 
         # -------------------- TAKE USER INPUT --------------------
         # understand user input
         user_labels = encode_request(
             args,
-            system_mode=system_log[-1]['system_mode'],
+            system_mode=dialog['system_log'][-1]['system_mode'],
             dialog_logger=dialog_logger)
-        text_image_log.append('USER:   ' + user_labels['text'])
 
-        # update not_used_attribute
-        if user_labels['attribute'] in not_used_attribute:
-            not_used_attribute.remove(user_labels['attribute'])
-
-        # #################### DECIDE STATE ####################
-        state = decide_next_state(
-            state=state_log[-1],
-            system_mode=system_log[-1]['system_mode'],
-            user_mode=user_labels['user_mode'])
-
-        if state == 'end':
-            user_log.append(user_labels)
-            state_log.append(state)
-            text_log.append('USER:   ' + user_labels['text'])
-            break
-
-        # #################### DECIDE EDIT ####################
-        edit_labels = decide_next_edit(
-            edit_log=edit_log,
-            system_labels=system_log[-1],
-            user_labels=user_labels,
-            state=state,
-            attribute_dict=attribute_dict,
-            dialog_logger=dialog_logger)
-
-        text_image_log.append(edit_labels)
-
-        attribute_dict, exception_mode, latent_code, edited_latent_code = edit_target_attribute(  # noqa
-            opt,
-            attribute_dict,
-            edit_labels,
-            round_idx,
-            latent_code,
-            edited_latent_code,
+        system_labels = dialog_turn(
             field_model,
-            display_img=display_img)
-        if state == 'no_edit':
-            dialog_logger.info('NO EDIT  >>> ' + str(attribute_dict))
-        else:
-            dialog_logger.info('UPDATED IMAGE >>> ' + str(attribute_dict))
-        text_image_log.append(attribute_dict.copy())
-
-        # #################### DECIDE SYSTEM ####################
-        # decide system feedback hard labels
-        temp_system_labels = decide_next_feedback(
-            system_labels=system_log[-1],
-            user_labels=user_labels,
-            state=state,
-            edit_labels=edit_labels,
-            not_used_attribute=not_used_attribute,
-            round_idx=round_idx,
-            exception_mode=exception_mode)
-
-        # instantiate feedback
-        system_labels = instantiate_feedback(
+            dialog,
+            user_labels,
+            opt,
             args,
-            system_mode=temp_system_labels['system_mode'],
-            attribute=temp_system_labels['attribute'],
-            exception_mode=exception_mode)
-
-        dialog_logger.info('SYSTEM FEEDBACK >>> ' + system_labels['text'])
-
-        # update not_used_attribute
-        if system_labels['attribute'] in not_used_attribute:
-            not_used_attribute.remove(system_labels['attribute'])
-
-        # -------------------- UPDATE LOG --------------------
-        state_log.append(state)
-        edit_log.append(edit_labels)
-        system_log.append(system_labels)
-        user_log.append(user_labels)
-        text_log.append('USER:   ' + user_labels['text'])
-        text_log.append('SYSTEM: ' + system_labels['text'])
-        text_log.append('')
-        text_image_log.append('SYSTEM: ' + system_labels['text'])
-        text_image_log.append('')
-
-        round_idx += 1
+            dialog_logger,
+            display_img=display_img)
+        if system_labels is None:
+            break
 
-    dialog_overall_log = {
-        'state_log': state_log,
-        'edit_log': edit_log,
-        'system_log': system_log,
-        'user_log': user_log,
-        'text_log': text_log,
-        'text_image_log': text_image_log
-    }
+    dialog_overall_log = {key: dialog[key] for key in DIALOG_LOG_KEYS}
     dialog_logger.info('Dialog successfully ended.')
 
     return dialog_overall_log
@@ -806,7 +1178,7 @@ def decide_next_feedback(system_labels, user_labels, state, edit_labels,
         # first round has higher chance for whether_enough
         whether_enough_random_num = random.uniform(0, 1)
         if round_idx == 0:
-            whether_enough_prob = 0.8
+            whether_enough_prob = WHETHER_ENOUGH_FIRST_ROUND_PROB
             if whether_enough_random_num < whether_enough_prob:
                 system_mode = 'whether_enough'
                 if state == 'no_edit':
@@ -819,11 +1191,10 @@ def decide_next_feedback(system_labels, user_labels, state, edit_labels,
         # higher chance at earlier rounds
         if system_mode is None:
             whats_next_random_num = random.uniform(0, 1)
-            whats_next_prob_list = [0.5, 0.4, 0.3, 0.3]
-            if round_idx <= 3:
-                whats_next_prob = whats_next_prob_list[round_idx]
+            if round_idx < len(WHATS_NEXT_PROB_LIST):
+                whats_next_prob = WHATS_NEXT_PROB_LIST[round_idx]
             else:
-                whats_next_prob = 0.2
+                whats_next_prob = WHATS_NEXT_DEFAULT_PROB
             if whats_next_random_num < whats_next_prob:
                 system_mode = 'whats_next'
                 feedback_attribute = None
@@ -832,7 +1203,8 @@ def decide_next_feedback(system_labels, user_labels, state, edit_labels,
         # if a lot of attribute has been edited, don't be suggestion
         if system_mode is None:
             suggestion_random_num = random.uniform(0, 1)
-            suggestion_prob = len(not_used_attribute) * 0.2
+            suggestion_prob = len(
+                not_used_attribute) * SUGGESTION_PROB_PER_ATTRIBUTE
             if suggestion_random_num < suggestion_prob:
                 system_mode = 'suggestion'
                 if len(not_used_attribute) > 0:
@@ -0,0 +1,437 @@
+"""
+Table-compiled dialog manager.
+
+The string-based decide_next_state / decide_next_edit / decide_next_feedback
+in utils/dialog_edit_utils.py stay the reference implementation. Here they
+are enumerated once into integer-coded transition and probability tables,
+so that the next states, edits and feedback modes of many dialogs can be
+computed as NumPy operations.
+
+Codes:
+- state: index in STATE_LIST
+- system_mode: index in SYSTEM_MODE_LIST (same as system_mode.json)
+- user_mode: index in USER_MODE_LIST
+- attribute: index in ATTRIBUTE_LIST (same as metadata_fsm.json)
+- request_mode: index in REQUEST_MODE_LIST (same as metadata_fsm.json)
+- direction: 1 for positive, -1 for negative, 0 for None
+- NONE (-1) for missing attribute / value / target_score / transitions
+"""
+
+import numpy as np
+
+from utils.dialog_edit_utils import (SUGGESTION_PROB_PER_ATTRIBUTE,
+                                     WHATS_NEXT_DEFAULT_PROB,
+                                     WHATS_NEXT_PROB_LIST,
+                                     WHETHER_ENOUGH_FIRST_ROUND_PROB,
+                                     decide_next_edit, decide_next_state)
+
+NONE = -1
+
+STATE_LIST = ['start', 'edit', 'no_edit', 'end']
+SYSTEM_MODE_LIST = ['start', 'suggestion', 'whether_enough', 'whats_next']
+USER_MODE_LIST = [
+    'start_pureRequest', 'yes', 'yes_pureRequest', 'yes_end', 'no',
+    'no_pureRequest', 'no_end', 'pureRequest', 'end'
+]
+ATTRIBUTE_LIST = ['Bangs', 'Eyeglasses', 'No_Beard', 'Smiling', 'Young']
+REQUEST_MODE_LIST = ['change_definite', 'change_indefinite', 'target', 'end']
+
+STATE_TO_IDX = {name: idx for idx, name in enumerate(STATE_LIST)}
+SYSTEM_MODE_TO_IDX = {name: idx for idx, name in enumerate(SYSTEM_MODE_LIST)}
+USER_MODE_TO_IDX = {name: idx for idx, name in enumerate(USER_MODE_LIST)}
+ATTRIBUTE_TO_IDX = {name: idx for idx, name in enumerate(ATTRIBUTE_LIST)}
+REQUEST_MODE_TO_IDX = {
+    name: idx
+    for idx, name in enumerate(REQUEST_MODE_LIST)
+}
+
+# where the attribute of the next edit comes from
+EDIT_NONE = 0
+EDIT_USER = 1
+EDIT_CONTINUE = 2
+EDIT_SUGGESTION = 3
+
+# outcomes of the random feedback decision
+FEEDBACK_WHATS_NEXT = 0
+FEEDBACK_SUGGESTION = 1
+FEEDBACK_WHETHER_ENOUGH_USER = 2
+FEEDBACK_WHETHER_ENOUGH_EDIT = 3
+
+MIN_SCORE = 0
+MAX_SCORE = 5
+
+DIRECTION_TO_CODE = {'positive': 1, 'negative': -1, None: 0}
+CODE_TO_DIRECTION = {code: name for name, code in DIRECTION_TO_CODE.items()}
+
+
+def compile_next_state_table():
+    """
+    Enumerate decide_next_state into a
+    [num_state, num_system_mode, num_user_mode] table of next states.
+    """
+    table = np.full(
+        (len(STATE_LIST), len(SYSTEM_MODE_LIST), len(USER_MODE_LIST)),
+        NONE,
+        dtype=np.int64)
+    for state_idx, state in enumerate(STATE_LIST):
+        for system_idx, system_mode in enumerate(SYSTEM_MODE_LIST):
+            for user_idx, user_mode in enumerate(USER_MODE_LIST):
+                try:
+                    next_state = decide_next_state(state, system_mode,
+                                                   user_mode)
+                except (AssertionError, ValueError, UnboundLocalError):
+                    continue
+                table[state_idx, system_idx,
+                      user_idx] = STATE_TO_IDX[next_state]
+    return table
+
+
+def compile_edit_source_table():
+    """
+    Enumerate decide_next_edit into a
+    [num_state, num_system_mode, num_user_mode, has_edit_log] table of
+    where the attribute of the next edit comes from.
+    """
+    # distinct dummy attributes reveal which branch has been taken
+    source_of_attribute = {
+        None: EDIT_NONE,
+        'Bangs': EDIT_USER,
+        'Eyeglasses': EDIT_CONTINUE,
+        'No_Beard': EDIT_SUGGESTION
+    }
+    previous_edit = {
+        'attribute': 'Eyeglasses',
+        'score_change_direction': 'negative',
+        'score_change_value': 1,
+        'target_score': None
+    }
+    attribute_dict = {attr: 1 for attr in ATTRIBUTE_LIST}
+
+    table = np.full((len(STATE_LIST), len(SYSTEM_MODE_LIST),
+                     len(USER_MODE_LIST), 2),
+                    NONE,
+                    dtype=np.int64)
+    for state_idx, state in enumerate(STATE_LIST):
+        for system_idx, system_mode in enumerate(SYSTEM_MODE_LIST):
+            for user_idx, user_mode in enumerate(USER_MODE_LIST):
+                for has_edit_log in range(2):
+                    user_labels = {
+                        'user_mode': user_mode,
+                        'request_mode': 'change_indefinite',
+                        'attribute': 'Bangs',
+                        'score_change_direction': 'positive',
+                        'score_change_value': None,
+                        'target_score': None
+                    }
+                    system_labels = {
+                        'system_mode': system_mode,
+                        'attribute': 'No_Beard'
+                    }
+                    edit_log = [previous_edit] if has_edit_log else []
+                    try:
+                        edit_labels = decide_next_edit(
+                            edit_log, system_labels, user_labels, state,
+                            attribute_dict, None)
+                    except (AssertionError, ValueError):
+                        continue
+                    table[state_idx, system_idx, user_idx,
+                          has_edit_log] = source_of_attribute[
+                              edit_labels['attribute']]
+    return table
+
+
+def compile_feedback_prob_table():
+    """
+    Closed form of the rejection sampling loop in decide_next_feedback:
+    a [num_state, num_round_bucket, num_attr + 1, num_outcome] table of
+    outcome probabilities, indexed by the state, min(round_idx,
+    len(WHATS_NEXT_PROB_LIST)) and the number of not used attributes.
+    """
+    num_round_bucket = len(WHATS_NEXT_PROB_LIST) + 1
+    table = np.zeros(
+        (len(STATE_LIST), num_round_bucket, len(ATTRIBUTE_LIST) + 1, 4))
+    for round_bucket in range(num_round_bucket):
+        if round_bucket < len(WHATS_NEXT_PROB_LIST):
+            whats_next_prob = WHATS_NEXT_PROB_LIST[round_bucket]
+        else:
+            whats_next_prob = WHATS_NEXT_DEFAULT_PROB
+        if round_bucket == 0:
+            whether_enough_prob = WHETHER_ENOUGH_FIRST_ROUND_PROB
+        else:
+            whether_enough_prob = 0
+        for num_not_used in range(len(ATTRIBUTE_LIST) + 1):
+            suggestion_prob = min(
+                1, num_not_used * SUGGESTION_PROB_PER_ATTRIBUTE)
+
+            rest_prob = 1 - whether_enough_prob
+            edit_prob = np.array([
+                rest_prob * whats_next_prob,
+                rest_prob * (1 - whats_next_prob) * suggestion_prob,
+                whether_enough_prob,
+                rest_prob * (1 - whats_next_prob) * (1 - suggestion_prob)
+            ])
+            table[STATE_TO_IDX['edit'], round_bucket, num_not_used] = \
+                edit_prob
+
+            # whether_enough is rejected and resampled for no_edit
+            no_edit_prob = np.array([
+                whats_next_prob, (1 - whats_next_prob) * suggestion_prob, 0,
+                0
+            ])
+            table[STATE_TO_IDX['no_edit'], round_bucket, num_not_used] = \
+                no_edit_prob / no_edit_prob.sum()
+    return table
+
+
+def to_code(name, name_to_idx):
+    return NONE if name is None else name_to_idx[name]
+
+
+def from_code(code, name_list):
+    return None if code == NONE else name_list[code]
+
+
+def user_labels_to_codes(user_labels_list):
+    """
+    Input: list of N user labels parsed by encode_request
+    Output: [N] user_modes, dict of [N] arrays with keys 'request_mode',
+    'attribute', 'direction', 'value', 'target' (see decide_next_edit_batch)
+    """
+    user_modes = np.array([
+        USER_MODE_TO_IDX[user_labels['user_mode']]
+        for user_labels in user_labels_list
+    ],
+                          dtype=np.int64)
+    user_edits = {
+        'request_mode':
+        np.array([
+            to_code(user_labels['request_mode'], REQUEST_MODE_TO_IDX)
+            for user_labels in user_labels_list
+        ],
+                 dtype=np.int64),
+        'attribute':
+        np.array([
+            to_code(user_labels['attribute'], ATTRIBUTE_TO_IDX)
+            for user_labels in user_labels_list
+        ],
+                 dtype=np.int64),
+        'direction':
+        np.array([
+            DIRECTION_TO_CODE[user_labels['score_change_direction']]
+            for user_labels in user_labels_list
+        ],
+                 dtype=np.int64),
+        'value':
+        np.array([
+            NONE if user_labels['score_change_value'] is None else
+            user_labels['score_change_value']
+            for user_labels in user_labels_list
+        ],
+                 dtype=np.int64),
+        'target':
+        np.array([
+            NONE if user_labels['target_score'] is None else
+            user_labels['target_score'] for user_labels in user_labels_list
+        ],
+                 dtype=np.int64)
+    }
+    return user_modes, user_edits
+
+
+def edit_labels_to_codes(edit_labels_list):
+    """
+    Input: list of N edit labels, None for dialogs without an edit yet
+    Output: dict of [N] arrays with keys 'attribute', 'direction'
+    """
+    edit_labels_list = [
+        edit_labels or {
+            'attribute': None,
+            'score_change_direction': None
+        } for edit_labels in edit_labels_list
+    ]
+    return {
+        'attribute':
+        np.array([
+            to_code(edit_labels['attribute'], ATTRIBUTE_TO_IDX)
+            for edit_labels in edit_labels_list
+        ],
+                 dtype=np.int64),
+        'direction':
+        np.array([
+            DIRECTION_TO_CODE[edit_labels['score_change_direction']]
+            for edit_labels in edit_labels_list
+        ],
+                 dtype=np.int64)
+    }
+
+
+def edit_codes_to_labels(edits):
+    """
+    Input: dict of [N] arrays returned by decide_next_edit_batch
+    Output: list of N edit labels as returned by decide_next_edit
+    """
+    edit_labels_list = []
+    for attribute, direction, value, target in zip(
+            edits['attribute'].tolist(), edits['direction'].tolist(),
+            edits['value'].tolist(), edits['target'].tolist()):
+        if attribute == NONE:
+            direction, value, target = 0, NONE, NONE
+        edit_labels_list.append({
+            'attribute': from_code(attribute, ATTRIBUTE_LIST),
+            'score_change_direction': CODE_TO_DIRECTION[direction],
+            'score_change_value': None if value == NONE else value,
+            'target_score': None if target == NONE else target
+        })
+    return edit_labels_list
+
+
+NEXT_STATE_TABLE = compile_next_state_table()
+EDIT_SOURCE_TABLE = compile_edit_source_table()
+FEEDBACK_PROB_TABLE = compile_feedback_prob_table()
+FEEDBACK_CUM_PROB_TABLE = np.cumsum(FEEDBACK_PROB_TABLE, axis=-1)
+FEEDBACK_CUM_PROB_TABLE[..., -1] = 1
+
+
+def decide_next_state_batch(states, system_modes, user_modes):
+    """
+    Input: [N] integer arrays of state, system_mode, user_mode
+    Output: [N] next states
+    """
+    next_states = NEXT_STATE_TABLE[states, system_modes, user_modes]
+    if (next_states == NONE).any():
+        raise ValueError('invalid state transition')
+    return next_states
+
+
+def decide_next_edit_batch(states, system_modes, user_modes, has_edit_log,
+                           user_edits, previous_edits, system_attributes,
+                           attr_labels):
+    """
+    Input:
+    - states, system_modes, user_modes, has_edit_log: [N] integer arrays
+    - user_edits: dict of [N] arrays with keys 'request_mode', 'attribute',
+      'direction', 'value', 'target' parsed from the user request
+    - previous_edits: dict of [N] arrays with keys 'attribute', 'direction'
+    - system_attributes: [N] attribute of the previous system feedback
+    - attr_labels: [N, num_attr] current attribute labels
+    Output: dict of [N] arrays with keys 'attribute', 'direction', 'value',
+    'target'
+    """
+    attr_labels = np.asarray(attr_labels)
+    system_attributes = np.asarray(system_attributes)
+    num = attr_labels.shape[0]
+    source = EDIT_SOURCE_TABLE[states, system_modes, user_modes,
+                               np.asarray(has_edit_log).astype(np.int64)]
+    if (source == NONE).any():
+        raise ValueError('invalid dialog state for edit')
+
+    attribute = np.full(num, NONE, dtype=np.int64)
+    direction = np.zeros(num, dtype=np.int64)
+    value = np.full(num, NONE, dtype=np.int64)
+    target = np.full(num, NONE, dtype=np.int64)
+
+    # edit according to user request
+    is_user = source == EDIT_USER
+    attribute[is_user] = user_edits['attribute'][is_user]
+    direction[is_user] = user_edits['direction'][is_user]
+    value[is_user] = user_edits['value'][is_user]
+    target[is_user] = user_edits['target'][is_user]
+    value[is_user & (user_edits['request_mode'] ==
+                     REQUEST_MODE_TO_IDX['change_indefinite'])] = 1
+
+    # continue the previous edit
+    is_continue = source == EDIT_CONTINUE
+    attribute[is_continue] = previous_edits['attribute'][is_continue]
+    direction[is_continue] = previous_edits['direction'][is_continue]
+    value[is_continue] = 1
+
+    # play with the suggested attribute
+    is_suggestion = source == EDIT_SUGGESTION
+    attribute[is_suggestion] = system_attributes[is_suggestion]
+    value[is_suggestion] = 1
+
+    has_attribute = attribute != NONE
+    current = attr_labels[np.arange(num),
+                          np.where(has_attribute, attribute, 0)]
+    direction[is_suggestion] = np.where(current[is_suggestion] <= 2, 1, -1)
+
+    # fill in all the values
+    has_target = has_attribute & (target != NONE)
+    direction[has_target] = np.sign(target - current)[has_target]
+    value[has_target] = np.abs(target - current)[has_target]
+
+    has_direction = has_attribute & ~has_target & (direction != 0)
+    target[has_direction] = (current + direction * value)[has_direction]
+    # boundary value checking
+    clipped = has_direction & ((target > MAX_SCORE) | (target < MIN_SCORE))
+    target[clipped] = np.clip(target, MIN_SCORE, MAX_SCORE)[clipped]
+    value[clipped] = np.abs(target - current)[clipped]
+
+    return {
+        'attribute': attribute,
+        'direction': direction,
+        'value': value,
+        'target': target
+    }
+
+
+def decide_next_feedback_batch(states, system_modes, user_modes, round_idx,
+                               not_used_mask, exception, user_attributes,
+                               edit_attributes, system_attributes, rng):
+    """
+    Input:
+    - states, system_modes, user_modes: [N] integer arrays
+    - round_idx: int or [N] integer array
+    - not_used_mask: [N, num_attr] bool array of the not used attributes
+    - exception: [N] bool array, whether exception_mode is not 'normal'
+    - user_attributes, edit_attributes, system_attributes: [N] attributes
+      of the user request, the current edit and the previous feedback
+    - rng: np.random.Generator
+    Output: [N] system_modes, [N] feedback attributes
+    """
+    states = np.asarray(states)
+    system_modes = np.asarray(system_modes)
+    user_modes = np.asarray(user_modes)
+    system_attributes = np.asarray(system_attributes)
+    num = states.shape[0]
+    if not np.isin(states, [STATE_TO_IDX['edit'],
+                            STATE_TO_IDX['no_edit']]).all():
+        raise ValueError('invalid state for feedback')
+
+    round_bucket = np.minimum(
+        np.broadcast_to(round_idx, (num, )), len(WHATS_NEXT_PROB_LIST))
+    num_not_used = np.asarray(not_used_mask).sum(axis=1)
+    cum_prob = FEEDBACK_CUM_PROB_TABLE[states, round_bucket, num_not_used]
+    outcome = (rng.random(num)[:, None] >= cum_prob).sum(axis=1)
+    outcome = np.minimum(outcome, FEEDBACK_WHETHER_ENOUGH_EDIT)
+
+    # uniformly pick one of the not used attributes for suggestion
+    keys = rng.random(np.shape(not_used_mask))
+    keys[~np.asarray(not_used_mask, dtype=bool)] = -1
+    suggested_attributes = keys.argmax(axis=1)
+
+    outcome_to_system_mode = np.array([
+        SYSTEM_MODE_TO_IDX['whats_next'], SYSTEM_MODE_TO_IDX['suggestion'],
+        SYSTEM_MODE_TO_IDX['whether_enough'],
+        SYSTEM_MODE_TO_IDX['whether_enough']
+    ])
+    next_system_modes = outcome_to_system_mode[outcome]
+    attribute_choices = np.stack([
+        np.full(num, NONE), suggested_attributes, user_attributes,
+        edit_attributes
+    ],
+                                 axis=1)
+    attributes = attribute_choices[np.arange(num), outcome]
+
+    # suggestion accepted: ask whether the suggested edit is enough
+    suggestion_yes = (system_modes == SYSTEM_MODE_TO_IDX['suggestion']) & (
+        user_modes == USER_MODE_TO_IDX['yes'])
+    next_system_modes[suggestion_yes] = SYSTEM_MODE_TO_IDX['whether_enough']
+    attributes[suggestion_yes] = system_attributes[suggestion_yes]
+
+    # exception: always ask what's next
+    exception = np.asarray(exception, dtype=bool)
+    next_system_modes[exception] = SYSTEM_MODE_TO_IDX['whats_next']
+    attributes[exception] = NONE
+
+    return next_system_modes, attributes
@@ -7,10 +7,15 @@ def edit_target_attribute(opt,
                           field_model,
                           editing_logger=None,
                           print_intermediate_result=False,
-                          display_img=False):
+                          display_img=False,
+                          materialize=None,
+                          image_paths=None):
     """
     Input: current attribute labels, how to edit
     Output: updated attribute labels
+    materialize: images written by the editing, 'none' | 'final' | 'all',
+        see continuous_editing_with_target
+    image_paths: list the paths of the written images are appended to
     """
 
     edit_attr_name = edit_labels['attribute']
@@ -20,8 +25,8 @@ def edit_target_attribute(opt,
         return attribute_dict, exception_mode, latent_code, edited_latent_code
 
     # define network
+    field_model.select_field(edit_attr_name)
     field_model.target_attr_idx = int(opt['attr_to_idx'][edit_attr_name])
-    field_model.load_network(opt['pretrained_field'][edit_attr_name])
 
     latent_code, edited_latent_code, saved_label, exception_mode = \
         field_model.continuous_editing_with_target(
@@ -32,7 +37,9 @@ def edit_target_attribute(opt,
             edited_latent_code=edited_latent_code,
             prefix=f'edit_order_{str(round_idx)}',
             print_intermediate_result=print_intermediate_result,
-            display_img=display_img)
+            display_img=display_img,
+            materialize=materialize,
+            image_paths=image_paths)
 
     latent_code = latent_code.cpu().numpy()
 
@@ -0,0 +1,300 @@
+"""
+Micro-batching inference scheduler.
+
+Concurrent dialog sessions each synthesize and classify a few latent codes at
+a time, e.g., the start image or the trials of an edit. The scheduler collects
+the pending (latent codes, w plus flag, exit resolution) requests of all the
+sessions on an asyncio event loop and evaluates them with one batched
+generator + predictor forward, as soon as max_batch_size requests are pending
+or the oldest one has waited max_wait seconds. The results are returned to the
+future of each caller.
+
+Any model with synthesize_and_predict_batch can be served, e.g., BaseModel or
+the CPU StandInModel below, which is used by run_stand_in_client to exercise
+the scheduler without the pretrained models. The session models of
+dialog_service.py submit their requests from worker threads, see
+BaseModel.session_model.
+"""
+
+import asyncio
+import collections
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import torch
+
+
+class InferenceScheduler():
+    """Batch synthesize_and_predict requests of concurrent sessions.
+
+    Args:
+        model: Model with synthesize_and_predict_batch(latent_codes) and
+            stylegan_gen.n_latent.
+        max_batch_size (int): Maximum number of requests in one forward.
+        max_wait (float): Seconds the oldest request waits for the batch to
+            fill up.
+        latency_window (int): Number of the latest requests kept for the
+            latency statistics.
+    """
+
+    def __init__(self,
+                 model,
+                 max_batch_size=8,
+                 max_wait=0.005,
+                 latency_window=10000):
+        self.model = model
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+
+        self.loop = None
+        self.queue = None
+        self.worker = None
+        # the forwards run one at a time in their own thread, so that they
+        # are not held up by the callers blocked in the default executor
+        self.executor = None
+        # requests taken off the queue whose forward is not finished
+        self.in_flight = []
+
+        self.num_requests = 0
+        self.batch_size_hist = collections.Counter()
+        self.latencies = collections.deque(maxlen=latency_window)
+
+    def start(self):
+        """Start the batching worker on the running event loop."""
+        self.loop = asyncio.get_running_loop()
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.queue = asyncio.Queue()
+        self.worker = asyncio.ensure_future(self.run())
+
+    async def stop(self):
+        """Stop the batching worker, the requests still queued or in flight
+        fail with a RuntimeError."""
+        self.worker.cancel()
+        try:
+            await self.worker
+        except asyncio.CancelledError:
+            pass
+        self.worker = None
+        self.executor.shutdown(wait=False)
+
+        requests, self.in_flight = self.in_flight, []
+        while not self.queue.empty():
+            requests.append(self.queue.get_nowait())
+        for _, _, _, future, _ in requests:
+            if not future.done():
+                future.set_exception(
+                    RuntimeError('The inference scheduler is stopped.'))
+
+    @property
+    def queue_depth(self):
+        return self.queue.qsize() if self.queue is not None else 0
+
+    async def synthesize_and_predict(self,
+                                     latent_code,
+                                     is_w_plus=False,
+                                     exit_res=None):
+        """Same as BaseModel.synthesize_and_predict for a single latent code
+        ([1, 512], or [1, n_latent, 512] if is_w_plus), batched with the
+        requests of the other sessions.
+        """
+        images, labels, scores = await self.synthesize_and_predict_batch(
+            latent_code, is_w_plus, exit_res)
+        return images, labels[0], scores[0]
+
+    async def synthesize_and_predict_batch(self,
+                                           latent_codes,
+                                           is_w_plus=False,
+                                           exit_res=None):
+        """Same as BaseModel.synthesize_and_predict_batch, the latent codes of
+        the request are evaluated in one batch with the requests of the
+        other sessions.
+        """
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((latent_codes, is_w_plus, exit_res, future,
+                              time.perf_counter()))
+        return await future
+
+    def submit(self, latent_codes, is_w_plus=False, exit_res=None):
+        """synthesize_and_predict_batch for the callers in other threads than
+        the event loop, blocks until the batch of the request is evaluated.
+        """
+        return asyncio.run_coroutine_threadsafe(
+            self.synthesize_and_predict_batch(latent_codes, is_w_plus,
+                                              exit_res), self.loop).result()
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            requests = self.in_flight = [await self.queue.get()]
+            deadline = requests[0][4] + self.max_wait
+            while len(requests) < self.max_batch_size:
+                timeout = deadline - time.perf_counter()
+                try:
+                    if timeout > 0:
+                        requests.append(await asyncio.wait_for(
+                            self.queue.get(), timeout))
+                    else:
+                        requests.append(self.queue.get_nowait())
+                except (asyncio.TimeoutError, asyncio.QueueEmpty):
+                    break
+
+            # run the forward outside of the event loop, so that the
+            # sessions keep queueing requests for the next batch meanwhile
+            try:
+                results = await loop.run_in_executor(
+                    self.executor, self.forward,
+                    [request[:3] for request in requests])
+            except Exception as error:
+                for _, _, _, future, _ in requests:
+                    if not future.done():
+                        future.set_exception(error)
+                self.in_flight = []
+                continue
+            self.in_flight = []
+
+            finish_time = time.perf_counter()
+            self.num_requests += len(requests)
+            self.batch_size_hist[len(requests)] += 1
+            for (_, _, _, future, submit_time), result in zip(
+                    requests, results):
+                self.latencies.append(finish_time - submit_time)
+                if not future.done():
+                    future.set_result(result)
+
+    def forward(self, requests):
+        """Evaluate the requests, one batch per exit resolution."""
+        groups = collections.defaultdict(list)
+        for request_idx, (_, _, exit_res) in enumerate(requests):
+            groups[exit_res].append(request_idx)
+
+        results = [None] * len(requests)
+        for exit_res, request_indices in groups.items():
+            latent_codes = [requests[idx][0] for idx in request_indices]
+            if any(requests[idx][1] for idx in request_indices):
+                # w latent codes are broadcast to all the layers, as the
+                # generator does for w latent codes
+                n_latent = self.model.stylegan_gen.n_latent
+                latent_codes = [
+                    latent_code if requests[idx][1] else
+                    latent_code.unsqueeze(1).repeat(1, n_latent, 1)
+                    for idx, latent_code in zip(request_indices, latent_codes)
+                ]
+
+            with torch.no_grad():
+                images, labels, scores = \
+                    self.model.synthesize_and_predict_batch(
+                        torch.cat(latent_codes), exit_res)
+
+            start = 0
+            for idx, latent_code in zip(request_indices, latent_codes):
+                end = start + latent_code.size(0)
+                results[idx] = (images[start:end], labels[start:end],
+                                scores[start:end])
+                start = end
+
+        return results
+
+    def metrics(self):
+        latencies = np.array(self.latencies)
+        metrics = {
+            'queue_depth': self.queue_depth,
+            'num_requests': self.num_requests,
+            'batch_size_hist': dict(sorted(self.batch_size_hist.items())),
+        }
+        if len(latencies) > 0:
+            metrics['latency'] = {
+                'mean': float(latencies.mean()),
+                'p50': float(np.percentile(latencies, 50)),
+                'p95': float(np.percentile(latencies, 95)),
+                'max': float(latencies.max())
+            }
+        return metrics
+
+
+class StandInGenerator():
+
+    def __init__(self, n_latent):
+        self.n_latent = n_latent
+
+
+class StandInModel():
+    """CPU stand-in of BaseModel for exercising the scheduler.
+
+    Images are blank, labels and scores are derived from the latent codes,
+    and each forward sleeps forward_time seconds to mimic a batched forward
+    whose cost does not grow much with the batch size.
+    """
+
+    def __init__(self,
+                 img_res=128,
+                 n_latent=12,
+                 num_attr=5,
+                 max_cls_num=5,
+                 forward_time=0.02):
+        self.img_res = img_res
+        self.stylegan_gen = StandInGenerator(n_latent)
+        self.num_attr = num_attr
+        self.max_cls_num = max_cls_num
+        self.forward_time = forward_time
+
+    def synthesize_and_predict_batch(self, sample_latent_codes,
+                                     exit_res=None):
+        time.sleep(self.forward_time)
+        batch_size = sample_latent_codes.size(0)
+        res = self.img_res if exit_res is None else exit_res
+        images = torch.zeros(batch_size, 3, res, res)
+
+        latent_codes = sample_latent_codes.view(batch_size, -1)
+        scores = torch.sigmoid(latent_codes[:, :self.num_attr])
+        labels = (scores * (self.max_cls_num + 1)).long().clamp(
+            max=self.max_cls_num)
+
+        return images, labels.tolist(), scores.tolist()
+
+
+async def run_stand_in_client(num_sessions=16,
+                              num_turns=8,
+                              max_batch_size=8,
+                              max_wait=0.005,
+                              latent_dim=512,
+                              model=None,
+                              threaded=False):
+    """Drive the scheduler with num_sessions concurrent sessions, each
+    requesting num_turns single latent codes one after another.
+
+    If threaded, the sessions run in worker threads and block on submit, as
+    the rounds of dialog_service.py do.
+
+    Returns the metrics of the scheduler.
+    """
+    if model is None:
+        model = StandInModel()
+    scheduler = InferenceScheduler(model, max_batch_size, max_wait)
+    scheduler.start()
+
+    def request(session_id, turn):
+        if (session_id + turn) % 2 == 0:
+            return torch.randn(1, latent_dim), False
+        return torch.randn(1, model.stylegan_gen.n_latent, latent_dim), True
+
+    async def session(session_id):
+        for turn in range(num_turns):
+            await scheduler.synthesize_and_predict(*request(session_id, turn))
+
+    def threaded_session(session_id):
+        for turn in range(num_turns):
+            scheduler.submit(*request(session_id, turn))
+
+    if threaded:
+        loop = asyncio.get_running_loop()
+        with ThreadPoolExecutor(max_workers=num_sessions) as executor:
+            await asyncio.gather(*[
+                loop.run_in_executor(executor, threaded_session, idx)
+                for idx in range(num_sessions)
+            ])
+    else:
+        await asyncio.gather(*[session(idx) for idx in range(num_sessions)])
+    await scheduler.stop()
+
+    return scheduler.metrics()
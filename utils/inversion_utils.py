@@ -1,4 +1,8 @@
+import glob
+import json
+import logging
 import math
+import os
 
 import models.archs.stylegan2.lpips as lpips
 import numpy as np
@@ -11,6 +15,8 @@ from tqdm import tqdm
 
 from utils.crop_img import crop_img
 
+logger = logging.getLogger('base')
+
 
 def noise_regularize(noises):
     loss = 0
@@ -61,14 +67,127 @@ def make_image(tensor):
         torch.uint8).permute(0, 2, 3, 1).to("cpu").numpy())
 
 
-def inversion(opt, field_model):
+class ConvergenceMonitor():
+    """Detect the plateau of an inversion loss.
+
+    The loss is averaged over windows of window steps. A window that does
+    not lower the best window mean by at least min_improvement (relative)
+    counts against the patience, an improving window resets it. The loss
+    has converged after patience windows in a row without improvement, but
+    never before min_step steps of the inversion, the steps of the coarse
+    stages that are not monitored included.
+    """
+
+    def __init__(self,
+                 window=50,
+                 min_improvement=1e-3,
+                 patience=2,
+                 min_step=0):
+        self.window = window
+        self.min_improvement = min_improvement
+        self.patience = patience
+        self.min_step = min_step
+
+        self.num_steps = 0
+        self.reset()
+
+    def reset(self):
+        """Forget the loss level, e.g., when the loss changes its scale at a
+        new stage. The number of steps is kept."""
+        self.window_losses = []
+        self.best_mean = None
+        self.num_bad_windows = 0
+
+    @classmethod
+    def from_opt(cls, early_stop_opt):
+        """A monitor configured by the early_stop block of the inversion
+        options, None if the block is not given."""
+        if early_stop_opt is None:
+            return None
+        return cls(
+            window=early_stop_opt.get('window', 50),
+            min_improvement=early_stop_opt.get('min_improvement', 1e-3),
+            patience=early_stop_opt.get('patience', 2),
+            min_step=early_stop_opt.get('min_step', 0))
+
+    def update(self, loss, step=None):
+        """Add the loss of one step, returns True if converged.
+
+        step is the number of inversion steps run so far, counting the
+        unmonitored ones; defaults to the number of updates.
+        """
+        self.num_steps = self.num_steps + 1 if step is None else step
+        self.window_losses.append(float(loss))
+        if len(self.window_losses) < self.window:
+            return False
+
+        window_mean = sum(self.window_losses) / self.window
+        self.window_losses = []
+        if self.best_mean is not None and window_mean > self.best_mean * (
+                1 - self.min_improvement):
+            self.num_bad_windows += 1
+        else:
+            self.num_bad_windows = 0
+        if self.best_mean is None or window_mean < self.best_mean:
+            self.best_mean = window_mean
+
+        return self.num_steps >= self.min_step and \
+            self.num_bad_windows >= self.patience
+
+
+def downsample_image(img):
+    """Average pool images larger than 256 to 256 for the losses."""
+    batch, channel, height, width = img.shape
+
+    if height > 256:
+        factor = height // 256
+
+        img = img.reshape(batch, channel, height // factor, factor,
+                          width // factor, factor)
+        img = img.mean([3, 5])
+
+    return img
+
+
+def inversion_res(inv_opt, img_res, t):
+    """Resolution rendered at the progress t of the inversion of an image.
+
+    The stages of inv_opt['coarse_to_fine'] are dicts of 'until' (the
+    progress the stage ends at) and 'res' (a power of two, capped to
+    img_res), in order. After the last stage, and without stages, the
+    generator renders at img_res.
+    """
+    for stage in inv_opt['coarse_to_fine'] or []:
+        if t < stage['until']:
+            return min(stage['res'], img_res)
+    return img_res
 
-    inv_opt = opt['inversion']
-    device = inv_opt['device']
 
+def render_inversion(generator, latent, res):
+    """Render the w latent codes at res, exiting the generator early below
+    its full resolution, downsampled for the losses."""
+    img_gen, _ = generator([latent],
+                           input_is_latent=True,
+                           randomize_noise=False,
+                           exit_res=res if res < generator.size else None)
+
+    return downsample_image(img_gen)
+
+
+def resize_target(img, res):
+    """Area downscale the target to a coarse stage rendered at res."""
+    if res < img.shape[-1]:
+        img = F.interpolate(img, (res, res), mode='area')
+
+    return img
+
+
+def load_target_image(opt, img_path, cropped_output_path):
+    """Load the image to be inverted as a [1, 3, H, W] tensor in [-1, 1],
+    cropped and aligned first if inv_opt['crop_img']."""
+    inv_opt = opt['inversion']
     img_size = opt['img_res']
 
-    # inversion
     transform = transforms.Compose([
         transforms.Resize(img_size),
         transforms.CenterCrop(img_size),
@@ -77,31 +196,31 @@ def inversion(opt, field_model):
     ])
 
     if inv_opt['crop_img']:
-        cropped_output_path = f'{opt["path"]["visualization"]}/cropped.png'
-        crop_img(img_size, inv_opt['img_path'], cropped_output_path, device)
+        crop_img(img_size, img_path, cropped_output_path, inv_opt['device'])
         img = transform(Image.open(cropped_output_path).convert("RGB"))
     else:
-        img = transform(Image.open(inv_opt['img_path']).convert("RGB"))
+        img = transform(Image.open(img_path).convert("RGB"))
 
     img = img.unsqueeze(0).to(torch.device('cuda'))
 
-    batch, channel, height, width = img.shape
+    return downsample_image(img)
 
-    if height > 256:
-        factor = height // 256
 
-        img = img.reshape(batch, channel, height // factor, factor,
-                          width // factor, factor)
-        img = img.mean([3, 5])
+def inversion(opt, field_model):
 
-    n_mean_latent = 10000
-    with torch.no_grad():
-        noise_sample = torch.randn(n_mean_latent, 512, device=device)
-        latent_out = field_model.stylegan_gen.style_forward(noise_sample)
+    inv_opt = opt['inversion']
+    device = inv_opt['device']
+
+    # inversion
+    img = load_target_image(
+        opt, inv_opt['img_path'],
+        f'{opt["path"]["visualization"]}/cropped.png')
 
-        latent_mean = latent_out.mean(0)
-        latent_std = ((latent_out - latent_mean).pow(2).sum() /
-                      n_mean_latent)**0.5
+    n_mean_latent = 10000
+    # loaded from next to the generator checkpoint after the first run
+    latent_stats = field_model.stylegan_gen.get_latent_stats(n_mean_latent)
+    latent_mean = latent_stats['mean']
+    latent_std = latent_stats['std']
 
     percept = lpips.PerceptualLoss(
         model="net-lin", net="vgg", use_gpu=device.startswith("cuda"))
@@ -124,9 +243,13 @@ def inversion(opt, field_model):
     }],
                            lr=inv_opt['lr'])
 
+    # stops once the loss plateaus if inv_opt['early_stop'] is given
+    monitor = ConvergenceMonitor.from_opt(inv_opt['early_stop'])
+
     pbar = tqdm(range(inv_opt['step']))
 
     latent_path = []
+    res = None
     for i in pbar:
         t = i / inv_opt['step']
         lr = get_lr(t, inv_opt['lr'])
@@ -134,23 +257,21 @@ def inversion(opt, field_model):
         noise_strength = latent_std * inv_opt['noise'] * max(
             0, 1 - t / inv_opt['noise_ramp'])**2
 
-        latent_n = latent_noise(latent_in, noise_strength.item())
-
-        img_gen, _ = field_model.stylegan_gen([latent_n],
-                                              input_is_latent=True,
-                                              randomize_noise=False)
-
-        batch, channel, height, width = img_gen.shape
+        if inversion_res(inv_opt, opt['img_res'], t) != res:
+            # coarse stages render at a lower resolution, against the
+            # downscaled target; its vgg features are computed once a stage
+            res = inversion_res(inv_opt, opt['img_res'], t)
+            target = resize_target(img, res)
+            percept.set_target(target)
+            if monitor is not None:
+                monitor.reset()
 
-        if height > 256:
-            factor = height // 256
+        latent_n = latent_noise(latent_in, noise_strength.item())
 
-            img_gen = img_gen.reshape(batch, channel, height // factor, factor,
-                                      width // factor, factor)
-            img_gen = img_gen.mean([3, 5])
+        img_gen = render_inversion(field_model.stylegan_gen, latent_n, res)
 
-        p_loss = percept(img_gen, img).sum()
-        mse_loss = F.mse_loss(img_gen, img)
+        p_loss = percept(img_gen).sum()
+        mse_loss = F.mse_loss(img_gen, target)
 
         loss = p_loss + inv_opt['img_mse_weight'] * mse_loss
 
@@ -164,7 +285,244 @@ def inversion(opt, field_model):
         pbar.set_description((f"total: {loss:.4f}; perceptual: {p_loss:.4f};"
                               f" mse: {mse_loss:.4f}; lr: {lr:.4f}"))
 
+        # only the full resolution stage may stop early
+        if monitor is not None and res == opt['img_res'] and monitor.update(
+                loss.item(), step=i + 1):
+            break
+
+    pbar.close()
+    logger.info(f'Inversion finished after {i + 1} steps, total: {loss:.4f}; '
+                f'perceptual: {p_loss:.4f}; mse: {mse_loss:.4f}')
+
     latent_code = latent_in[0].cpu().detach().numpy()
     latent_code = np.expand_dims(latent_code, axis=0)
 
     return latent_code
+
+
+IMG_EXTENSIONS = ['.png', '.jpg', '.jpeg', '.PNG', '.JPG', '.JPEG']
+
+
+class LatentStore():
+    """Inverted w latent codes saved as one [1, 512] .npy file per image.
+
+    Each latent code is written as soon as its image is inverted, through a
+    temporary file, so an interrupted batch inversion leaves only complete
+    files and resumes with the images that are not in the store.
+    """
+
+    def __init__(self, store_dir):
+        self.store_dir = store_dir
+        os.makedirs(store_dir, exist_ok=True)
+
+    def path(self, name):
+        return f'{self.store_dir}/{name}.npy'
+
+    def __contains__(self, name):
+        return os.path.exists(self.path(name))
+
+    def info_path(self, name):
+        return f'{self.store_dir}/{name}.json'
+
+    def save(self, name, latent_code, info=None):
+        """Save the latent code and the info dict of the inversion, e.g., the
+        number of steps and the final losses."""
+        if info is not None:
+            # the latent code is written last, it marks the image as done
+            with open(self.info_path(name), 'w') as f:
+                json.dump(info, f)
+        tmp_path = f'{self.store_dir}/{name}.tmp.npy'
+        np.save(tmp_path, latent_code)
+        os.replace(tmp_path, self.path(name))
+
+    def load(self, name):
+        return np.load(self.path(name))
+
+    def load_info(self, name):
+        if not os.path.exists(self.info_path(name)):
+            return None
+        with open(self.info_path(name), 'r') as f:
+            return json.load(f)
+
+    def load_all(self):
+        """Returns {image name: latent code} of all the saved images."""
+        return {
+            os.path.basename(path)[:-len('.npy')]: np.load(path)
+            for path in sorted(glob.glob(f'{self.store_dir}/*.npy'))
+            if not path.endswith('.tmp.npy')
+        }
+
+
+def list_images(img_paths):
+    """The image paths of a directory, or the given list of paths."""
+    if isinstance(img_paths, str):
+        return sorted(
+            path for path in glob.glob(f'{img_paths}/*')
+            if os.path.splitext(path)[1] in IMG_EXTENSIONS)
+    return list(img_paths)
+
+
+def batch_inversion(opt, field_model, img_paths, store_dir, batch_size=None):
+    """Invert many images by optimizing a [N, 512] w latent batch jointly.
+
+    Each of the batch_size slots optimizes one image with its own step
+    counter, learning rate and noise schedule and Adam state, and the loss
+    of each image only drives its own latent code. The images that are in
+    the same coarse_to_fine stage are rendered together. When an image
+    finishes inv_opt['step'] steps, or its loss converges if
+    inv_opt['early_stop'] is given, its latent code is saved to the
+    LatentStore in store_dir with the number of steps and the final losses,
+    and the slot takes the next image. Images already in the store are
+    skipped, so an interrupted run resumes where it stopped.
+
+    Unlike inversion, the generator is not tuned: it is shared by all the
+    images of the batch, inv_opt['lr_gen'] is ignored.
+
+    Args:
+        img_paths (str | list[str]): Directory of the images or their paths.
+        store_dir (str): Directory of the LatentStore.
+        batch_size (int | None): Number of images optimized together,
+            defaults to inv_opt['batch_size'] or 8.
+
+    Returns:
+        dict: {image name: [1, 512] w latent code} of all the images in
+            the store.
+    """
+    inv_opt = opt['inversion']
+    device = inv_opt['device']
+    batch_size = batch_size or inv_opt['batch_size'] or 8
+    generator = field_model.stylegan_gen
+    img_res = opt['img_res']
+
+    store = LatentStore(store_dir)
+    pending = [
+        path for path in list_images(img_paths)
+        if os.path.basename(path) not in store
+    ]
+
+    n_mean_latent = 10000
+    latent_stats = generator.get_latent_stats(n_mean_latent)
+    latent_mean = latent_stats['mean']
+    latent_std = latent_stats['std']
+
+    percept = lpips.PerceptualLoss(
+        model="net-lin", net="vgg", use_gpu=device.startswith("cuda"))
+
+    # one parameter group per slot, for the per-image learning rate
+    slots = [{
+        'group': group,
+        'latent': latent_mean.detach().clone().unsqueeze(0).requires_grad_(),
+        'name': None
+    } for group in range(min(batch_size, len(pending)))]
+    if len(slots) == 0:
+        return store.load_all()
+    optimizer = optim.Adam([{
+        'params': [slot['latent']]
+    } for slot in slots],
+                           lr=inv_opt['lr'])
+
+    def fill(slot):
+        if len(pending) == 0:
+            slot['name'] = None
+            return
+        img_path = pending.pop(0)
+        slot['name'] = os.path.basename(img_path)
+        slot['img'] = load_target_image(
+            opt, img_path,
+            f'{opt["path"]["visualization"]}/cropped_{slot["name"]}')
+        slot['step'] = 0
+        slot['res'] = None
+        slot['monitor'] = ConvergenceMonitor.from_opt(inv_opt['early_stop'])
+        # restart from the mean latent with a fresh Adam state
+        with torch.no_grad():
+            slot['latent'].copy_(latent_mean.unsqueeze(0))
+        optimizer.state.pop(slot['latent'], None)
+
+    for slot in slots:
+        fill(slot)
+
+    pbar = tqdm(total=len(pending) + len(slots))
+    active = [slot for slot in slots if slot['name'] is not None]
+    while len(active) > 0:
+        for slot in active:
+            t = slot['step'] / inv_opt['step']
+            optimizer.param_groups[slot['group']]['lr'] = get_lr(
+                t, inv_opt['lr'])
+            noise_strength = latent_std * inv_opt['noise'] * max(
+                0, 1 - t / inv_opt['noise_ramp'])**2
+            slot['latent_n'] = latent_noise(slot['latent'],
+                                            noise_strength.item())
+
+            res = inversion_res(inv_opt, img_res, t)
+            if res != slot['res']:
+                # the target and its features are cached for each stage
+                slot['res'] = res
+                slot['target'] = resize_target(slot['img'], res)
+                slot['target_feats'] = percept.target_features(
+                    slot['target'])
+                if slot['monitor'] is not None:
+                    slot['monitor'].reset()
+
+        # the images of the batch may be in different stages, one forward
+        # per resolution
+        groups = []
+        for res in sorted(set(slot['res'] for slot in active)):
+            group = [slot for slot in active if slot['res'] == res]
+            img_gen = render_inversion(
+                generator, torch.cat([slot['latent_n'] for slot in group]),
+                res)
+            target = torch.cat([slot['target'] for slot in group])
+            target_feats = [
+                torch.cat(layer_feats) for layer_feats in zip(
+                    *[slot['target_feats'] for slot in group])
+            ]
+
+            # per image losses, summed so that each latent code only gets
+            # the gradient of its own image
+            p_loss = percept(img_gen, target_feats=target_feats).view(-1)
+            mse_loss = (img_gen - target).pow(2).mean([1, 2, 3])
+            loss = p_loss + inv_opt['img_mse_weight'] * mse_loss
+            groups.append((group, loss, p_loss, mse_loss))
+
+        active = [slot for group in groups for slot in group[0]]
+        loss, p_loss, mse_loss = [
+            torch.cat([group[idx] for group in groups]) for idx in range(1, 4)
+        ]
+
+        optimizer.zero_grad()
+        latents = [slot['latent'] for slot in active]
+        # the generator is not tuned, skip its gradients
+        grads = torch.autograd.grad(loss.sum(), latents)
+        for latent, grad in zip(latents, grads):
+            latent.grad = grad
+        optimizer.step()
+
+        pbar.set_description(
+            f'images: {len(active)}; total: {loss.mean():.4f}; '
+            f'perceptual: {p_loss.mean():.4f}; '
+            f'mse: {mse_loss.mean():.4f}')
+
+        losses = torch.stack([loss, p_loss, mse_loss], dim=1).tolist()
+        for slot, slot_losses in zip(active, losses):
+            slot['step'] += 1
+            # only the full resolution stage may stop early
+            converged = slot['monitor'] is not None and \
+                slot['res'] == img_res and \
+                slot['monitor'].update(slot_losses[0], step=slot['step'])
+            if converged or slot['step'] == inv_opt['step']:
+                store.save(
+                    slot['name'],
+                    slot['latent'].detach().cpu().numpy(), {
+                        'step': slot['step'],
+                        'converged': converged,
+                        'loss': slot_losses[0],
+                        'perceptual': slot_losses[1],
+                        'mse': slot_losses[2]
+                    })
+                pbar.update(1)
+                fill(slot)
+        active = [slot for slot in slots if slot['name'] is not None]
+
+    pbar.close()
+
+    return store.load_all()
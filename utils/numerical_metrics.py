@@ -7,7 +7,8 @@ import torch
 import torch.nn as nn
 import torch.nn.functional as F
 import torchvision.transforms as transforms
-from models.archs.attribute_predictor_arch import resnet50
+from models.archs.attribute_predictor_arch import (fold_input_normalization,
+                                                   resnet50)
 from models.losses.arcface_loss import resnet_face18
 from models.utils import output_to_label
 from PIL import Image
@@ -89,17 +90,9 @@ def load_image_predictor(img_path,
                                                        ])):
     image = Image.open(img_path).convert('RGB')
     image = transform(image)
+    # resized and normalized inside the predictor
     image = image.to(torch.device('cuda')).unsqueeze(0)
 
-    if image.size()[-1] > 128:
-        image = F.interpolate(image, (128, 128), mode='area')
-
-    img_mean = torch.Tensor([0.485, 0.456,
-                             0.406]).view(1, 3, 1, 1).to(torch.device('cuda'))
-    img_std = torch.Tensor([0.229, 0.224,
-                            0.225]).view(1, 3, 1, 1).to(torch.device('cuda'))
-    image = (image - img_mean) / img_std
-
     return image
 
 
@@ -162,6 +155,8 @@ def compute_num_metrics(image_dir, image_num, pretrained_arcface, attr_file,
     checkpoint = torch.load(pretrained_predictor)
     predictor.load_state_dict(checkpoint['state_dict'], strict=True)
     predictor.eval()
+    # the predictor takes the [0, 1] images directly
+    predictor = fold_input_normalization(predictor)
 
     criterion_predictor = nn.CrossEntropyLoss(reduction='mean')
 